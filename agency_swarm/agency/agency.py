@@ -1,10 +1,17 @@
+import bisect
+import functools
+import hashlib
 import inspect
+import itertools
 import json
+import logging
 import os
-import queue
 import re
 import threading
+import time
 import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
 from enum import Enum
 from typing import (
@@ -13,6 +20,8 @@ from typing import (
     Dict,
     List,
     Literal,
+    NamedTuple,
+    Optional,
     Tuple,
     Type,
     TypedDict,
@@ -20,7 +29,7 @@ from typing import (
     Union,
 )
 
-from dotenv import load_dotenv
+from openai import APITimeoutError
 from openai.lib._parsing._completions import type_to_response_format_param
 from openai.types.beta.threads import Message
 from openai.types.beta.threads.runs import RunStep
@@ -43,15 +52,232 @@ from agency_swarm.threads.thread_async import ThreadAsync
 from agency_swarm.tools import BaseTool, CodeInterpreter, FileSearch
 from agency_swarm.tools.send_message import SendMessage, SendMessageBase
 from agency_swarm.user import User
+from agency_swarm.util import fast_json
+from agency_swarm.util.cache import PlanCache, ResponseCache
 from agency_swarm.util.errors import RefusalError
 from agency_swarm.util.files import get_file_purpose, get_tools
 from agency_swarm.util.shared_state import SharedState
 from agency_swarm.util.streaming import AgencyEventHandler
+from agency_swarm.util.swap_buffer import SwapBuffer
 
 console = Console()
+log = logging.getLogger(__name__)
 
 T = TypeVar("T", bound=BaseModel)
 
+# Gradio流式输出时，文本增量攒到这么多字符或这么久（秒）再推送给界面
+_TEXT_BATCH_CHARS = 512
+_TEXT_BATCH_INTERVAL = 0.01
+
+# task_planning的开关在导入时从环境变量读取一次（.env已由agency_swarm.util.oai加载），
+# 需要临时切换时可直接修改模块属性
+# 是否启用“代码级调度”模式（DEBUG_CODE_SCHEDULING）
+CODE_SCHEDULING = os.getenv("DEBUG_CODE_SCHEDULING", "").lower() == "true"
+# 同一批可调度的step是否并发执行（PARALLEL_STEPS）
+PARALLEL_STEPS = os.getenv("PARALLEL_STEPS", "").lower() == "true"
+# RAG检索相关配置，同样在导入时读取一次
+# planning_layer是否先通过RAGFlow检索运维手册（USE_RAG）
+USE_RAG = os.getenv("USE_RAG") == "True"
+RAGFLOW_API_KEY = os.getenv("RAGFLOW_API_KEY")
+RAGFLOW_ASSISTANT_NAME = os.getenv("ASSISTANT_NAME")
+RAGFLOW_SESSION_NAME = os.getenv("SESSION_NAME")
+# 任务树中各层节点存放子节点的字段：请求 -> 任务 -> 子任务 -> 步骤 -> 动作
+_CONTEXT_TREE_CHILDREN = ("tasks", "subtasks", "steps", "actions")
+# json_get_completion多次无法得到json时返回的空结果
+_EMPTY_JSON = json.dumps({})
+# task_planning中同时执行的step数上限
+_MAX_PARALLEL_STEPS = 8
+# step超时后原地重试的次数，超过后再交给上一级重新规划
+_STEP_TIMEOUT_RETRIES = 1
+# 事件回调中按tool_call["type"]查找对应的ToolCall类
+_TOOL_CALL_CLASSES = {
+    "function": FunctionToolCall,
+    "code_interpreter": CodeInterpreterToolCall,
+    "file_search": FileSearchToolCall,
+    "retrieval": FileSearchToolCall,
+}
+
+# demo_gradio注入的主题切换脚本，在导入时生成两种主题的版本
+_THEME_JS = """function () {
+  gradioURL = window.location.href
+  if (!gradioURL.endsWith('?__theme={theme}')) {
+    window.location.replace(gradioURL + '?__theme={theme}');
+  }
+}"""
+_THEME_JS_DARK = _THEME_JS.replace("{theme}", "dark")
+_THEME_JS_LIGHT = _THEME_JS.replace("{theme}", "light")
+
+
+def _drain_generator(gen):
+    """Runs a generator to exhaustion and returns its return value.
+
+    deque(maxlen=0) consumes the items in C; the wrapper only captures the StopIteration value.
+    """
+    result = []
+
+    def capture():
+        result.append((yield from gen))
+
+    deque(capture(), maxlen=0)
+    return result[0]
+
+
+def _hold_lock(lock, gen):
+    """Wraps a generator so that lock is held from the first item until it is exhausted or closed."""
+    with lock:
+        return (yield from gen)
+
+
+def _tool_class_names(agent: Agent) -> frozenset:
+    """Returns the names of the agent's tool classes, cached until the tool list changes length."""
+    cached = getattr(agent, "_tool_class_names_cache", None)
+    if cached is None or cached[0] != len(agent.tools):
+        names = frozenset(
+            getattr(tool, "__name__", type(tool).__name__) for tool in agent.tools
+        )
+        cached = (len(agent.tools), names)
+        agent._tool_class_names_cache = cached
+    return cached[1]
+
+
+def _coerce_tool_call(tool_call: dict) -> ToolCall:
+    """Builds the ToolCall model for a tool call that the stream delivered as a plain dict."""
+    tool_call_type = tool_call.setdefault("type", "function")
+    tool_call_class = _TOOL_CALL_CLASSES.get(tool_call_type)
+    if tool_call_class is None:
+        raise ValueError("Invalid tool call type: " + tool_call_type)
+    return tool_call_class(**tool_call)
+
+
+def _with_files_lock(method):
+    """Runs a method that reads and rewrites the shared json files while holding the agency's files lock."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._files_lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+@functools.lru_cache(maxsize=128)
+def _response_format_for(model: Type[BaseModel]) -> dict:
+    """Builds the OpenAI response_format for a pydantic model once per model class."""
+    return type_to_response_format_param(model)
+
+
+def _loads_scheduled_ids(scheduled: str, field: str):
+    """Returns the value under ``field`` of a scheduler response, parsed with the generic json path."""
+    return fast_json.loads(scheduled)[field]
+
+
+try:
+    import msgspec
+
+    # 调度器的三种返回结果各自只解码需要的字段，其余字段在解析时直接跳过；
+    # 字段为null时得到None，与直接用json解析时一致
+    _SCHEDULE_DECODERS = {
+        field: msgspec.json.Decoder(
+            msgspec.defstruct(f"_{field}", [(field, Optional[list])])
+        )
+        for field in ("next_tasks", "next_subtasks", "next_steps")
+    }
+
+    def _scheduled_ids(scheduled: str, field: str) -> Optional[list]:
+        """Returns the list of node ids under ``field`` of a scheduler response."""
+        try:
+            return getattr(_SCHEDULE_DECODERS[field].decode(scheduled), field)
+        except msgspec.MsgspecError:
+            # 字段缺失、类型不符或不是合法json时改用通用解析，结果和异常（KeyError、
+            # JSONDecodeError）与未安装msgspec时相同
+            return _loads_scheduled_ids(scheduled, field)
+
+except ImportError:
+    _scheduled_ids = _loads_scheduled_ids
+
+
+class _DependencyTracker:
+    """Incremental ready set of a plan graph ``{node_id: {"dep": [...], ...}}``.
+
+    The reverse-dependency map and the number of unfinished dependencies of each node are built once
+    per graph. Each ``ready`` call then only visits the dependents of the nodes completed since the
+    previous call, instead of re-checking every dependency of every node. The "id (title)" labels of
+    completed nodes are kept the same way, so progress lines do not rebuild them on every call.
+    """
+
+    def __init__(self, graph: Dict[str, Dict[str, Any]]):
+        self._graph = graph
+        self._order = {node_id: index for index, node_id in enumerate(graph)}
+        self._completed_labels = []
+        self._completed_text = "none"
+        self._dependents = {}
+        self._waiting = {}
+        self._ready = set()
+        self._completed = set()
+        self._seen = 0
+        for node_id, info in graph.items():
+            deps = set(info.get("dep", ()))
+            self._waiting[node_id] = len(deps)
+            for dep in deps:
+                self._dependents.setdefault(dep, []).append(node_id)
+            if not deps:
+                self._ready.add(node_id)
+
+    def ready(self, completed_ids: List[str]) -> List[str]:
+        """Returns the unfinished nodes whose dependencies have all completed, in graph order.
+
+        ``completed_ids`` must only grow between calls; ids after the ones seen last time are processed.
+        """
+        new_ids = completed_ids[self._seen :]
+        for node_id in new_ids:
+            if node_id in self._completed:
+                continue
+            self._completed.add(node_id)
+            self._completed_labels.append(self.label(node_id))
+            self._ready.discard(node_id)
+            for dependent in self._dependents.get(node_id, ()):
+                self._waiting[dependent] -= 1
+                if not self._waiting[dependent] and dependent not in self._completed:
+                    self._ready.add(dependent)
+        self._seen = len(completed_ids)
+        if new_ids and self._completed_labels:
+            self._completed_text = ", ".join(self._completed_labels)
+        return sorted(self._ready, key=self._order.__getitem__)
+
+    def pending(self, ready_ids: List[str]) -> List[str]:
+        """Returns the nodes that are neither completed nor in ``ready_ids``, in graph order."""
+        return sorted(
+            self._order.keys() - self._completed - set(ready_ids),
+            key=self._order.__getitem__,
+        )
+
+    def label(self, node_id: str) -> str:
+        return f"{node_id} ({self._graph[node_id]['title']})"
+
+    @property
+    def completed_text(self) -> str:
+        """Comma-separated labels of the completed nodes, or "none"; rebuilt only when nodes complete."""
+        return self._completed_text
+
+
+class StepError(NamedTuple):
+    """Failure of a single step in task_planning.
+
+    The payload is kept as the original object (the agent's context or the exception) and only turned
+    into text when it is printed or handed to the planner.
+    """
+
+    id: int
+    # "fail": 能力agent返回FAIL；"validation": 返回结果不合法；
+    # "timeout": 请求超时；"exec": 执行时抛出的其他异常
+    kind: Literal["fail", "validation", "timeout", "exec"]
+    payload: Any
+    step_id: str
+
+    @property
+    def message(self) -> str:
+        return str(self.payload)
+
 
 class SettingsCallbacks(TypedDict):
     load: Callable[[], List[Dict]]
@@ -81,6 +307,11 @@ class Agency:
         max_completion_tokens: int = None,
         truncation_strategy: dict = None,
         log_file=None,
+        response_cache: ResponseCache = None,
+        cached_agents: List[str] = None,
+        event_callback: Callable[[str, str, str], Any] = None,
+        cache_completions: bool = False,
+        plan_cache: PlanCache = None,
     ):
         """
         Initializes the Agency object, setting up agents, threads, and core functionalities.
@@ -100,20 +331,38 @@ class Agency:
             max_prompt_tokens (int, optional): The maximum number of tokens allowed in the prompt for each agent. Agent-specific values will override this. Defaults to None.
             max_completion_tokens (int, optional): The maximum number of tokens allowed in the completion for each agent. Agent-specific values will override this. Defaults to None.
             truncation_strategy (dict, optional): The truncation strategy to use for the completion for each agent. Agent-specific values will override this. Defaults to None.
+            response_cache (ResponseCache, optional): A cache consulted before sending a json completion request to any agent listed in cached_agents. Lookups are exact, except that a planner's plan for the original request may be reused for a similar request. Defaults to None.
+            cached_agents (List[str], optional): Names of the agents whose json completions may be served from response_cache. Agents that execute side effects should not be listed. Defaults to None.
+            event_callback (Callable[[str, str, str], Any], optional): Called as event_callback(agent_name, role, content) for every message sent to an agent through json_get_completion and for every reply, e.g. to stream the transcript to a JSONL file. Defaults to None.
+            cache_completions (bool, optional): Whether get_completion may serve repeated identical requests from response_cache. Only plain requests (no files, attachments, tool_choice, streaming or verbose output) are cached. Defaults to False.
+            plan_cache (PlanCache, optional): A persistent cache of task, subtask and step plans. task_planning and task_planning_rag reuse a cached plan instead of calling the planner, and stores a plan once every node in it has completed. Only plans for the original request are matched by similarity; task and subtask plans are reused on an exact match only. Defaults to None.
 
         This constructor initializes various components of the Agency, including CEO, agents, threads, and user interactions. It parses the agency chart to set up the organizational structure and initializes the messaging tools, agents, and threads necessary for the operation of the agency. Additionally, it prepares a main thread for user interactions.
         """
         self.ceo = None
         self.user = User()
         self.agents = []
+        # 在_add_agent中维护，解析agency_chart时按名字/id直接查找，无需遍历self.agents
+        self._agents_by_name = {}
+        self._agent_indices_by_id = {}
         self.agents_and_threads = {}
         self.main_recipients = []
+        self._main_recipient_ids = set()
         self.main_thread = None
         self.recipient_agents = None  # for autocomplete
-        self.thread_strategy = thread_strategy
+        # SendMessage每次调用都会判断(调用方, 接收方)是否在策略中，转为frozenset以便O(1)查找
+        self.thread_strategy = {
+            strategy: frozenset(pairs) for strategy, pairs in thread_strategy.items()
+        }
         self.shared_files = shared_files if shared_files else []
         self.async_mode = async_mode
         self.send_message_tool_class = send_message_tool_class
+        # SendMessage的输出是否直接作为结果返回，终端事件处理器每次工具调用结束都要判断
+        self._output_as_result = getattr(
+            getattr(send_message_tool_class, "ToolConfig", None),
+            "output_as_result",
+            False,
+        )
         self.settings_path = settings_path
         self.settings_callbacks = settings_callbacks
         self.threads_callbacks = threads_callbacks
@@ -123,6 +372,31 @@ class Agency:
         self.max_completion_tokens = max_completion_tokens
         self.truncation_strategy = truncation_strategy
         self.log_file = log_file
+        self.response_cache = response_cache
+        self.cached_agents = set(cached_agents) if cached_agents else set()
+        self.event_callback = event_callback
+        self.cache_completions = cache_completions
+        self.plan_cache = plan_cache
+        # context_tree.json的内存副本，修改后标记为dirty，在agent读取前写回文件
+        self._context_tree = None
+        self._context_tree_dirty = False
+        # 任务树节点的路径索引，见_context_tree_node
+        self._context_tree_nodes = {}
+        # error.json的内存副本，与任务树一样在agent读取前写回文件
+        self._errors = {}
+        self._errors_dirty = False
+        # task_planning中各agent的Thread，见_agent_thread
+        self._agent_threads = {}
+        # rag_flow使用的RAGFlow对话助手，见_ragflow_assistant
+        self._ragflow_chat = None
+        # 最近一次推送给RAGFlow助手的配置的摘要，配置不变时不再重复update
+        self._assistant_cfg_hash = None
+        # 并发执行step时借出的备用能力agent Thread，按能力群存放，见_borrow_cap_agent_threads
+        self._spare_cap_agent_threads = {}
+        # task_planning中并发执行step的线程池，由Agency持有并在各次请求间复用
+        self._step_pool = ThreadPoolExecutor(
+            max_workers=_MAX_PARALLEL_STEPS, thread_name_prefix="agency-step"
+        )
 
         # set thread type based send_message_tool_class async mode
         if (
@@ -152,14 +426,19 @@ class Agency:
                 "Please select async_mode = 'threading' or 'tools_threading'."
             )
 
-        if os.path.isfile(
-            os.path.join(self._get_class_folder_path(), shared_instructions)
-        ):
-            self._read_instructions(
-                os.path.join(self._get_class_folder_path(), shared_instructions)
+        # shared_instructions可以是相对于agency所在目录的文件、普通路径或直接给出的文本
+        instructions_path = None
+        if shared_instructions:
+            local_path = os.path.join(
+                self._get_class_folder_path(), shared_instructions
             )
-        elif os.path.isfile(shared_instructions):
-            self._read_instructions(shared_instructions)
+            if os.path.isfile(local_path):
+                instructions_path = local_path
+            elif os.path.isfile(shared_instructions):
+                instructions_path = shared_instructions
+
+        if instructions_path is not None:
+            self._read_instructions(instructions_path)
         else:
             self.shared_instructions = shared_instructions
 
@@ -203,7 +482,33 @@ class Agency:
         if verbose and yield_messages:
             raise Exception("Verbose mode is not compatible with yield_messages=True")
 
-        res = self.main_thread.get_completion(
+        main_thread = self.main_thread
+
+        # 只缓存不带文件、附件和tool_choice的普通请求
+        cache_key = None
+        if (
+            self.cache_completions
+            and self.response_cache is not None
+            and not yield_messages
+            and not verbose
+            and not message_files
+            and not attachments
+            and tool_choice is None
+        ):
+            agent = recipient_agent or main_thread.recipient_agent
+            cache_key = self.response_cache.make_key(
+                agent.name,
+                agent.model,
+                agent.instructions,
+                message,
+                additional_instructions,
+                response_format,
+            )
+            result = self.response_cache.get(cache_key, scope=agent.name)
+            if result is not None:
+                return result
+
+        res = main_thread.get_completion(
             message=message,
             message_files=message_files,
             attachments=attachments,
@@ -214,16 +519,24 @@ class Agency:
             response_format=response_format,
         )
 
-        if not yield_messages or verbose:
-            while True:
-                try:
-                    message = next(res)
-                    if verbose:
+        run_lock = main_thread._run_lock
+        if verbose:
+            with run_lock:
+                while True:
+                    try:
+                        message = next(res)
                         message.cprint()
-                except StopIteration as e:
-                    return e.value
+                    except StopIteration as e:
+                        return e.value
+
+        if not yield_messages:
+            with run_lock:
+                result = _drain_generator(res)
+            if cache_key is not None and result is not None:
+                self.response_cache.set(cache_key, result, scope=agent.name)
+            return result
 
-        return res
+        return _hold_lock(run_lock, res)
 
     def get_completion_stream(
         self,
@@ -255,7 +568,8 @@ class Agency:
         if not inspect.isclass(event_handler):
             raise Exception("Event handler must not be an instance.")
 
-        res = self.main_thread.get_completion_stream(
+        main_thread = self.main_thread
+        res = main_thread.get_completion_stream(
             message=message,
             message_files=message_files,
             event_handler=event_handler,
@@ -266,13 +580,11 @@ class Agency:
             response_format=response_format,
         )
 
-        while True:
-            try:
-                next(res)
-            except StopIteration as e:
-                event_handler.on_all_streams_end()
+        with main_thread._run_lock:
+            result = _drain_generator(res)
+        event_handler.on_all_streams_end()
 
-                return e.value
+        return result
 
     def get_completion_parse(
         self,
@@ -304,7 +616,7 @@ class Agency:
         response_model = None
         if isinstance(response_format, type):
             response_model = response_format
-            response_format = type_to_response_format_param(response_format)
+            response_format = _response_format_for(response_format)
 
         res = self.get_completion(
             message=message,
@@ -320,7 +632,10 @@ class Agency:
         try:
             return response_model.model_validate_json(res)
         except:
-            parsed_res = json.loads(res)
+            # 没有refusal字段时无需再解析一遍
+            if '"refusal"' not in res:
+                raise Exception("Failed to parse response: " + res)
+            parsed_res = fast_json.loads(res)
             if "refusal" in parsed_res:
                 raise RefusalError(parsed_res["refusal"])
             else:
@@ -342,17 +657,7 @@ class Agency:
         except ImportError:
             raise Exception("Please install gradio: pip install gradio")
 
-        js = """function () {
-          gradioURL = window.location.href
-          if (!gradioURL.endsWith('?__theme={theme}')) {
-            window.location.replace(gradioURL + '?__theme={theme}');
-          }
-        }"""
-
-        if dark_mode:
-            js = js.replace("{theme}", "dark")
-        else:
-            js = js.replace("{theme}", "light")
+        js = _THEME_JS_DARK if dark_mode else _THEME_JS_LIGHT
 
         attachments = []
         images = []
@@ -361,8 +666,13 @@ class Agency:
         recipient_agent_names = [agent.name for agent in self.main_recipients]
         recipient_agent = self.main_recipients[0]
 
+        concurrency_limit = 10
+        # 复用线程执行每轮对话的get_completion_stream，避免每条消息新建线程
+        completion_pool = ThreadPoolExecutor(
+            max_workers=concurrency_limit, thread_name_prefix="gradio-completion"
+        )
+
         with gr.Blocks(js=js) as demo:
-            chatbot_queue = queue.Queue()
             chatbot = gr.Chatbot(height=height)
             with gr.Row():
                 with gr.Column(scale=9):
@@ -380,6 +690,16 @@ class Agency:
                 nonlocal recipient_agent
                 recipient_agent = self._get_agent_by_name(selected_option)
 
+            def upload_file(file_obj):
+                purpose = get_file_purpose(file_obj.name)
+
+                with open(file_obj.name, "rb") as f:
+                    # Upload the file to OpenAI
+                    file = self.main_thread.client.files.create(file=f, purpose=purpose)
+
+                tools = get_tools(file.filename) if purpose != "vision" else None
+                return file, purpose, tools
+
             def handle_file_upload(file_list):
                 nonlocal attachments
                 nonlocal message_file_names
@@ -390,15 +710,13 @@ class Agency:
                 message_file_names = []
                 if file_list:
                     try:
-                        for file_obj in file_list:
-                            purpose = get_file_purpose(file_obj.name)
-
-                            with open(file_obj.name, "rb") as f:
-                                # Upload the file to OpenAI
-                                file = self.main_thread.client.files.create(
-                                    file=f, purpose=purpose
-                                )
+                        # 并发上传，再按原顺序处理结果
+                        with ThreadPoolExecutor(
+                            max_workers=min(8, len(file_list))
+                        ) as executor:
+                            uploaded = list(executor.map(upload_file, file_list))
 
+                        for file, purpose, tools in uploaded:
                             if purpose == "vision":
                                 images.append(
                                     {
@@ -410,7 +728,7 @@ class Agency:
                                 attachments.append(
                                     {
                                         "file_id": file.id,
-                                        "tools": get_tools(file.filename),
+                                        "tools": tools,
                                     }
                                 )
 
@@ -438,36 +756,36 @@ class Agency:
 
                 # Check if attachments contain file search or code interpreter types
                 def check_and_add_tools_in_attachments(attachments, recipient_agent):
-                    for attachment in attachments:
-                        for tool in attachment.get("tools", []):
-                            if tool["type"] == "file_search":
-                                if not any(
-                                    isinstance(t, FileSearch)
-                                    for t in recipient_agent.tools
-                                ):
-                                    # Add FileSearch tool if it does not exist
-                                    recipient_agent.tools.append(FileSearch)
-                                    recipient_agent.client.beta.assistants.update(
-                                        recipient_agent.id,
-                                        tools=recipient_agent.get_oai_tools(),
-                                    )
-                                    print(
-                                        "Added FileSearch tool to recipient agent to analyze the file."
-                                    )
-                            elif tool["type"] == "code_interpreter":
-                                if not any(
-                                    isinstance(t, CodeInterpreter)
-                                    for t in recipient_agent.tools
-                                ):
-                                    # Add CodeInterpreter tool if it does not exist
-                                    recipient_agent.tools.append(CodeInterpreter)
-                                    recipient_agent.client.beta.assistants.update(
-                                        recipient_agent.id,
-                                        tools=recipient_agent.get_oai_tools(),
-                                    )
-                                    print(
-                                        "Added CodeInterpreter tool to recipient agent to analyze the file."
-                                    )
+                    # 先汇总附件需要的工具，缺少的一次性加上，只调用一次assistants.update
+                    needed = {
+                        tool["type"]
+                        for attachment in attachments
+                        for tool in attachment.get("tools", [])
+                    }
+                    tool_names = _tool_class_names(recipient_agent)
+                    added = False
+                    if "file_search" in needed and "FileSearch" not in tool_names:
+                        # Add FileSearch tool if it does not exist
+                        recipient_agent.tools.append(FileSearch)
+                        added = True
+                        print(
+                            "Added FileSearch tool to recipient agent to analyze the file."
+                        )
+                    if (
+                        "code_interpreter" in needed
+                        and "CodeInterpreter" not in tool_names
+                    ):
+                        # Add CodeInterpreter tool if it does not exist
+                        recipient_agent.tools.append(CodeInterpreter)
+                        added = True
+                        print(
+                            "Added CodeInterpreter tool to recipient agent to analyze the file."
+                        )
+                    if added:
+                        recipient_agent.client.beta.assistants.update(
+                            recipient_agent.id,
+                            tools=recipient_agent.get_oai_tools(),
+                        )
                     return None
 
                 check_and_add_tools_in_attachments(attachments, recipient_agent)
@@ -491,32 +809,64 @@ class Agency:
 
                 return original_user_message, history + [[user_message, None]]
 
+            # 工具调用的标题只取决于消息类型和收发双方，按这三者缓存，
+            # 不必为了标题把整个function或其输出转成字符串
+            tool_call_headers = {}
+
+            def tool_call_header(msg_type, sender_name, receiver_name):
+                key = (msg_type, sender_name, receiver_name)
+                header = tool_call_headers.get(key)
+                if header is None:
+                    header = (
+                        MessageOutput(
+                            msg_type, sender_name, receiver_name, ""
+                        ).get_formatted_header()
+                        + "\n"
+                    )
+                    tool_call_headers[key] = header
+                return header
+
             class GradioEventHandler(AgencyEventHandler):
                 message_output = None
+                # 本轮对话的输出缓冲区，由bot()为每轮对话创建子类时指定
+                buffer: SwapBuffer = None
+
+                def __init__(self):
+                    super().__init__()
+                    # 本次stream中尚未推送的文本增量
+                    self._text_batch = []
+                    self._text_batch_len = 0
+                    self._text_batch_started = 0.0
+
+                def _flush_text(self):
+                    if self._text_batch:
+                        self.buffer.push("".join(self._text_batch))
+                        self._text_batch.clear()
+                        self._text_batch_len = 0
 
                 @classmethod
                 def change_recipient_agent(cls, recipient_agent_name):
-                    nonlocal chatbot_queue
-                    chatbot_queue.put("[change_recipient_agent]")
-                    chatbot_queue.put(recipient_agent_name)
+                    # 连续切换时只有最后一次有意义，新的覆盖未处理的旧值
+                    cls.buffer.put_control(
+                        "[change_recipient_agent]", recipient_agent_name
+                    )
 
                 @override
                 def on_message_created(self, message: Message) -> None:
+                    self._flush_text()
                     if message.role == "user":
-                        full_content = ""
+                        parts = []
                         for content in message.content:
                             if content.type == "image_file":
-                                full_content += (
+                                parts.append(
                                     f"🖼️ Image File: {content.image_file.file_id}\n"
                                 )
-                                continue
-
-                            if content.type == "image_url":
-                                full_content += f"\n{content.image_url.url}\n"
-                                continue
-
-                            if content.type == "text":
-                                full_content += content.text.value + "\n"
+                            elif content.type == "image_url":
+                                parts.append(f"\n{content.image_url.url}\n")
+                            elif content.type == "text":
+                                parts.append(content.text.value)
+                                parts.append("\n")
+                        full_content = "".join(parts)
 
                         self.message_output = MessageOutput(
                             "text",
@@ -530,62 +880,56 @@ class Agency:
                             "text", self.recipient_agent_name, self.agent_name, ""
                         )
 
-                    chatbot_queue.put("[new_message]")
-                    chatbot_queue.put(self.message_output.get_formatted_content())
+                    self.buffer.push(
+                        ("[new_message]", self.message_output.get_formatted_content())
+                    )
 
                 @override
                 def on_text_delta(self, delta, snapshot):
-                    chatbot_queue.put(delta.value)
+                    text = delta.value
+                    if not self._text_batch:
+                        self._text_batch_started = time.monotonic()
+                    self._text_batch.append(text)
+                    self._text_batch_len += len(text)
+                    if (
+                        self._text_batch_len >= _TEXT_BATCH_CHARS
+                        or time.monotonic() - self._text_batch_started
+                        >= _TEXT_BATCH_INTERVAL
+                    ):
+                        self._flush_text()
+
+                @override
+                def on_message_done(self, message: Message) -> None:
+                    self._flush_text()
+
+                @override
+                def on_end(self):
+                    self._flush_text()
 
                 @override
                 def on_tool_call_created(self, tool_call: ToolCall):
+                    self._flush_text()
                     if isinstance(tool_call, dict):
-                        if "type" not in tool_call:
-                            tool_call["type"] = "function"
-
-                        if tool_call["type"] == "function":
-                            tool_call = FunctionToolCall(**tool_call)
-                        elif tool_call["type"] == "code_interpreter":
-                            tool_call = CodeInterpreterToolCall(**tool_call)
-                        elif (
-                            tool_call["type"] == "file_search"
-                            or tool_call["type"] == "retrieval"
-                        ):
-                            tool_call = FileSearchToolCall(**tool_call)
-                        else:
-                            raise ValueError(
-                                "Invalid tool call type: " + tool_call["type"]
-                            )
+                        tool_call = _coerce_tool_call(tool_call)
 
                     # TODO: add support for code interpreter and retrieval tools
                     if tool_call.type == "function":
-                        chatbot_queue.put("[new_message]")
-                        self.message_output = MessageOutput(
-                            "function",
-                            self.recipient_agent_name,
-                            self.agent_name,
-                            str(tool_call.function),
-                        )
-                        chatbot_queue.put(
-                            self.message_output.get_formatted_header() + "\n"
+                        self.buffer.push(
+                            (
+                                "[new_message]",
+                                tool_call_header(
+                                    "function",
+                                    self.recipient_agent_name,
+                                    self.agent_name,
+                                ),
+                            )
                         )
 
                 @override
                 def on_tool_call_done(self, snapshot: ToolCall):
+                    self._flush_text()
                     if isinstance(snapshot, dict):
-                        if "type" not in snapshot:
-                            snapshot["type"] = "function"
-
-                        if snapshot["type"] == "function":
-                            snapshot = FunctionToolCall(**snapshot)
-                        elif snapshot["type"] == "code_interpreter":
-                            snapshot = CodeInterpreterToolCall(**snapshot)
-                        elif snapshot["type"] == "file_search":
-                            snapshot = FileSearchToolCall(**snapshot)
-                        else:
-                            raise ValueError(
-                                "Invalid tool call type: " + snapshot["type"]
-                            )
+                        snapshot = _coerce_tool_call(snapshot)
 
                     self.message_output = None
 
@@ -593,11 +937,12 @@ class Agency:
                     if snapshot.type != "function":
                         return
 
-                    chatbot_queue.put(str(snapshot.function))
+                    function = snapshot.function
+                    self.buffer.push(str(function))
 
-                    if snapshot.function.name == "SendMessage":
+                    if function.name == "SendMessage":
                         try:
-                            args = eval(snapshot.function.arguments)
+                            args = fast_json.loads(function.arguments)
                             recipient = args["recipient"]
                             self.message_output = MessageOutput(
                                 "text",
@@ -606,9 +951,11 @@ class Agency:
                                 args["message"],
                             )
 
-                            chatbot_queue.put("[new_message]")
-                            chatbot_queue.put(
-                                self.message_output.get_formatted_content()
+                            self.buffer.push(
+                                (
+                                    "[new_message]",
+                                    self.message_output.get_formatted_content(),
+                                )
                             )
                         except Exception as e:
                             pass
@@ -617,34 +964,47 @@ class Agency:
 
                 @override
                 def on_run_step_done(self, run_step: RunStep) -> None:
+                    self._flush_text()
                     if run_step.type == "tool_calls":
                         for tool_call in run_step.step_details.tool_calls:
                             if tool_call.type != "function":
                                 continue
 
-                            if tool_call.function.name == "SendMessage":
+                            function = tool_call.function
+                            if function.name == "SendMessage":
                                 continue
 
                             self.message_output = None
-                            chatbot_queue.put("[new_message]")
-
-                            self.message_output = MessageOutput(
-                                "function_output",
-                                tool_call.function.name,
-                                self.recipient_agent_name,
-                                tool_call.function.output,
-                            )
-
-                            chatbot_queue.put(
-                                self.message_output.get_formatted_header() + "\n"
+                            self.buffer.push(
+                                (
+                                    "[new_message]",
+                                    tool_call_header(
+                                        "function_output",
+                                        function.name,
+                                        self.recipient_agent_name,
+                                    ),
+                                )
                             )
-                            chatbot_queue.put(tool_call.function.output)
+                            self.buffer.push(function.output)
 
                 @override
                 @classmethod
                 def on_all_streams_end(cls):
                     cls.message_output = None
-                    chatbot_queue.put("[end]")
+                    cls.buffer.push(("[end]", None))
+
+            # 每个recipient对应的下拉框更新只构建一次，流式输出时直接复用
+            dropdown_updates = {}
+
+            def dropdown_update(agent_name):
+                update = dropdown_updates.get(agent_name)
+                if update is None:
+                    update = gr.update(
+                        value=agent_name,
+                        choices=set([*recipient_agent_names, agent_name]),
+                    )
+                    dropdown_updates[agent_name] = update
+                return update
 
             def bot(original_message, history, dropdown):
                 nonlocal attachments
@@ -658,10 +1018,7 @@ class Agency:
                     return (
                         "",
                         history,
-                        gr.update(
-                            value=recipient_agent.name,
-                            choices=set([*recipient_agent_names, recipient_agent.name]),
-                        ),
+                        dropdown_update(recipient_agent.name),
                     )
 
                 if uploading_files:
@@ -669,22 +1026,17 @@ class Agency:
                     yield (
                         "",
                         history,
-                        gr.update(
-                            value=recipient_agent.name,
-                            choices=set([*recipient_agent_names, recipient_agent.name]),
-                        ),
+                        dropdown_update(recipient_agent.name),
                     )
                     return (
                         "",
                         history,
-                        gr.update(
-                            value=recipient_agent.name,
-                            choices=set([*recipient_agent_names, recipient_agent.name]),
-                        ),
+                        dropdown_update(recipient_agent.name),
                     )
 
-                print("Message files: ", attachments)
-                print("Images: ", images)
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Message files: %r", attachments)
+                    log.debug("Images: %r", images)
 
                 if images and len(images) > 0:
                     original_message = [
@@ -695,19 +1047,28 @@ class Agency:
                         *images,
                     ]
 
-                completion_thread = threading.Thread(
-                    target=self.get_completion_stream,
-                    args=(
-                        original_message,
-                        GradioEventHandler,
-                        [],
-                        recipient_agent,
-                        "",
-                        attachments,
-                        None,
-                    ),
+                # 每轮对话使用自己的缓冲区：多个会话同时进行时，各自的bot()只读取本轮的输出
+                chatbot_buffer = SwapBuffer()
+                event_handler = type(
+                    "GradioEventHandler", (GradioEventHandler,), {"buffer": chatbot_buffer}
                 )
-                completion_thread.start()
+                completion = completion_pool.submit(
+                    self.get_completion_stream,
+                    original_message,
+                    event_handler,
+                    [],
+                    recipient_agent,
+                    "",
+                    attachments,
+                    None,
+                )
+
+                def end_on_error(future):
+                    # 出错时不会触发on_all_streams_end，补发[end]，由下面的result()抛出异常
+                    if future.exception() is not None:
+                        chatbot_buffer.push(("[end]", None))
+
+                completion.add_done_callback(end_on_error)
 
                 attachments = []
                 message_file_names = []
@@ -715,51 +1076,54 @@ class Agency:
                 uploading_files = False
 
                 new_message = True
-                while True:
-                    try:
-                        bot_message = chatbot_queue.get(block=True)
+                stream_ended = False
+                pending_text = []
 
-                        if bot_message == "[end]":
-                            completion_thread.join()
+                def flush_pending_text():
+                    # 连续的文本增量拼接后一次写入history
+                    nonlocal new_message
+                    if not pending_text:
+                        return
+                    text = "".join(pending_text)
+                    pending_text.clear()
+                    if new_message:
+                        history.append([None, text])
+                        new_message = False
+                    else:
+                        history[-1][1] += text
+
+                while not stream_ended:
+                    # 一次取走所有已到达的消息，每批只刷新一次界面
+                    # 文本增量为str，控制消息为(标记, 内容)元组
+                    for bot_message in chatbot_buffer.drain():
+                        if type(bot_message) is not tuple:
+                            pending_text.append(bot_message)
+                            continue
+
+                        flush_pending_text()
+                        kind, payload = bot_message
+                        if kind == "[end]":
+                            stream_ended = True
                             break
 
-                        if bot_message == "[new_message]":
-                            new_message = True
-                            continue
+                        # [new_message]: 以payload开启新的一条消息
+                        history.append([None, payload])
+                        new_message = False
 
-                        if bot_message == "[change_recipient_agent]":
-                            new_agent_name = chatbot_queue.get(block=True)
-                            recipient_agent = self._get_agent_by_name(new_agent_name)
-                            yield (
-                                "",
-                                history,
-                                gr.update(
-                                    value=new_agent_name,
-                                    choices=set(
-                                        [*recipient_agent_names, recipient_agent.name]
-                                    ),
-                                ),
-                            )
-                            continue
+                    flush_pending_text()
 
-                        if new_message:
-                            history.append([None, bot_message])
-                            new_message = False
-                        else:
-                            history[-1][1] += bot_message
-
-                        yield (
-                            "",
-                            history,
-                            gr.update(
-                                value=recipient_agent.name,
-                                choices=set(
-                                    [*recipient_agent_names, recipient_agent.name]
-                                ),
-                            ),
-                        )
-                    except queue.Empty:
-                        break
+                    # 控制消息在[end]之前写入，这里总能取到最后一次切换
+                    control = chatbot_buffer.take_control()
+                    if control is not None:
+                        recipient_agent = self._get_agent_by_name(control[1])
+
+                    yield (
+                        "",
+                        history,
+                        dropdown_update(recipient_agent.name),
+                    )
+
+                completion.result()
 
             button.click(user, inputs=[msg, chatbot], outputs=[msg, chatbot]).then(
                 bot, [msg, chatbot, dropdown], [msg, chatbot, dropdown]
@@ -771,7 +1135,7 @@ class Agency:
             )
 
             # Enable queuing for streaming intermediate outputs
-            demo.queue(default_concurrency_limit=10)
+            demo.queue(default_concurrency_limit=concurrency_limit)
 
         # Launch the demo
         demo.launch(**kwargs)
@@ -781,13 +1145,12 @@ class Agency:
         """
         Autocomplete completer for recipient agent names.
         """
-        options = [
-            agent
-            for agent in self.recipient_agents
-            if agent.lower().startswith(text.lower())
-        ]
-        if state < len(options):
-            return options[state]
+        # readline对同一个text依次以state=0,1,2...调用，用二分查找定位前缀区间
+        keys = self._recipient_agent_keys
+        prefix = text.lower()
+        index = bisect.bisect_left(keys, prefix) + state
+        if index < len(keys) and keys[index].startswith(prefix):
+            return self._recipient_agent_names[index]
         else:
             return None
 
@@ -851,20 +1214,7 @@ class Agency:
             @override
             def on_tool_call_created(self, tool_call):
                 if isinstance(tool_call, dict):
-                    if "type" not in tool_call:
-                        tool_call["type"] = "function"
-
-                    if tool_call["type"] == "function":
-                        tool_call = FunctionToolCall(**tool_call)
-                    elif tool_call["type"] == "code_interpreter":
-                        tool_call = CodeInterpreterToolCall(**tool_call)
-                    elif (
-                        tool_call["type"] == "file_search"
-                        or tool_call["type"] == "retrieval"
-                    ):
-                        tool_call = FileSearchToolCall(**tool_call)
-                    else:
-                        raise ValueError("Invalid tool call type: " + tool_call["type"])
+                    tool_call = _coerce_tool_call(tool_call)
 
                 # TODO: add support for code interpreter and retirieval tools
 
@@ -879,17 +1229,7 @@ class Agency:
             @override
             def on_tool_call_delta(self, delta, snapshot):
                 if isinstance(snapshot, dict):
-                    if "type" not in snapshot:
-                        snapshot["type"] = "function"
-
-                    if snapshot["type"] == "function":
-                        snapshot = FunctionToolCall(**snapshot)
-                    elif snapshot["type"] == "code_interpreter":
-                        snapshot = CodeInterpreterToolCall(**snapshot)
-                    elif snapshot["type"] == "file_search":
-                        snapshot = FileSearchToolCall(**snapshot)
-                    else:
-                        raise ValueError("Invalid tool call type: " + snapshot["type"])
+                    snapshot = _coerce_tool_call(snapshot)
 
                 self.message_output.cprint_update(str(snapshot.function))
 
@@ -901,15 +1241,10 @@ class Agency:
                 if snapshot.type != "function":
                     return
 
-                if snapshot.function.name == "SendMessage" and not (
-                    hasattr(
-                        outer_self.send_message_tool_class.ToolConfig,
-                        "output_as_result",
-                    )
-                    and outer_self.send_message_tool_class.ToolConfig.output_as_result
-                ):
+                function = snapshot.function
+                if function.name == "SendMessage" and not outer_self._output_as_result:
                     try:
-                        args = eval(snapshot.function.arguments)
+                        args = fast_json.loads(function.arguments)
                         recipient = args["recipient"]
                         self.message_output = MessageOutputLive(
                             "text", self.recipient_agent_name, recipient, ""
@@ -928,17 +1263,18 @@ class Agency:
                         if tool_call.type != "function":
                             continue
 
-                        if tool_call.function.name == "SendMessage":
+                        function = tool_call.function
+                        if function.name == "SendMessage":
                             continue
 
                         self.message_output = None
                         self.message_output = MessageOutputLive(
                             "function_output",
-                            tool_call.function.name,
+                            function.name,
                             self.recipient_agent_name,
-                            tool_call.function.output,
+                            function.output,
                         )
-                        self.message_output.cprint_update(tool_call.function.output)
+                        self.message_output.cprint_update(function.output)
 
                     self.message_output = None
 
@@ -947,6 +1283,10 @@ class Agency:
                 self.message_output = None
 
         self.recipient_agents = [str(agent.name) for agent in self.main_recipients]
+        # 补全用的小写名称有序表，与原名称一一对应
+        completions = sorted((agent.lower(), agent) for agent in self.recipient_agents)
+        self._recipient_agent_keys = [key for key, _ in completions]
+        self._recipient_agent_names = [agent for _, agent in completions]
 
         self._setup_autocomplete()  # Prepare readline for autocomplete
 
@@ -1003,52 +1343,67 @@ class Agency:
 
         There are no output parameters as this method is used for internal initialization purposes within the Agency class.
         """
-        if self.settings_callbacks:
+
+        def restore_settings():
             loaded_settings = self.settings_callbacks["load"]()
             with open(self.settings_path, "w") as f:
                 json.dump(loaded_settings, f, indent=4)
 
-        for agent in self.agents:
-            assert isinstance(agent, Agent)
-            print(f"Initializing agent... {agent.name}")
-            if "temp_id" in agent.id:
-                agent.id = None
-
-            agent.agency = self
-            agent.add_shared_instructions(self.shared_instructions)
-            agent.settings_path = self.settings_path
-
-            if self.shared_files:
-                if isinstance(self.shared_files, str):
-                    self.shared_files = [self.shared_files]
-
-                if isinstance(agent.files_folder, str):
-                    agent.files_folder = [agent.files_folder]
-                    agent.files_folder += self.shared_files
-                elif isinstance(agent.files_folder, list):
-                    agent.files_folder += self.shared_files
-
-            if self.temperature is not None and agent.temperature is None:
-                agent.temperature = self.temperature
-            if self.top_p and agent.top_p is None:
-                agent.top_p = self.top_p
-            if self.max_prompt_tokens is not None and agent.max_prompt_tokens is None:
-                agent.max_prompt_tokens = self.max_prompt_tokens
-            if (
-                self.max_completion_tokens is not None
-                and agent.max_completion_tokens is None
-            ):
-                agent.max_completion_tokens = self.max_completion_tokens
-            if (
-                self.truncation_strategy is not None
-                and agent.truncation_strategy is None
-            ):
-                agent.truncation_strategy = self.truncation_strategy
-
-            if not agent.shared_state:
-                agent.shared_state = self.shared_state
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(32, len(self.agents)))
+        ) as executor:
+            # 从回调恢复settings.json的读写与下面设置agent属性的循环重叠执行
+            settings_restored = (
+                executor.submit(restore_settings) if self.settings_callbacks else None
+            )
 
-            agent.init_oai()
+            # agency级别的默认参数，只覆盖agent上未设置（None）的值
+            defaults = {
+                name: value
+                for name, value in (
+                    ("temperature", self.temperature),
+                    ("top_p", self.top_p or None),
+                    ("max_prompt_tokens", self.max_prompt_tokens),
+                    ("max_completion_tokens", self.max_completion_tokens),
+                    ("truncation_strategy", self.truncation_strategy),
+                )
+                if value is not None
+            }
+            if isinstance(self.shared_files, str):
+                self.shared_files = [self.shared_files]
+
+            for agent in self.agents:
+                assert isinstance(agent, Agent)
+                log.debug("Initializing agent... %s", agent.name)
+                if "temp_id" in agent.id:
+                    agent.id = None
+
+                agent.agency = self
+                agent.add_shared_instructions(self.shared_instructions)
+                agent.settings_path = self.settings_path
+
+                if self.shared_files:
+                    if isinstance(agent.files_folder, str):
+                        agent.files_folder = [agent.files_folder]
+                        agent.files_folder += self.shared_files
+                    elif isinstance(agent.files_folder, list):
+                        agent.files_folder += self.shared_files
+
+                for name, value in defaults.items():
+                    if getattr(agent, name) is None:
+                        setattr(agent, name, value)
+
+                if not agent.shared_state:
+                    agent.shared_state = self.shared_state
+
+            # init_oai会读取settings.json，必须等恢复完成
+            if settings_restored is not None:
+                settings_restored.result()
+
+            # init_oai主要是对OpenAI的网络请求，各agent之间互不依赖，并发执行
+            # 遍历结果，使任一agent初始化失败时在这里抛出异常
+            for _ in executor.map(lambda agent: agent.init_oai(), self.agents):
+                pass
 
         if self.settings_callbacks:
             with open(self.agents[0].get_settings_path(), "r") as f:
@@ -1068,6 +1423,8 @@ class Agency:
             This method does not return any value but updates the agents_and_threads attribute with initialized Thread objects.
         """
         self.main_thread = Thread(self.user, self.ceo)
+        # 需要新建OpenAI thread的对象，最后并发执行init_thread
+        pending_threads = []
 
         # load thread ids
         loaded_thread_ids = {}
@@ -1076,7 +1433,7 @@ class Agency:
             if "main_thread" in loaded_thread_ids and loaded_thread_ids["main_thread"]:
                 self.main_thread.id = loaded_thread_ids["main_thread"]
             else:
-                self.main_thread.init_thread()
+                pending_threads.append(self.main_thread)
 
         # Save main_thread into agents_and_threads
         self.agents_and_threads["main_thread"] = self.main_thread
@@ -1102,7 +1459,16 @@ class Agency:
                     ].id = loaded_thread_ids[agent_name][other_agent]
                 # init threads if threre are threads callbacks so the ids are saved for later use
                 elif self.threads_callbacks:
-                    self.agents_and_threads[agent_name][other_agent].init_thread()
+                    pending_threads.append(self.agents_and_threads[agent_name][other_agent])
+
+        if pending_threads:
+            with ThreadPoolExecutor(
+                max_workers=min(32, len(pending_threads))
+            ) as executor:
+                for _ in executor.map(
+                    lambda thread: thread.init_thread(), pending_threads
+                ):
+                    pass
 
         # save thread ids
         if self.threads_callbacks:
@@ -1146,31 +1512,23 @@ class Agency:
                 self._add_main_recipient(node)
 
             elif isinstance(node, list):
-                for i, agent in enumerate(node):
-                    print(f"checking {agent.name}...")
+                for agent in node:
+                    log.debug("checking %s...", agent.name)
                     if not isinstance(agent, Agent):
                         raise Exception("Invalid agency chart.")
 
-                    index = self._add_agent(agent)
+                    self._add_agent(agent)
 
-                    if i == len(node) - 1:
+                # 相邻两个agent构成一条通信边：前者可以向后者发送消息
+                for agent, other_agent in zip(node, node[1:]):
+                    recipients = self.agents_and_threads.setdefault(agent.name, {})
+                    if other_agent.name == agent.name:
                         continue
-
-                    if agent.name not in self.agents_and_threads.keys():
-                        self.agents_and_threads[agent.name] = {}
-
-                    if i < len(node) - 1:
-                        other_agent = node[i + 1]
-                        if other_agent.name == agent.name:
-                            continue
-                        if (
-                            other_agent.name
-                            not in self.agents_and_threads[agent.name].keys()
-                        ):
-                            self.agents_and_threads[agent.name][other_agent.name] = {
-                                "agent": agent.name,
-                                "recipient_agent": other_agent.name,
-                            }
+                    if other_agent.name not in recipients:
+                        recipients[other_agent.name] = {
+                            "agent": agent.name,
+                            "recipient_agent": other_agent.name,
+                        }
             else:
                 raise Exception("Invalid agency chart.")
 
@@ -1189,13 +1547,16 @@ class Agency:
         if not agent.id:
             # assign temp id
             agent.id = "temp_id_" + str(uuid.uuid4())
-        if agent.id not in self._get_agent_ids():
-            if agent.name in self._get_agent_names():
-                raise Exception("Agent names must be unique.")
-            self.agents.append(agent)
-            return len(self.agents) - 1
-        else:
-            return self._get_agent_ids().index(agent.id)
+        index = self._agent_indices_by_id.get(agent.id)
+        if index is not None:
+            return index
+        if agent.name in self._agents_by_name:
+            raise Exception("Agent names must be unique.")
+        self.agents.append(agent)
+        index = len(self.agents) - 1
+        self._agents_by_name[agent.name] = agent
+        self._agent_indices_by_id[agent.id] = index
+        return index
 
     def _add_main_recipient(self, agent):
         """
@@ -1206,10 +1567,9 @@ class Agency:
 
         This method adds an agent to the agency's list of main recipients. These are agents that can be directly contacted by the user.
         """
-        main_recipient_ids = [agent.id for agent in self.main_recipients]
-
-        if agent.id not in main_recipient_ids:
+        if agent.id not in self._main_recipient_ids:
             self.main_recipients.append(agent)
+            self._main_recipient_ids.add(agent.id)
 
     def _read_instructions(self, path):
         """
@@ -1220,9 +1580,12 @@ class Agency:
 
         This method opens the file located at the given path, reads its contents, and stores these contents in the 'shared_instructions' attribute of the agency. This is used to provide common guidelines or instructions to all agents within the agency.
         """
-        path = path
-        with open(path, "r") as f:
-            self.shared_instructions = f.read()
+        # 一次读入字节再整体解码，跳过文本模式逐块的换行转换
+        with open(path, "rb") as f:
+            data = f.read()
+        if b"\r" in data:
+            data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        self.shared_instructions = data.decode("utf-8")
 
     def _create_special_tools(self):
         """
@@ -1259,6 +1622,7 @@ class Agency:
             SendMessage: A SendMessage tool class that is dynamically created and configured for the given agent and its recipient agents. This tool allows the agent to send messages to the specified recipients, facilitating inter-agent communication within the agency.
         """
         recipient_names = [agent.name for agent in recipient_agents]
+        recipient_name_set = frozenset(recipient_names)
         recipients = Enum("recipient", {name: name for name in recipient_names})
 
         agent_descriptions = ""
@@ -1274,7 +1638,7 @@ class Agency:
             @field_validator("recipient")
             @classmethod
             def check_recipient(cls, value):
-                if value.value not in recipient_names:
+                if value.value not in recipient_name_set:
                     raise ValueError(
                         f"Recipient {value} is not valid. Valid recipients are: {recipient_names}"
                     )
@@ -1290,6 +1654,7 @@ class Agency:
         Creates a CheckStatus tool to enable an agent to check the status of a task with a specified recipient agent.
         """
         recipient_names = [agent.name for agent in recipient_agents]
+        recipient_name_set = frozenset(recipient_names)
         recipients = Enum("recipient", {name: name for name in recipient_names})
 
         outer_self = self
@@ -1304,7 +1669,7 @@ class Agency:
 
             @field_validator("recipient")
             def check_recipient(cls, value):
-                if value.value not in recipient_names:
+                if value.value not in recipient_name_set:
                     raise ValueError(
                         f"Recipient {value} is not valid. Valid recipients are: {recipient_names}"
                     )
@@ -1334,10 +1699,10 @@ class Agency:
         Raises:
             Exception: If no agent with the given name is found in the agency.
         """
-        for agent in self.agents:
-            if agent.name == agent_name:
-                return agent
-        raise Exception(f"Agent {agent_name} not found.")
+        try:
+            return self._agents_by_name[agent_name]
+        except KeyError:
+            raise Exception(f"Agent {agent_name} not found.")
 
     def _get_agents_by_names(self, agent_names):
         """
@@ -1367,7 +1732,7 @@ class Agency:
         Returns:
             List[str]: A list of names of all agents currently part of the agency.
         """
-        return [agent.name for agent in self.agents]
+        return list(self._agents_by_name)
 
     def _get_class_folder_path(self):
         """
@@ -1384,8 +1749,22 @@ class Agency:
         """
         for agent in self.agents:
             agent.delete()
+        self.shutdown()
+
+    def shutdown(self):
+        """
+        停止task_planning使用的线程池：尚未开始的step被取消，正在执行的等待其结束。
+        入口脚本在关闭日志之前调用，被中断或收到SIGTERM时后台线程不会在日志关闭后继续运行
+        """
+        self._step_pool.shutdown(wait=True, cancel_futures=True)
 
     def _init_file(self, file_path):
+        try:
+            # 文件已存在且为空时无需再截断
+            if os.stat(file_path).st_size == 0:
+                return
+        except OSError:
+            pass
         try:
             with open(file_path, "w", encoding="utf-8") as f:
                 pass
@@ -1395,15 +1774,20 @@ class Agency:
     def _init_dir(self, dir_path):
         import shutil
 
-        try:
-            shutil.rmtree(dir_path)
-        except:
-            pass
-        os.mkdir(dir_path)
+        os.makedirs(dir_path, exist_ok=True)
+        # 只清空目录内容，不删除再重建目录本身
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
 
     def _rm_file(self, file_path):
-        if os.path.exists(file_path):
+        try:
             os.remove(file_path)
+        except FileNotFoundError:
+            pass
 
     files_path = os.path.join("agents", "files")
     # 未使用的文件路径
@@ -1417,11 +1801,15 @@ class Agency:
     error_path = os.path.join(files_path, "error.json")
     text_path = os.path.join(files_path, "text.txt")
     CONTEXT_TREE_PATH = os.path.join(files_path, "context_tree.json")
+    # 串行化对上面json文件的读-改-写，并发执行step时不会互相覆盖
+    _files_lock = threading.RLock()
     contexts_path = os.path.join(files_path, "api_results")
 
     def init_files(self):
         # self._init_dir(self.files_path)
         # self._init_dir(self.contexts_path)
+        self._errors.clear()
+        self._errors_dirty = False
         self._init_file(self.error_path)
         # self._init_file(self.completed_step_path)
         # self._init_file(self.completed_subtask_path)
@@ -1434,6 +1822,18 @@ class Agency:
         self._rm_file(self.context_index_path)
         self._rm_file(self.context_path)
 
+    def _agent_thread(self, agent: Agent, cap_group: str = None) -> Thread:
+        """
+        返回用户与agent的Thread，按(能力群, agent名称)缓存，多次请求复用同一个对象。
+        Thread每次get_completion都会新建会话，复用不会带入上一次请求的上下文
+        """
+        key = (cap_group, agent.name)
+        thread = self._agent_threads.get(key)
+        if thread is None or thread.recipient_agent is not agent:
+            thread = Thread(self.user, agent)
+            self._agent_threads[key] = thread
+        return thread
+
     def create_cap_group_agent_threads(
         self, cap_group_agents: Dict[str, List]
     ) -> Dict[str, List[Thread]]:
@@ -1441,17 +1841,55 @@ class Agency:
         for key in cap_group_agents.keys():
             capgroup_thread[key] = []
             for agent in cap_group_agents[key]:
-                capgroup_thread[key].append(Thread(self.user, agent))
+                capgroup_thread[key].append(self._agent_thread(agent, key))
         return capgroup_thread
 
     def create_cap_agent_thread(
-        self, cap_group: str, cap_agents: Dict[str, List]
+        self, cap_group: str, cap_agents: Dict[str, List], shared: bool = True
     ) -> Dict[str, Thread]:
+        """
+        shared为False时总是新建Thread，供需要与缓存的Thread同时运行的调用方使用
+        """
         cap_agent_thread = {}
         for agent in cap_agents[cap_group]:
-            cap_agent_thread[agent.name] = Thread(self.user, agent)
+            cap_agent_thread[agent.name] = (
+                self._agent_thread(agent, cap_group)
+                if shared
+                else Thread(self.user, agent)
+            )
         return cap_agent_thread
 
+    def _borrow_cap_agent_threads(
+        self, cap_group: str, cap_agents: Dict[str, List]
+    ) -> Dict[str, Dict[str, Thread]]:
+        """
+        取一组备用的能力agent Thread（格式同cap_agent_threads，只含该能力群），
+        供与共享Thread并发执行的step使用，没有空闲的才新建。用完后需调用_return_cap_agent_threads
+        """
+        spare = self._spare_cap_agent_threads.setdefault(cap_group, [])
+        agents = cap_agents[cap_group]
+        while True:
+            try:
+                threads = spare.pop()
+            except IndexError:
+                break
+            group_threads = threads[cap_group]
+            # 能力群的agent有变化时丢弃旧的Thread
+            if len(group_threads) == len(agents) and all(
+                getattr(group_threads.get(agent.name), "recipient_agent", None) is agent
+                for agent in agents
+            ):
+                return threads
+        return {
+            cap_group: self.create_cap_agent_thread(
+                cap_group=cap_group, cap_agents=cap_agents, shared=False
+            )
+        }
+
+    def _return_cap_agent_threads(self, cap_group: str, threads_list: List[dict]):
+        """归还_borrow_cap_agent_threads借出的Thread"""
+        self._spare_cap_agent_threads.setdefault(cap_group, []).extend(threads_list)
+
     def test_single_cap_agent(
         self,
         step: dict,
@@ -1507,12 +1945,22 @@ class Agency:
         # 初始化任务树
         self.init_context_tree(request_id=request_id, content=original_request)
 
-        # 判断是否启用“代码级调度”模式（通过环境变量 DEBUG_CODE_SCHEDULING 控制）
-        code_scheduling = os.getenv("DEBUG_CODE_SCHEDULING")
-        if code_scheduling is None or code_scheduling.lower() != "true":
-            code_scheduling = False
-        else:
-            code_scheduling = True
+        # 是否启用“代码级调度”模式
+        code_scheduling = CODE_SCHEDULING
+
+        # 同一批可调度的step是否并发执行
+        parallel_steps = PARALLEL_STEPS
+
+        # 循环内频繁调用的方法先绑定为局部变量，省去每次迭代的属性查找
+        cached_planning_layer = self.cached_planning_layer
+        scheduling_layer = self.scheduling_layer
+        code_scheduling_layer = self.code_scheduling_layer
+        capability_agents_processor = self.capability_agents_processor
+        add_context_tree_nodes = self.add_context_tree_nodes
+        update_context_tree = self.update_context_tree
+        clear_context_tree_node = self.clear_context_tree_node
+        save_plan = self.save_plan
+        discard_plan = self.discard_plan
 
         # 取出各类规划/检查/调度的智能体（Agent）
         task_planner = plan_agents["task_planner"]
@@ -1521,18 +1969,18 @@ class Agency:
         subtask_inspector = plan_agents["subtask_inspector"]
         step_inspector = plan_agents["step_inspector"]
         # 创建用户与各智能体的对话线程（Thread）
-        task_planner_thread = Thread(self.user, task_planner)
-        task_inspector_thread = Thread(self.user, task_inspector)
-        subtask_planner_thread = Thread(self.user, subtask_planner)
-        subtask_inspector_thread = Thread(self.user, subtask_inspector)
-        step_inspector_thread = Thread(self.user, step_inspector)
+        task_planner_thread = self._agent_thread(task_planner)
+        task_inspector_thread = self._agent_thread(task_inspector)
+        subtask_planner_thread = self._agent_thread(subtask_planner)
+        subtask_inspector_thread = self._agent_thread(subtask_inspector)
+        step_inspector_thread = self._agent_thread(step_inspector)
 
         # 如果未开启代码级调度，还需要分别为task和subtask调度器创建线程
         if not code_scheduling:
             task_scheduler = plan_agents["task_scheduler"]
             subtask_scheduler = plan_agents["subtask_scheduler"]
-            task_scheduler_thread = Thread(self.user, task_scheduler)
-            subtask_scheduler_thread = Thread(self.user, subtask_scheduler)
+            task_scheduler_thread = self._agent_thread(task_scheduler)
+            subtask_scheduler_thread = self._agent_thread(subtask_scheduler)
 
         # 为每个能力群的智能体批量创建线程
         cap_group_thread = self.create_cap_group_agent_threads(
@@ -1550,14 +1998,15 @@ class Agency:
 
         original_request_error_flag = False
         original_request_error_message = ""
-        error_id = 0
+        # 并发执行step时也能安全地分配error_id
+        error_ids = itertools.count(1)
 
         # 主循环：规划用户原始请求，拆解为task流程图
         while True:
             # task_id = task_id + 1
 
             # 1. 任务规划层，生成task级流程图和调度所需信息
-            task_graph, tasks_need_scheduled, _ = self.planning_layer(
+            task_graph, tasks_need_scheduled, _, task_plan_key = cached_planning_layer(
                 message=original_request,
                 original_request=original_request,
                 planner_thread=task_planner_thread,
@@ -1569,39 +2018,35 @@ class Agency:
 
             # 重置错误标志，清理错误文件
             original_request_error_flag = False
-            self._init_file(self.error_path)
+            self.clear_errors()
 
             # id2task 用于记录task_id到task对象的映射
-            id2task = {}
-            task_graph_json = json.loads(task_graph)
-            for key in task_graph_json.keys():
-                task = task_graph_json[key]
-                id2task[task["id"]] = task
-                self.update_context_tree(
-                    request_id=request_id,
-                    task_id=task["id"],
-                    status="pending",
-                    title=task["title"],
-                    description=task["description"],
-                )
+            task_graph_json, id2task = self._index_graph(task_graph)
+            add_context_tree_nodes(
+                request_id=request_id,
+                nodes=id2task.values(),
+            )
             completed_task_ids = []
+            completed_task_labels = []
+            # 代码级调度时按依赖关系增量计算可执行的task
+            task_deps = _DependencyTracker(task_graph_json) if code_scheduling else None
 
             # 任务调度循环
             while True:
                 # 2. 任务调度层，确定当前可执行的task列表
                 if code_scheduling:
-                    next_task_list = self.code_scheduling_layer(
+                    next_task_list = code_scheduling_layer(
                         overall_id="original request",
                         graph=task_graph_json,
                         completed_ids=completed_task_ids,
+                        tracker=task_deps,
                     )
                 else:
-                    tasks_scheduled = self.scheduling_layer(
+                    tasks_scheduled = scheduling_layer(
                         scheduler_thread=task_scheduler_thread,
                         message=tasks_need_scheduled,
                     )
-                    tasks_scheduled_json = json.loads(tasks_scheduled)
-                    next_task_list = tasks_scheduled_json["next_tasks"]
+                    next_task_list = _scheduled_ids(tasks_scheduled, "next_tasks")
 
                 # 没有可执行task则说明全部完成，退出循环
                 if not next_task_list:
@@ -1615,14 +2060,16 @@ class Agency:
 
                     next_task = id2task[next_task_id]
 
-                    # 传递给subtask规划的信息
-                    subtask_input = {
-                        "title": next_task['title'],
-                        "description": next_task['description'],
-                    }
+                    # 传递给subtask规划的信息，task内重新规划时不变，只序列化一次
+                    subtask_input = fast_json.dumps(
+                        {
+                            "title": next_task['title'],
+                            "description": next_task['description'],
+                        }
+                    )
                         # "total_task_graph": task_graph_json,
                     
-                    self.update_context_tree(
+                    update_context_tree(
                         request_id = request_id,
                         task_id = next_task_id,
                         status = "executing",
@@ -1631,16 +2078,21 @@ class Agency:
                     )
 
                     console.rule()
+                    # 进度信息整块一次输出
                     print(
-                        f"completed tasks: {(', '.join([str(id)+' ('+task_graph_json[id]['title']+')' for id in completed_task_ids])) if completed_task_ids else 'none'}"
+                        "\n".join(
+                            (
+                                f"completed tasks: {', '.join(completed_task_labels) if completed_task_labels else 'none'}",
+                                f"next task -> {next_task_id} ({next_task['title']})",
+                            )
+                        )
                     )
-                    print(f"next task -> {next_task_id} ({next_task['title']})")
 
                     # task内循环：不断尝试把task拆分为subtask（能力群相关）
                     while True:
                         # 3. 子任务规划层，生成subtask级流程图和调度所需信息
-                        subtask_graph, subtasks_need_scheduled, _ = self.planning_layer(
-                            message=json.dumps(subtask_input, ensure_ascii=False),
+                        subtask_graph, subtasks_need_scheduled, _, subtask_plan_key = cached_planning_layer(
+                            message=subtask_input,
                             original_request=next_task["description"],
                             planner_thread=subtask_planner_thread,
                             error_message=task_error_message,
@@ -1650,39 +2102,36 @@ class Agency:
                         )
                         task_error_flag = False
 
-                        id2subtask = {}
-                        subtask_graph_json = json.loads(subtask_graph)
-                        for key in subtask_graph_json.keys():
-                            subtask = subtask_graph_json[key]
-                            id2subtask[subtask["id"]] = subtask
-                            self.update_context_tree(
-                                request_id=request_id,
-                                task_id=next_task_id,
-                                subtask_id=subtask["id"],
-                                status="pending",
-                                title=subtask["title"],
-                                description=subtask["description"],
-                            )
+                        subtask_graph_json, id2subtask = self._index_graph(subtask_graph)
+                        add_context_tree_nodes(
+                            request_id=request_id,
+                            task_id=next_task_id,
+                            nodes=id2subtask.values(),
+                        )
                         completed_subtask_ids = []
+                        completed_subtask_labels = []
+                        subtask_deps = (
+                            _DependencyTracker(subtask_graph_json) if code_scheduling else None
+                        )
 
                         # 子任务调度循环
                         while True:
                             # 4. 子任务调度层，确定可执行的subtask列表
                             if code_scheduling:
-                                next_subtask_list = self.code_scheduling_layer(
+                                next_subtask_list = code_scheduling_layer(
                                     overall_id=next_task_id,
                                     graph=subtask_graph_json,
                                     completed_ids=completed_subtask_ids,
+                                    tracker=subtask_deps,
                                 )
                             else:
-                                subtasks_scheduled = self.scheduling_layer(
+                                subtasks_scheduled = scheduling_layer(
                                     scheduler_thread=subtask_scheduler_thread,
                                     message=subtasks_need_scheduled,
                                 )
-                                subtasks_scheduled_json = json.loads(subtasks_scheduled)
-                                next_subtask_list = subtasks_scheduled_json[
-                                    "next_subtasks"
-                                ]
+                                next_subtask_list = _scheduled_ids(
+                                    subtasks_scheduled, "next_subtasks"
+                                )
 
                             if (
                                 not next_subtask_list
@@ -1695,13 +2144,16 @@ class Agency:
                                 subtask_error_message = ""
 
                                 next_subtask = id2subtask[next_subtask_id]
-                                steps_input = {
-                                    "title": next_subtask['title'],
-                                    "description": next_subtask['description'],
-                                }
+                                # subtask内重新规划时不变，只序列化一次
+                                steps_input = fast_json.dumps(
+                                    {
+                                        "title": next_subtask['title'],
+                                        "description": next_subtask['description'],
+                                    }
+                                )
                                     # "total_subtask_graph": subtask_graph_json,
                                 
-                                self.update_context_tree (
+                                update_context_tree(
                                     request_id = request_id,
                                     task_id = next_task_id,
                                     subtask_id = next_subtask_id,
@@ -1711,35 +2163,34 @@ class Agency:
                                 )
 
                                 console.rule()
+                                # 进度信息整块一次输出
                                 print(
-                                    f"completed tasks: {(', '.join([str(id)+' ('+task_graph_json[id]['title']+')' for id in completed_task_ids])) if completed_task_ids else 'none'}"
-                                )
-                                print(
-                                    f"this task -> {next_task_id} ({next_task['title']})"
-                                )
-                                print(
-                                    f"├ completed subtasks: {(', '.join([str(id)+' ('+subtask_graph_json[id]['title']+')' for id in completed_subtask_ids])) if completed_subtask_ids else 'none'}"
-                                )
-                                print(
-                                    f"└ next subtask -> {next_subtask_id} ({next_subtask['title']})"
+                                    "\n".join(
+                                        (
+                                            f"completed tasks: {', '.join(completed_task_labels) if completed_task_labels else 'none'}",
+                                            f"this task -> {next_task_id} ({next_task['title']})",
+                                            f"├ completed subtasks: {', '.join(completed_subtask_labels) if completed_subtask_labels else 'none'}",
+                                            f"└ next subtask -> {next_subtask_id} ({next_subtask['title']})",
+                                        )
+                                    )
                                 )
                                 next_subtask_cap_group = next_subtask[
                                     "capability_group"
                                 ]
+                                # 该能力群的planner和scheduler线程，在subtask内的重新规划和调度中复用
+                                step_planner_thread, step_scheduler_thread = (
+                                    cap_group_thread[next_subtask_cap_group][:2]
+                                )
 
                                 while True:
                                     # 5. 步骤规划层，生成step级流程图和调度所需信息
-                                    steps_graph, steps_need_scheduled, _ = (
-                                        self.planning_layer(
-                                            message=json.dumps(
-                                                steps_input, ensure_ascii=False
-                                            ),
+                                    steps_graph, steps_need_scheduled, _, steps_plan_key = (
+                                        cached_planning_layer(
+                                            message=steps_input,
                                             original_request=next_subtask[
                                                 "description"
                                             ],
-                                            planner_thread=cap_group_thread[
-                                                next_subtask_cap_group
-                                            ][0],
+                                            planner_thread=step_planner_thread,
                                             error_message=subtask_error_message,
                                             inspector_thread=step_inspector_thread,
                                             node_color="white",
@@ -1748,163 +2199,258 @@ class Agency:
                                     )
                                     subtask_error_flag = False
                                     # id2step 用于记录step_id到step对象的映射
-                                    id2step = {}
-                                    steps_graph_json = json.loads(steps_graph)
-                                    for key in steps_graph_json.keys():
-                                        step = steps_graph_json[key]
-                                        id2step[step["id"]] = step
-                                        self.update_context_tree(
-                                            request_id=request_id,
-                                            task_id=next_task_id,
-                                            subtask_id=next_subtask_id,
-                                            step_id=step["id"],
-                                            status="pending",
-                                            title=step["title"],
-                                            description=step["description"],
-                                        )
+                                    steps_graph_json, id2step = self._index_graph(steps_graph)
+                                    add_context_tree_nodes(
+                                        request_id=request_id,
+                                        task_id=next_task_id,
+                                        subtask_id=next_subtask_id,
+                                        nodes=id2step.values(),
+                                    )
                                     completed_step_ids = []
+                                    completed_step_labels = []
+                                    step_deps = (
+                                        _DependencyTracker(steps_graph_json)
+                                        if code_scheduling
+                                        else None
+                                    )
 
-                                    # 步骤调度循环
-                                    while True:
-                                        if code_scheduling:
-                                            next_step_list = self.code_scheduling_layer(
-                                                overall_id=next_subtask_id,
-                                                graph=steps_graph_json,
-                                                completed_ids=completed_step_ids,
-                                            )
-                                        else:
-                                            steps_scheduled = self.scheduling_layer(
-                                                scheduler_thread=cap_group_thread[
-                                                    next_subtask_cap_group
-                                                ][1],
-                                                message=steps_need_scheduled,
-                                            )
-                                            steps_scheduled_json = json.loads(
-                                                steps_scheduled
-                                            )
-                                            next_step_list = steps_scheduled_json[
-                                                "next_steps"
-                                            ]
-                                        # 没有可执行step则说明全部完成，退出循环
-                                        if not next_step_list:
-                                            break
-                                        # 执行单个step，如出错重新规划task。
-                                        for next_step_id in next_step_list:
-                                            # 单个step的错误标志和信息
-                                            step_error_flag = False
-                                            step_error_message = ""
-
-                                            next_step = id2step[next_step_id]
-
-                                            self.update_context_tree(
-                                                request_id = request_id,
-                                                task_id = next_task_id,
-                                                subtask_id = next_subtask_id,
-                                                step_id = next_step_id,
-                                                status = "executing",
-                                                title = next_step['title'],
-                                                description = next_step['description']
-                                            )
-
-                                            console.rule()
-                                            print(
-                                                f"completed tasks: {(', '.join([str(id)+' ('+task_graph_json[id]['title']+')' for id in completed_task_ids])) if completed_task_ids else 'none'}"
-                                            )
-                                            print(
-                                                f"this task -> {next_task_id} ({next_task['title']})"
-                                            )
-                                            print(
-                                                f"├ completed subtasks: {(', '.join([str(id)+' ('+subtask_graph_json[id]['title']+')' for id in completed_subtask_ids])) if completed_subtask_ids else 'none'}"
-                                            )
-                                            print(
-                                                f"└ this subtask -> {next_subtask_id} ({next_subtask['title']})"
-                                            )
-                                            print(
-                                                f"  ├ completed steps: {(', '.join([str(id)+' ('+steps_graph_json[id]['title']+')' for id in completed_step_ids])) if completed_step_ids else 'none'}"
-                                            )
-                                            print(
-                                                f"  └ next step -> {next_step_id} ({next_step['title']})"
-                                            )
-
-                                            while True:
-                                                try:
-                                                    # 7. 能力agent执行单个step
-                                                    action = self.capability_agents_processor(step=next_step, cap_group=next_subtask_cap_group, cap_agent_threads=cap_agent_threads)
-                                                    result = action.get('result', "FAIL")
-                                                    context = action.get('context', "No context provided.")
-                                                    assert result == 'SUCCESS' or result == 'FAIL', f"Unknown result: {result}" 
-                                                    
-                                                    self.update_context_tree(
-                                                        request_id = request_id,
-                                                        task_id = next_task_id,
-                                                        subtask_id = next_subtask_id,
-                                                        step_id = next_step_id,
-                                                        action = action,
-                                                    )
+                                    def run_step(next_step_id, step_cap_agent_threads):
+                                        """执行单个step，成功返回None，失败返回StepError"""
 
-                                                    if result == "SUCCESS":
-                                                        pass
-                                                    elif result == "FAIL":
-                                                        # 如果失败，记录并更新error
-                                                        error_id = error_id + 1
-                                                        step_error_flag = True
-                                                        step_error_message = context
+                                        next_step = id2step[next_step_id]
 
-                                                        self.update_error(error_id = error_id, error = action, step = next_step)
+                                        update_context_tree(
+                                            request_id = request_id,
+                                            task_id = next_task_id,
+                                            subtask_id = next_subtask_id,
+                                            step_id = next_step_id,
+                                            status = "executing",
+                                            title = next_step['title'],
+                                            description = next_step['description']
+                                        )
 
-                                                except Exception as e:
-                                                    # 更新error
-                                                    error_id = error_id + 1
-                                                    step_error_flag = True
-                                                    step_error_message = str(e)
+                                        console.rule()
+                                        # 整块一次输出，并发执行step时各自的进度信息不会交错
+                                        print(
+                                            "\n".join(
+                                                (
+                                                    f"completed tasks: {', '.join(completed_task_labels) if completed_task_labels else 'none'}",
+                                                    f"this task -> {next_task_id} ({next_task['title']})",
+                                                    f"├ completed subtasks: {', '.join(completed_subtask_labels) if completed_subtask_labels else 'none'}",
+                                                    f"└ this subtask -> {next_subtask_id} ({next_subtask['title']})",
+                                                    f"  ├ completed steps: {', '.join(completed_step_labels) if completed_step_labels else 'none'}",
+                                                    f"  └ next step -> {next_step_id} ({next_step['title']})",
+                                                )
+                                            )
+                                        )
 
-                                                # 如果没有错误则退出该step循环，否则进入下一级错误处理
-                                                if not step_error_flag:
+                                        for attempt in range(_STEP_TIMEOUT_RETRIES + 1):
+                                            try:
+                                                # 7. 能力agent执行单个step
+                                                action = capability_agents_processor(step=next_step, cap_group=next_subtask_cap_group, cap_agent_threads=step_cap_agent_threads)
+                                                result = action.get('result', "FAIL")
+                                                assert result == 'SUCCESS' or result == 'FAIL', f"Unknown result: {result}"
+
+                                                update_context_tree(
+                                                    request_id = request_id,
+                                                    task_id = next_task_id,
+                                                    subtask_id = next_subtask_id,
+                                                    step_id = next_step_id,
+                                                    action = action,
+                                                )
+
+                                                if result == "SUCCESS":
+                                                    step_error = None
+                                                else:
+                                                    # 如果失败，记录并更新error
+                                                    step_error = StepError(next(error_ids), "fail", action.get('context', "No context provided."), next_step_id)
+                                                    self.update_error(error_id = step_error.id, error = action, step = next_step)
+                                            except AssertionError as e:
+                                                step_error = StepError(next(error_ids), "validation", e, next_step_id)
+                                            except (TimeoutError, APITimeoutError) as e:
+                                                step_error = StepError(next(error_ids), "timeout", e, next_step_id)
+                                            except Exception as e:
+                                                step_error = StepError(next(error_ids), "exec", e, next_step_id)
+
+                                            # 根据错误类型决定：完成step、原地重试，还是交给上一级重新规划
+                                            match step_error:
+                                                case None:
                                                     console.rule()
                                                     print(
                                                         f"    {next_step_id} ({next_step['title']}) complete"
                                                     )
-                                                    break
-                                                else:
+                                                    return None
+                                                case StepError(kind="timeout") if attempt < _STEP_TIMEOUT_RETRIES:
+                                                    # 超时多为暂时性问题，直接重试该step，不必重新规划subtask
                                                     console.rule()
                                                     print(
-                                                        f"    {next_step_id} ({next_step['title']}) failed, error: {step_error_message}"
+                                                        f"    {next_step_id} ({next_step['title']}) timed out, retrying"
+                                                    )
+                                                case _:
+                                                    console.rule()
+                                                    print(
+                                                        f"    {next_step_id} ({next_step['title']}) failed, error: {step_error.message}"
                                                     )
 
-                                                    self.clear_context_tree_node(
+                                                    clear_context_tree_node(
                                                         request_id=request_id,
                                                         task_id=next_task_id,
                                                         subtask_id=next_subtask_id,
                                                         step_id=next_step_id,
                                                     )
+                                                    return step_error
+
+                                    def complete_step(next_step_id):
+                                        """把step记为已完成"""
+                                        completed_step_ids.append(next_step_id)
+                                        completed_step_labels.append(f"{next_step_id} ({id2step[next_step_id]['title']})")
+
+                                        update_context_tree(
+                                            request_id=request_id,
+                                            task_id=next_task_id,
+                                            subtask_id=next_subtask_id,
+                                            step_id=next_step_id,
+                                            status="completed",
+                                        )
+
+                                    if code_scheduling and parallel_steps:
+                                        # 代码级调度下不按批次等待：任一step完成后立即重新调度，
+                                        # 新就绪的step马上开始，不必等同一批中耗时较长的step
+                                        started_step_ids = set()
+                                        # 同一个Thread不能同时运行，空闲的能力agent线程在step之间复用，不够时借用备用Thread
+                                        idle_step_threads = [cap_agent_threads]
+                                        running_steps = {}
+                                        try:
+                                            while True:
+                                                if not subtask_error_flag:
+                                                    for next_step_id in code_scheduling_layer(
+                                                        overall_id=next_subtask_id,
+                                                        graph=steps_graph_json,
+                                                        completed_ids=completed_step_ids,
+                                                        tracker=step_deps,
+                                                    ):
+                                                        if next_step_id in started_step_ids:
+                                                            continue
+                                                        started_step_ids.add(next_step_id)
+                                                        step_threads = (
+                                                            idle_step_threads.pop()
+                                                            if idle_step_threads
+                                                            else self._borrow_cap_agent_threads(
+                                                                next_subtask_cap_group, cap_agents
+                                                            )
+                                                        )
+                                                        future = self._step_pool.submit(run_step, next_step_id, step_threads)
+                                                        running_steps[future] = (next_step_id, step_threads)
+                                                # 没有正在执行的step则说明全部完成（或已出错），退出循环
+                                                if not running_steps:
+                                                    break
+                                                done, _ = wait(running_steps, return_when=FIRST_COMPLETED)
+                                                for future in done:
+                                                    next_step_id, step_threads = running_steps.pop(future)
+                                                    idle_step_threads.append(step_threads)
+                                                    if future.cancelled():
+                                                        continue
+                                                    step_error = future.result()
+                                                    if subtask_error_flag:
+                                                        continue
+                                                    if step_error is not None:
+                                                        subtask_error_flag = True
+                                                        subtask_error_message = step_error.message
+                                                        # 失败后不再启动新的step，尚未开始的直接取消，等待执行中的结束后重新规划subtask
+                                                        for pending in running_steps:
+                                                            pending.cancel()
+                                                    else:
+                                                        complete_step(next_step_id)
+                                        finally:
+                                            # 抛出异常时执行中的step仍在使用Thread：取消尚未开始的，等待执行中的结束后再归还
+                                            for pending in running_steps:
+                                                pending.cancel()
+                                            wait(running_steps)
+                                            idle_step_threads.extend(
+                                                step_threads for _, step_threads in running_steps.values()
+                                            )
+                                            # 借用的备用Thread归还给Agency，供之后的subtask和请求复用
+                                            self._return_cap_agent_threads(
+                                                next_subtask_cap_group,
+                                                [threads for threads in idle_step_threads if threads is not cap_agent_threads],
+                                            )
+                                    else:
+                                        # 步骤调度循环
+                                        while True:
+                                            if code_scheduling:
+                                                next_step_list = code_scheduling_layer(
+                                                    overall_id=next_subtask_id,
+                                                    graph=steps_graph_json,
+                                                    completed_ids=completed_step_ids,
+                                                    tracker=step_deps,
+                                                )
+                                            else:
+                                                steps_scheduled = scheduling_layer(
+                                                    scheduler_thread=step_scheduler_thread,
+                                                    message=steps_need_scheduled,
+                                                )
+                                                next_step_list = _scheduled_ids(
+                                                    steps_scheduled, "next_steps"
+                                                )
+                                            # 没有可执行step则说明全部完成，退出循环
+                                            if not next_step_list:
+                                                break
 
+                                            if parallel_steps and len(next_step_list) > 1:
+                                                # 同一批step互不依赖，并发执行；同一个Thread不能同时运行，
+                                                # 除第一个step外都借用备用的能力agent Thread，执行完后归还
+                                                spare_threads = [
+                                                    self._borrow_cap_agent_threads(next_subtask_cap_group, cap_agents)
+                                                    for _ in next_step_list[1:]
+                                                ]
+                                                step_futures = []
+                                                try:
+                                                    for next_step_id, step_threads in zip(
+                                                        next_step_list, [cap_agent_threads] + spare_threads
+                                                    ):
+                                                        step_futures.append(
+                                                            self._step_pool.submit(run_step, next_step_id, step_threads)
+                                                        )
+                                                    step_results = [future.result() for future in step_futures]
+                                                finally:
+                                                    # 某个step抛出异常时其余step可能仍在使用借出的Thread：
+                                                    # 取消尚未开始的，等待执行中的结束后再归还
+                                                    for future in step_futures:
+                                                        future.cancel()
+                                                    wait(step_futures)
+                                                    self._return_cap_agent_threads(next_subtask_cap_group, spare_threads)
+                                            else:
+                                                # 顺序执行时按需逐个运行，出错后不再执行后面的step
+                                                step_results = (
+                                                    run_step(next_step_id, cap_agent_threads)
+                                                    for next_step_id in next_step_list
+                                                )
+
+                                            # 执行单个step，如出错重新规划task。
+                                            for next_step_id, step_error in zip(
+                                                next_step_list, step_results
+                                            ):
+                                                if step_error is not None:
                                                     # continue # 重新执行step
                                                     subtask_error_flag = True
-                                                    subtask_error_message = (
-                                                        step_error_message
-                                                    )
+                                                    subtask_error_message = step_error.message
                                                     break  # 失败则跳出，重新规划subtask
+                                                # 本次step完成，加入已完成列表
+                                                complete_step(next_step_id)
 
                                             if subtask_error_flag:
                                                 break
-                                            # 本次step完成，加入已完成列表
-                                            completed_step_ids.append(next_step_id)
-
-                                            self.update_context_tree(
-                                                request_id=request_id,
-                                                task_id=next_task_id,
-                                                subtask_id=next_subtask_id,
-                                                step_id=next_step_id,
-                                                status="completed",
-                                            )
-
-                                        if subtask_error_flag:
-                                            break
-                                        # 本次step调度结束
+                                            # 本次step调度结束
 
                                     # 本subtask的所有step结束
                                     if not subtask_error_flag:
                                         # 如果step全都正常完成，更新已完成subtask
+                                        save_plan(
+                                            steps_plan_key,
+                                            steps_graph,
+                                            steps_need_scheduled,
+                                            step_planner_thread,
+                                        )
                                         console.rule()
                                         print(
                                             f"  {next_subtask_id} ({next_subtask['title']}) complete"
@@ -1916,11 +2462,12 @@ class Agency:
                                             f"  {next_subtask_id} ({next_subtask['title']}) failed, error: {subtask_error_message}"
                                         )
 
-                                        self.clear_context_tree_node(
+                                        clear_context_tree_node(
                                             request_id=request_id,
                                             task_id=next_task_id,
                                             subtask_id=next_subtask_id,
                                         )
+                                        discard_plan(steps_plan_key)
 
                                         # continue # 重新规划subtask
                                         task_error_flag = True
@@ -1931,8 +2478,9 @@ class Agency:
                                     break
                                 # 本次subtask完成，加入已完成列表
                                 completed_subtask_ids.append(next_subtask_id)
+                                completed_subtask_labels.append(f"{next_subtask_id} ({next_subtask['title']})")
 
-                                self.update_context_tree(
+                                update_context_tree(
                                     request_id=request_id,
                                     task_id=next_task_id,
                                     subtask_id=next_subtask_id,
@@ -1946,6 +2494,12 @@ class Agency:
                         # 本次task的所有subtask结束
                         if not task_error_flag:
                             # 如果subtask全都正常完成，更新已完成task
+                            save_plan(
+                                subtask_plan_key,
+                                subtask_graph,
+                                subtasks_need_scheduled,
+                                subtask_planner_thread,
+                            )
                             console.rule()
                             print(f"{next_task_id} ({next_task['title']}) complete")
                             break
@@ -1955,15 +2509,17 @@ class Agency:
                                 f"{next_task_id} ({next_task['title']}) failed, error: {task_error_message}"
                             )
 
-                            self.clear_context_tree_node(
+                            clear_context_tree_node(
                                 request_id=request_id, task_id=next_task_id
                             )
+                            discard_plan(subtask_plan_key)
                             continue  # 有错误则重新规划task
 
                     # 本次task完成，加入已完成列表
                     completed_task_ids.append(next_task_id)
+                    completed_task_labels.append(f"{next_task_id} ({next_task['title']})")
 
-                    self.update_context_tree(
+                    update_context_tree(
                         request_id=request_id,
                         task_id=next_task_id,
                         status="completed",
@@ -1975,10 +2531,17 @@ class Agency:
 
             # 所有task完成
             if not original_request_error_flag:
+                save_plan(
+                    task_plan_key,
+                    task_graph,
+                    tasks_need_scheduled,
+                    task_planner_thread,
+                    original_request,
+                )
                 console.rule()
                 print(f"original request complete")
 
-                self.update_context_tree(
+                update_context_tree(
                     request_id=request_id,
                     status="completed",
                 )
@@ -1989,7 +2552,8 @@ class Agency:
                 print(
                     f"original request failed, error: {original_request_error_message}"
                 )
-                self.clear_context_tree_node(request_id=request_id)
+                clear_context_tree_node(request_id=request_id)
+                discard_plan(task_plan_key)
                 continue  # 重新规划用户请求
 
     def task_planning_rag(
@@ -2015,26 +2579,25 @@ class Agency:
         # 初始化任务树
         self.init_context_tree(request_id=request_id, content=original_request)
 
-        # 判断是否启用“代码级调度”模式（通过环境变量 DEBUG_CODE_SCHEDULING 控制）
-        code_scheduling = os.getenv("DEBUG_CODE_SCHEDULING")
-        if code_scheduling is None or code_scheduling.lower() != "true":
-            code_scheduling = False
-        else:
-            code_scheduling = True
+        # 是否启用“代码级调度”模式
+        code_scheduling = CODE_SCHEDULING
+
+        # 同一批可调度的task是否并发执行（与task_planning中的step共用PARALLEL_STEPS开关）
+        parallel_tasks = PARALLEL_STEPS
 
         # 取出各类规划/检查/调度/任务细化的智能体（Agent）
         task_planner_rag = plan_agents["task_planner_rag"]
         task_inspector_rag = plan_agents["task_inspector_rag"]
         task_manager_rag = plan_agents["task_manager_rag"]
         # 创建用户与各智能体的对话线程（Thread）
-        task_planner_rag_thread = Thread(self.user, task_planner_rag)
-        task_inspector_rag_thread = Thread(self.user, task_inspector_rag)
-        task_manager_rag_thread = Thread(self.user, task_manager_rag)
+        task_planner_rag_thread = self._agent_thread(task_planner_rag)
+        task_inspector_rag_thread = self._agent_thread(task_inspector_rag)
+        task_manager_rag_thread = self._agent_thread(task_manager_rag)
 
         # 如果未开启代码级调度，还需要为task调度器创建线程
         if not code_scheduling:
             task_scheduler_rag = plan_agents["task_scheduler_rag"]
-            task_scheduler_rag_thread = Thread(self.user, task_scheduler_rag)
+            task_scheduler_rag_thread = self._agent_thread(task_scheduler_rag)
 
         # 为每个能力群的细化智能体批量创建线程
         cap_group_thread = self.create_cap_group_agent_threads(
@@ -2052,7 +2615,8 @@ class Agency:
 
         original_request_error_flag = False
         original_request_error_message = ""
-        error_id = 0
+        # 并发执行task时也能安全地分配error_id
+        error_ids = itertools.count(1)
         # 用户在与rag agent对话时，除原始用户请求的所有累加输入
         other_input = ""
 
@@ -2061,7 +2625,7 @@ class Agency:
         plan_original_request_num = "0"
         while True:
             # 任务规划层，生成task的（subtask级）流程图和调度所需信息
-            task_graph, tasks_need_scheduled, other_input = self.planning_layer(
+            task_graph, tasks_need_scheduled, other_input, task_plan_key = self.cached_planning_layer(
                 message=original_request,
                 original_request=original_request,
                 planner_thread=task_planner_rag_thread,
@@ -2075,74 +2639,125 @@ class Agency:
 
             # 重置错误标志，清理错误文件
             original_request_error_flag = False
-            self._init_file(self.error_path)
+            self.clear_errors()
 
-            id2task = {}
-            task_graph_json = json.loads(task_graph)
-            for key in task_graph_json.keys():
-                task = task_graph_json[key]
-                id2task[task["id"]] = task
-                self.update_context_tree(
-                    request_id=request_id,
-                    task_id=task["id"],
-                    status="pending",
-                    title=task["title"],
-                    description=task["description"],
-                )
+            task_graph_json, id2task = self._index_graph(task_graph)
+            self.add_context_tree_nodes(
+                request_id=request_id,
+                nodes=id2task.values(),
+            )
             completed_task_ids = []
+            completed_task_labels = []
+            # 代码级调度时按依赖关系增量计算可执行的task
+            task_deps = _DependencyTracker(task_graph_json) if code_scheduling else None
+
+            def run_task(next_task_id, task_cap_agent_threads, optimizer_thread):
+                """细化并执行单个task，失败时带上错误信息重新细化，成功返回None，连续3次失败返回错误信息"""
+                next_task = id2task[next_task_id]
+                task_input = {
+                    "title": next_task["title"],
+                    "description": next_task["description"],
+                    "total_task_graph": task_graph_json,
+                    "last_error": "",
+                }
 
-            # 任务调度循环
-            while True:
-                # 任务调度层，确定可执行的task列表（能力相关）
-                if code_scheduling:
-                    next_task_list = self.code_scheduling_layer(
-                        overall_id="original request",
-                        graph=task_graph_json,
-                        completed_ids=completed_task_ids,
-                    )
-                else:
-                    tasks_scheduled = self.scheduling_layer(
-                        scheduler_thread=task_scheduler_rag_thread,
-                        message=tasks_need_scheduled,
+                self.update_context_tree(request_id=request_id, task_id=next_task_id, status="executing")
+
+                console.rule()
+                # 进度信息整块一次输出，并发执行task时各自的进度信息不会交错
+                print(
+                    "\n".join(
+                        (
+                            f"completed tasks: {', '.join(completed_task_labels) if completed_task_labels else 'none'}",
+                            f"this task -> {next_task_id} ({next_task['title']})",
+                        )
                     )
-                    tasks_scheduled_json = json.loads(tasks_scheduled)
-                    next_task_list = tasks_scheduled_json["next_tasks"]
+                )
+                next_task_cap_group = next_task["capability_group"]
+
+                # 任务细化层
+                optimize_res = self.task_optimizing_layer(
+                    message=fast_json.dumps(task_input),
+                    original_request=next_task["description"],
+                    optimizer_thread=optimizer_thread,
+                    overall_id=next_task_id,
+                )
+                optimize_res_json = fast_json.loads(optimize_res)
+                next_task["description"] = optimize_res_json["description"]
+                next_task["agent"] = optimize_res_json["agent"]
 
-                if not next_task_list:  # 没有可执行task则说明全部完成，退出循环
-                    break
+                self.update_context_tree(
+                    request_id=request_id,
+                    task_id=next_task_id,
+                    description=next_task["description"],
+                    status="executing",
+                )
 
-                for next_task_id in next_task_list:
-                    # 细化并执行单个task
-                    task_error_flag = False
-                    task_error_message = ""
+                task_error_num = 0
+                while True:
+                    try:
+                        # 能力agent执行单个task
+                        action = self.capability_agents_processor(
+                                step=next_task,
+                                cap_group=next_task_cap_group,
+                                cap_agent_threads=task_cap_agent_threads,
+                            )
+                        result = action.get('result', "FAIL")
+                        context = action.get('context', "No context provided.")
+                        assert (result == "SUCCESS" or result == "FAIL"), f"Unknown result: {result}"
+
+                        self.update_context_tree(
+                            request_id=request_id,
+                            task_id=next_task_id,
+                            rag_action=action,
+                        )
 
-                    next_task = id2task[next_task_id]
-                    task_input = {
-                        "title": next_task["title"],
-                        "description": next_task["description"],
-                        "total_task_graph": task_graph_json,
-                        "last_error": "",
-                    }
+                        if result == "SUCCESS":
+                            task_error_flag = False
+                            task_error_message = ""
+                        elif result == "FAIL":
+                            # 如果失败，记录并更新error
+                            error_id = next(error_ids)
+                            task_error_flag = True
+                            task_error_message = context
+                            self.update_error(error_id=error_id, error=action, step=next_task)
+
+                    except Exception as e:
+                        # 更新error
+                        next(error_ids)
+                        task_error_flag = True
+                        task_error_message = str(e)
 
-                    self.update_context_tree(request_id=request_id, task_id=next_task_id, status="executing")
+                    # 如果没有错误则完成该task
+                    if not task_error_flag:
+                        console.rule()
+                        print(f"{next_task_id} ({next_task['title']}) complete")
+                        return None
 
                     console.rule()
                     print(
-                        f"completed tasks: {(', '.join([str(id)+' ('+task_graph_json[id]['title']+')' for id in completed_task_ids])) if completed_task_ids else 'none'}"
+                        f"{next_task_id} ({next_task['title']}) failed, error: {task_error_message}"
                     )
-                    print(f"this task -> {next_task_id} ({next_task['title']})")
-                    next_task_cap_group = next_task["capability_group"]
+                    task_error_num += 1
+
+                    self.clear_context_tree_node(request_id=request_id, task_id=next_task_id)
 
-                    # 任务细化层
-                    optimize_res = self.task_optimizing_layer(
-                        message=json.dumps(task_input, ensure_ascii=False),
+                    if task_error_num >= 3:
+                        # 单个task超过3次失败，交给上一级重新规划用户请求
+                        return task_error_message
+
+                    # 单个task执行不超过3次失败则加上错误信息重新细化该task
+                    task_input["last_error"] = task_error_message
+                    print("task_input:###",task_input)
+                    optimize_again = self.task_optimizing_layer(
+                        message=fast_json.dumps(task_input),
                         original_request=next_task["description"],
-                        optimizer_thread=cap_group_thread[next_task_cap_group][0],
+                        optimizer_thread=optimizer_thread,
                         overall_id=next_task_id,
                     )
-                    optimize_res_json = json.loads(optimize_res)
-                    next_task["description"] = optimize_res_json["description"]
-                    next_task["agent"] = optimize_res_json["agent"]
+                    optimize_again_json = fast_json.loads(optimize_again)
+                    next_task["description"] = optimize_again_json["description"]
+                    next_task["agent"] = optimize_again_json["agent"]
 
                     self.update_context_tree(
                         request_id=request_id,
@@ -2151,89 +2766,100 @@ class Agency:
                         status="executing",
                     )
 
-                    task_error_num = 0
-                    while True:
-                        try:
-                            # 能力agent执行单个task
-                            action = self.capability_agents_processor(
-                                    step=next_task,
-                                    cap_group=next_task_cap_group,
-                                    cap_agent_threads=cap_agent_threads,
-                                )
-                            result = action.get('result', "FAIL")
-                            context = action.get('context', "No context provided.")
-                            assert (result == "SUCCESS" or result == "FAIL"), f"Unknown result: {result}"
-
-                            self.update_context_tree(
-                                request_id=request_id,
-                                task_id=next_task_id,
-                                rag_action=action,
-                            )
+            def complete_task(next_task_id):
+                """把task记为已完成"""
+                completed_task_ids.append(next_task_id)
+                completed_task_labels.append(f"{next_task_id} ({id2task[next_task_id]['title']})")
 
-                            if result == "SUCCESS":
-                                task_error_flag = False
-                                task_error_message = ""
-                            elif result == "FAIL":
-                                # 如果失败，记录并更新error
-                                error_id = error_id + 1
-                                task_error_flag = True
-                                task_error_message = context
-                                self.update_error(error_id=error_id, error=action, step=next_task)
+                self.update_context_tree(
+                    request_id=request_id,
+                    task_id=next_task_id,
+                    status="completed",
+                )
 
-                        except Exception as e:
-                            # 更新error
-                            error_id = error_id + 1
-                            task_error_flag = True
-                            task_error_message = str(e)
+            # 任务调度循环
+            while True:
+                # 任务调度层，确定可执行的task列表（能力相关）
+                if code_scheduling:
+                    next_task_list = self.code_scheduling_layer(
+                        overall_id="original request",
+                        graph=task_graph_json,
+                        completed_ids=completed_task_ids,
+                        tracker=task_deps,
+                    )
+                else:
+                    tasks_scheduled = self.scheduling_layer(
+                        scheduler_thread=task_scheduler_rag_thread,
+                        message=tasks_need_scheduled,
+                    )
+                    next_task_list = _scheduled_ids(tasks_scheduled, "next_tasks")
 
-                        # 如果没有错误则退出该task，更新已完成task
-                        if not task_error_flag:
-                            console.rule()
-                            print(f"{next_task_id} ({next_task['title']}) complete")
-                            break
-                        else:
-                            console.rule()
-                            print(
-                                f"{next_task_id} ({next_task['title']}) failed, error: {task_error_message}"
-                            )
-                            task_error_num += 1
-
-                            self.clear_context_tree_node(request_id=request_id, task_id=next_task_id)
-
-                            if task_error_num < 3:
-                                # 单个task执行不超过3次失败则加上错误信息重新细化该task
-                                task_input["last_error"] = task_error_message
-                                print("task_input:###",task_input)
-                                optimize_again = self.task_optimizing_layer(
-                                    message=json.dumps(task_input, ensure_ascii=False),
-                                    original_request=next_task["description"],
-                                    optimizer_thread=cap_group_thread[next_task_cap_group][0],
-                                    overall_id=next_task_id,
-                                )
-                                optimize_again_json = json.loads(optimize_again)
-                                next_task["description"] = optimize_again_json["description"]
-                                next_task["agent"] = optimize_again_json["agent"]
+                if not next_task_list:  # 没有可执行task则说明全部完成，退出循环
+                    break
 
-                                self.update_context_tree(
-                                    request_id=request_id,
-                                    task_id=next_task_id,
-                                    description=next_task["description"],
-                                    status="executing",
-                                )
+                if parallel_tasks and len(next_task_list) > 1:
+                    # 同一批task互不依赖，并发执行；同一个Thread不能同时运行，除第一个task外
+                    # 都借用备用的能力agent Thread，并为能力群细化agent新建Thread
+                    task_threads = [
+                        (
+                            cap_agent_threads,
+                            cap_group_thread[id2task[next_task_list[0]]["capability_group"]][0],
+                        )
+                    ]
+                    for next_task_id in next_task_list[1:]:
+                        next_task_cap_group = id2task[next_task_id]["capability_group"]
+                        task_threads.append(
+                            (
+                                self._borrow_cap_agent_threads(next_task_cap_group, cap_agents),
+                                Thread(
+                                    self.user,
+                                    cap_group_thread[next_task_cap_group][0].recipient_agent,
+                                ),
+                            )
+                        )
+                    running_tasks = {}
+                    try:
+                        for next_task_id, threads in zip(next_task_list, task_threads):
+                            running_tasks[self._step_pool.submit(run_task, next_task_id, *threads)] = next_task_id
+                        for future in as_completed(running_tasks):
+                            if future.cancelled():
                                 continue
-                            else:
+                            task_error_message = future.result()
+                            if original_request_error_flag:
+                                continue
+                            if task_error_message is not None:
+                                # 单个task超过3次失败，尚未开始的task直接取消，等待执行中的结束后重新规划用户请求
                                 original_request_error_flag = True
                                 original_request_error_message = task_error_message
-                                break  # 单个task超过3次失败则跳出，重新规划用户请求
-
-                    # 本次task完成，加入已完成列表
-                    completed_task_ids.append(next_task_id)
-
-                    self.update_context_tree(
-                        request_id=request_id,
-                        task_id=next_task_id,
-                        status="completed",
-                    )
+                                for pending in running_tasks:
+                                    pending.cancel()
+                            else:
+                                complete_task(running_tasks[future])
+                    finally:
+                        # 某个task抛出异常时其余task可能仍在使用借出的Thread：取消尚未开始的，
+                        # 等待执行中的结束后再归还
+                        for pending in running_tasks:
+                            pending.cancel()
+                        wait(running_tasks)
+                        for next_task_id, (threads, _) in zip(
+                            next_task_list[1:], task_threads[1:]
+                        ):
+                            self._return_cap_agent_threads(
+                                id2task[next_task_id]["capability_group"], [threads]
+                            )
+                else:
+                    for next_task_id in next_task_list:
+                        task_error_message = run_task(
+                            next_task_id,
+                            cap_agent_threads,
+                            cap_group_thread[id2task[next_task_id]["capability_group"]][0],
+                        )
+                        if task_error_message is not None:
+                            original_request_error_flag = True
+                            original_request_error_message = task_error_message
+                            break  # 单个task超过3次失败则跳出，重新规划用户请求
+                        # 本次task完成，加入已完成列表
+                        complete_task(next_task_id)
 
                 if original_request_error_flag:
                     break
@@ -2241,6 +2867,13 @@ class Agency:
 
             # 所有task完成
             if not original_request_error_flag:
+                self.save_plan(
+                    task_plan_key,
+                    task_graph,
+                    tasks_need_scheduled,
+                    task_planner_rag_thread,
+                    original_request,
+                )
                 console.rule()
                 print(f"original request complete")
 
@@ -2257,34 +2890,44 @@ class Agency:
                 )
                 plan_original_request_num = str(int(plan_original_request_num) + 1)
                 self.clear_context_tree_node(request_id=request_id)
+                self.discard_plan(task_plan_key)
                 continue  # 重新规划用户请求
 
+    @_with_files_lock
     def update_error(self, error_id: int, error: dict, step: dict):
-        try:
-            with open(self.error_path, "r", encoding="utf-8") as file:
-                try:  # 尝试读取 JSON 数据
-                    data = json.load(file)
-                except json.JSONDecodeError:  # 如果文件为空或格式错误，则创建一个空字典
-                    data = {}
-        except FileNotFoundError:
-            data = {}
-        data[error_id] = {
+        # 键与写入JSON文件后一致，使用字符串
+        self._errors[str(error_id)] = {
             "error_id": "error_" + str(error_id),
             "step": step,
             "error": error,
         }
-        with open(self.error_path, "w", encoding="utf-8") as file:
-            json.dump(data, file, indent=4, ensure_ascii=False)
-
+        self._errors_dirty = True
+
+    @_with_files_lock
+    def clear_errors(self):
+        """清空错误记录，没有记录时不写文件"""
+        if self._errors:
+            self._errors.clear()
+            self._errors_dirty = True
+
+    @_with_files_lock
+    def flush_errors(self):
+        """把修改过的错误记录写回error.json"""
+        if not self._errors_dirty:
+            return
+        tmp_path = self.error_path + ".tmp"
+        data = fast_json.dumps_indented(self._errors)
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(data)
+        os.replace(tmp_path, self.error_path)
+        self._errors_dirty = False
+
+    @_with_files_lock
     def init_context_tree(self, request_id, content):
         """
         初始化任务树，在任务开始时创建根节点
         """
-        with open(self.CONTEXT_TREE_PATH, "r", encoding="utf-8") as file:
-            try:  # 尝试读取 JSON 数据
-                context_tree = json.load(file)
-            except json.JSONDecodeError:  # 如果文件为空或格式错误，则创建一个空字典
-                context_tree = {}
+        context_tree = self._load_context_tree()
 
         # 添加新的用户请求根节点
         context_tree[request_id] = {
@@ -2292,10 +2935,74 @@ class Agency:
             "status": "executing",
             "tasks": [],
         }
+        self._forget_context_tree_nodes((request_id,), keep_root=False)
+        self._context_tree_dirty = True
 
-        with open(self.CONTEXT_TREE_PATH, "w", encoding="utf-8") as f:
-            json.dump(context_tree, f, indent=4, ensure_ascii=False)
-
+    def _load_context_tree(self):
+        """返回任务树的内存副本，首次使用时从文件加载（调用方需持有_files_lock）"""
+        if self._context_tree is None:
+            try:
+                with open(self.CONTEXT_TREE_PATH, "r", encoding="utf-8") as file:
+                    self._context_tree = json.load(file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                # 如果文件不存在、为空或格式错误，则创建一个空字典
+                self._context_tree = {}
+        return self._context_tree
+
+    def _context_tree_node(self, request_id, *ids):
+        """
+        按路径(request_id, task_id, subtask_id, step_id)查找任务树中的节点，不存在时返回None。
+        找到的节点按路径缓存，之后的更新不再逐层遍历子节点列表（调用方需持有_files_lock）
+        """
+        path = (request_id, *ids)
+        node = self._context_tree_nodes.get(path)
+        if node is not None:
+            return node
+        if ids:
+            parent = self._context_tree_node(request_id, *ids[:-1])
+            if parent is None:
+                return None
+            node = next(
+                (
+                    child
+                    for child in parent[_CONTEXT_TREE_CHILDREN[len(ids) - 1]]
+                    if child["id"] == ids[-1]
+                ),
+                None,
+            )
+        else:
+            node = self._load_context_tree().get(request_id)
+        if node is not None:
+            self._context_tree_nodes[path] = node
+        return node
+
+    def _forget_context_tree_nodes(self, path, keep_root=True):
+        """子树被摘除或替换后，删除路径索引中该子树下的节点"""
+        depth = len(path)
+        for key in [
+            key
+            for key in self._context_tree_nodes
+            if key[:depth] == path and (len(key) > depth or not keep_root)
+        ]:
+            del self._context_tree_nodes[key]
+
+    @_with_files_lock
+    def flush_context_tree(self):
+        """
+        把修改过的任务树写回context_tree.json。先写临时文件再替换，
+        agent通过ReadJsonFile读取时不会读到写了一半的文件
+        """
+        if not self._context_tree_dirty:
+            return
+        tmp_path = self.CONTEXT_TREE_PATH + ".tmp"
+        # 整棵树一次序列化、一次写入；json.dump会把编码出的片段逐个写入文件
+        data = fast_json.dumps_indented(self._context_tree)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, self.CONTEXT_TREE_PATH)
+        self._context_tree_dirty = False
+
+    @_with_files_lock
     def update_context_tree(
         self,
         request_id: str,
@@ -2311,21 +3018,15 @@ class Agency:
         """
         更新任务树中的节点（任务/子任务/步骤）的状态
         """
-        # 加载当前任务树
-        with open(self.CONTEXT_TREE_PATH, "r", encoding="utf-8") as f:
-            context_tree = json.load(f)
-
         # 获取当前任务
-        request = context_tree.get(request_id)
+        request = self._context_tree_node(request_id)
         if not request:
             raise Exception(f"Request {request_id} not found in task tree.")
 
         # 如果是任务状态变化
         if task_id:
             # 查找任务
-            task = next(
-                (task for task in request["tasks"] if task["id"] == task_id), None
-            )
+            task = self._context_tree_node(request_id, task_id)
             if task:
                 if rag_action:
                     command = rag_action.get("command")
@@ -2341,11 +3042,11 @@ class Agency:
                 else:
                     if subtask_id:
                         # 查找子任务
-                        subtask = next((subtask for subtask in task["subtasks"] if subtask["id"] == subtask_id), None)
+                        subtask = self._context_tree_node(request_id, task_id, subtask_id)
                         if subtask:
                             if step_id:
                                 # 查找步骤
-                                step = next((step for step in subtask["steps"] if step["id"] == step_id), None)
+                                step = self._context_tree_node(request_id, task_id, subtask_id, step_id)
                                 if step:
                                     # 更新现有步骤
                                     if action:                                       
@@ -2396,94 +3097,119 @@ class Agency:
             # 更新整个请求状态
             request["status"] = status
 
-        # 保存更新后的任务树
-        with open(self.CONTEXT_TREE_PATH, "w", encoding="utf-8") as f:
-            json.dump(context_tree, f, indent=4, ensure_ascii=False)
+        self._context_tree_dirty = True
+        if not task_id:
+            # 整个请求的状态变化立即落盘
+            self.flush_context_tree()
+            self.flush_errors()
 
-    def clear_context_tree_node(
+    @_with_files_lock
+    def add_context_tree_nodes(
         self,
         request_id: str,
+        nodes,
         task_id: str = None,
         subtask_id: str = None,
-        step_id: str = None,
     ):
         """
-        清空任务树中的节点（任务/子任务/步骤）
+        把新规划出的一批节点以pending状态加入任务树，父节点只查找一次。
+        未指定task_id时nodes为任务，只指定task_id时为子任务，两者都指定时为步骤
         """
-        # 加载当前任务树
-        with open(self.CONTEXT_TREE_PATH, "r", encoding="utf-8") as f:
-            context_tree = json.load(f)
-
-        # 获取当前任务
-        request = context_tree.get(request_id)
+        request = self._context_tree_node(request_id)
         if not request:
             raise Exception(f"Request {request_id} not found in task tree.")
 
-        if task_id:
-            task = next(
-                (task for task in request["tasks"] if task["id"] == task_id), None
-            )
-            if task:
-                if subtask_id:
-                    subtask = next(
-                        (
-                            subtask
-                            for subtask in task["subtasks"]
-                            if subtask["id"] == subtask_id
-                        ),
-                        None,
-                    )
-                    if subtask:
-                        if step_id:
-                            step = next(
-                                (
-                                    step
-                                    for step in subtask["steps"]
-                                    if step["id"] == step_id
-                                ),
-                                None,
-                            )
-                            # 清空步骤
-                            if step:
-                                step["actions"] = []
-                            else:
-                                raise Exception(f"{step_id} not found in {subtask_id}.")
-                        else:
-                            # 清空子任务
-                            subtask["steps"] = []
-                    else:
-                        raise Exception(f"{subtask_id} not found in {task_id}.")
-                else:
-                    # 清空任务
-                    task["subtasks"] = []
-            else:
-                raise Exception(f"{task_id} not found in {request_id}.")
+        if not task_id:
+            parent, children_key = request, "tasks"
+            new_fields = {"subtasks": [], "rag_actions": []}
         else:
-            # 清空整个请求
-            request["tasks"] = []
+            parent = self._context_tree_node(request_id, task_id)
+            if not parent:
+                raise Exception(f"{task_id} not found in {request_id}.")
+            children_key, new_fields = "subtasks", {"steps": []}
+            if subtask_id:
+                parent = self._context_tree_node(request_id, task_id, subtask_id)
+                if not parent:
+                    raise Exception(f"{subtask_id} not found in {task_id}.")
+                children_key, new_fields = "steps", {"actions": []}
+
+        children = parent[children_key]
+        existing = {child["id"]: child for child in children}
+        for node in nodes:
+            child = existing.get(node["id"])
+            if child:
+                # 已存在的节点只更新状态，任务还会更新描述
+                child["status"] = "pending"
+                if not task_id:
+                    child["description"] = node["description"]
+                continue
+            child = {
+                "id": node["id"],
+                "status": "pending",
+                "title": node["title"],
+                "description": node["description"],
+                **{key: list(value) for key, value in new_fields.items()},
+            }
+            children.append(child)
+            existing[node["id"]] = child
+
+        self._context_tree_dirty = True
+
+    @_with_files_lock
+    def clear_context_tree_node(
+        self,
+        request_id: str,
+        task_id: str = None,
+        subtask_id: str = None,
+        step_id: str = None,
+    ):
+        """
+        清空任务树中的节点（任务/子任务/步骤）
+        """
+        ids = []
+        for node_id in (task_id, subtask_id, step_id):
+            if not node_id:
+                break
+            ids.append(node_id)
+
+        node = self._context_tree_node(request_id, *ids)
+        if node is None:
+            # 逐层找出第一个不存在的节点用于报错
+            path = (request_id, *ids)
+            depth = next(
+                depth
+                for depth in range(1, len(path) + 1)
+                if self._context_tree_node(*path[:depth]) is None
+            )
+            if depth == 1:
+                raise Exception(f"Request {request_id} not found in task tree.")
+            raise Exception(f"{path[depth - 1]} not found in {path[depth - 2]}.")
+
+        # 换成新的空列表，整棵子树一次摘除；路径索引中该子树下的节点随之失效
+        node[_CONTEXT_TREE_CHILDREN[len(ids)]] = []
+        self._forget_context_tree_nodes((request_id, *ids))
 
-        # 保存更新后的任务树
-        with open(self.CONTEXT_TREE_PATH, "w", encoding="utf-8") as f:
-            json.dump(context_tree, f, indent=4, ensure_ascii=False)
+        self._context_tree_dirty = True
 
     def capability_agents_processor(
         self, step: dict, cap_group: str, cap_agent_threads: dict
     ):
         """
-        能力agent执行任务，目前只考虑单个能力agent的情况
+        能力agent执行任务，step指定多个能力agent时按顺序执行（后面的agent可能依赖前面agent的操作），
+        以列表中最后一个agent的结果为准
         """
         cap_agents = step["agent"]  # 获取当前step指定的能力agent列表
+        step_message = fast_json.dumps(step)
+
         for agent_name in cap_agents:
             console.rule()
             print(f"{agent_name} EXECUTING {step['id']}...\n")
             # 获取该能力群下，指定能力agent的线程对象
             cap_agent_thread = cap_agent_threads[cap_group][agent_name]
             # 以json格式将step内容发给能力agent执行，获取返回结果
-            cap_agent_result = self.json_get_completion(
-                cap_agent_thread, json.dumps(step, ensure_ascii=False)
-            )
+            cap_agent_result = self.json_get_completion(cap_agent_thread, step_message)
             # 解析agent返回的结果（json字符串）
-            cap_agent_result_json = json.loads(cap_agent_result)
+            cap_agent_result_json = fast_json.loads(cap_agent_result)
         # 执行结果result和返回内容context
         result = cap_agent_result_json['result']
         context = cap_agent_result_json['context']
@@ -2507,45 +3233,40 @@ class Agency:
         overall_id: str,
         graph: Dict[str, Dict[str, Any]],
         completed_ids: List[str],
+        tracker: "_DependencyTracker" = None,
     ) -> List[str]:
         """
-        基于依赖关系进行代码级调度，返回下一个可执行的节点id列表
+        基于依赖关系进行代码级调度，返回下一个可执行的节点id列表。
+        同一个流程图多次调度时传入同一个tracker，每次只处理新完成的节点
         """
         console.rule()
         print(f"SCHEDULING {overall_id}...\n")
-        next_ids = []  # 待执行节点
-        completed_id_set = set(completed_ids)
-        for id_key, info in graph.items():
-            if id_key in completed_id_set:
-                continue  # 已完成节点直接跳过
-            deps = info.get("dep", [])
-            # 检查所有依赖的id是否都已完成
-            all_deps_met = all(dep_id in completed_id_set for dep_id in deps)
-            if all_deps_met:
-                next_ids.append(id_key)  # 依赖全部满足，加入待执行列表
-        print(
-            f"completed: {(', '.join([str(id)+' ('+graph[id]['title']+')' for id in completed_ids])) if completed_ids else 'none'}"
-        )
-        print(
-            f"scheduled: {(', '.join([str(id)+' ('+graph[id]['title']+')' for id in next_ids])) if next_ids else 'none'}"
-        )
-        pending_ids = []
-        for id_key in graph.keys():
-            if id_key not in completed_id_set and id_key not in next_ids:
-                pending_ids.append(id_key)
+        if tracker is None:
+            tracker = _DependencyTracker(graph)
+        next_ids = tracker.ready(completed_ids)  # 待执行节点
+        # 其余未完成的节点都在等待依赖
+        pending_ids = tracker.pending(next_ids)
+
+        def labels(ids):
+            return ", ".join(map(tracker.label, ids)) if ids else "none"
+
+        # 已完成节点的标签由tracker逐个追加，不必每次重新拼接
         print(
-            f"pending: {(', '.join([str(id)+' ('+graph[id]['title']+')' for id in pending_ids])) if pending_ids else 'none'}"
+            f"completed: {tracker.completed_text}\n"
+            f"scheduled: {labels(next_ids)}\n"
+            f"pending: {labels(pending_ids)}"
         )
         return next_ids  # 返回下一个可执行节点的id列表
 
-    def rag_flow(self, original_request: str, plan_num: str):
-        load_dotenv()
-        ragflow_api_key = os.getenv("RAGFLOW_API_KEY")
-        assistant_name = os.getenv("ASSISTANT_NAME")
-        session_name = os.getenv("SESSION_NAME")
+    def _ragflow_assistant(self) -> Chat:
+        """返回RAGFlow中的对话助手，客户端和助手只在首次使用时创建，之后各次请求复用"""
+        if self._ragflow_chat is None:
+            rag_object = RAGFlow(api_key=RAGFLOW_API_KEY, base_url="http://localhost:9222")
+            self._ragflow_chat = rag_object.list_chats(name=RAGFLOW_ASSISTANT_NAME)[0]
+        return self._ragflow_chat
 
-        rag_object = RAGFlow(api_key=ragflow_api_key, base_url="http://localhost:9222")
-        assistant = rag_object.list_chats(name=assistant_name)[0]
+    def rag_flow(self, original_request: str, plan_num: str):
+        assistant = self._ragflow_assistant()
         output_format = """
             {
                 "is_complete": "0"/"1"（注意带双引号）,
@@ -2616,14 +3337,20 @@ class Agency:
                 "prompt": instruction,
             },
         }
-        assistant.update(assistant_config)
+        # update是一次HTTP请求，只在配置变化时推送
+        cfg_hash = hashlib.blake2b(
+            fast_json.dumps(assistant_config).encode("utf-8")
+        ).hexdigest()
+        if cfg_hash != self._assistant_cfg_hash:
+            assistant.update(assistant_config)
+            self._assistant_cfg_hash = cfg_hash
 
         # ret=assistant.list_sessions(name=session_name)
         # if len(ret)==0:
         #     session = assistant.create_session(session_name)
         # else:
         #     session=assistant.list_sessions(name=session_name)[0]
-        session = assistant.create_session(session_name + " " + plan_num)
+        session = assistant.create_session(RAGFLOW_SESSION_NAME + " " + plan_num)
 
         message = original_request
         user_input = ""
@@ -2642,7 +3369,7 @@ class Agency:
             response = answer.content
             print("RAG generator:")
             print(response)  # Output content normally
-            dict_json = json.loads(response)
+            dict_json = fast_json.loads(response)
             if dict_json["is_complete"].strip() == "1":  # 关闭显示引文
                 return dict_json["response"], user_input
             elif dict_json["is_complete"].strip() == "0":
@@ -2675,6 +3402,13 @@ class Agency:
         """
         console.rule()
 
+        # 与cached_planning_layer相同：只有对用户原始请求的首次规划允许按相似度复用缓存结果
+        similar_text = (
+            original_request
+            if message == original_request and not error_message and not other_input
+            else None
+        )
+
         # 如果在之前的规划中rag环节获取到了用户输入的其他信息，将其拼接到original_request中
         if other_input != "":
             original_request = original_request + "\n其他信息：" + other_input
@@ -2682,8 +3416,7 @@ class Agency:
         print(f"{planner_thread.recipient_agent.name} PLANNING {overall_id}...\n")
         print(original_request)
 
-        use_rag = os.getenv("USE_RAG")
-        if use_rag=="True":
+        if USE_RAG:
             rag_response, user_input = self.rag_flow(original_request, plan_num)
             message = message + "\n请参考运维手册内容作答：\n" + rag_response
             other_input = other_input + user_input
@@ -2697,15 +3430,103 @@ class Agency:
             )
         # 发送message给planner agent线程，获取规划结果
         planmessage = self.json_get_completion(
-            planner_thread, message, original_request, inspector_thread
+            planner_thread,
+            message,
+            original_request,
+            inspector_thread,
+            similar_text=similar_text,
         )
         print(f"THREAD output:\n{planmessage}")
-        planmessage_json = json.loads(planmessage)
-        plan_json = {}
-        plan_json["main_task"] = original_request
-        plan_json["plan_graph"] = planmessage_json
+        # json_get_completion已确认planmessage是合法的json，直接嵌入scheduler输入，
+        # 不再解析后重新序列化；调用方解析流程图时只需解析一次
+        plan_json = (
+            '{"main_task":'
+            + fast_json.dumps(original_request)
+            + ',"plan_graph":'
+            + planmessage
+            + "}"
+        )
         # self.json2graph(planmessage, "TASK_PLAN", node_color)
-        return planmessage, json.dumps(plan_json, ensure_ascii=False), other_input
+        return planmessage, plan_json, other_input
+
+    def _index_graph(self, graph: str):
+        """
+        解析规划得到的流程图，返回(流程图, 节点id到节点的映射)
+        """
+        graph_json = fast_json.loads(graph)
+        return graph_json, {node["id"]: node for node in graph_json.values()}
+
+    def cached_planning_layer(
+        self,
+        message: str,
+        original_request: str,
+        planner_thread: Thread,
+        error_message: str = "",
+        **kwargs,
+    ):
+        """
+        带plan_cache的planning_layer。除planning_layer的三个返回值外，还返回plan_key（命中缓存时为
+        计划实际所在的key），该计划执行成功后用save_plan写入缓存，失败时用discard_plan删除。
+        """
+        if self.plan_cache is None:
+            return (
+                *self.planning_layer(
+                    message=message,
+                    original_request=original_request,
+                    planner_thread=planner_thread,
+                    error_message=error_message,
+                    **kwargs,
+                ),
+                None,
+            )
+
+        planner_name = planner_thread.recipient_agent.name
+        plan_key = self.plan_cache.make_key(planner_name, message, original_request)
+        # 出错后的重新规划必须参考错误信息，不使用缓存
+        if not error_message:
+            # 只有对用户原始请求的规划才按相似度匹配；任务、子任务的描述带有具体的id、名称和规格，
+            # 相似但参数不同的计划不能直接复用，只按精确key查找
+            cached = self.plan_cache.get(
+                plan_key,
+                scope=planner_name,
+                text=original_request if message == original_request else None,
+            )
+            if cached is not None:
+                console.rule()
+                print(f"{planner_name} PLAN CACHE HIT {kwargs.get('overall_id', '')}\n")
+                # 相似匹配命中时计划存放在另一个key下，执行失败时应删除的是这一条
+                plan_key, (plan, need_scheduled) = cached
+                # 命中缓存时没有与rag agent的新对话，累加输入保持不变
+                return plan, need_scheduled, kwargs.get("other_input", ""), plan_key
+
+        return (
+            *self.planning_layer(
+                message=message,
+                original_request=original_request,
+                planner_thread=planner_thread,
+                error_message=error_message,
+                **kwargs,
+            ),
+            plan_key,
+        )
+
+    def save_plan(self, plan_key, plan, need_scheduled, planner_thread, original_request=None):
+        """
+        缓存执行成功的计划。original_request只在对用户原始请求的规划时传入，用于之后的相似匹配
+        """
+        if self.plan_cache is None or plan_key is None:
+            return
+        self.plan_cache.set(
+            plan_key,
+            [plan, need_scheduled],
+            scope=planner_thread.recipient_agent.name,
+            text=original_request,
+        )
+
+    def discard_plan(self, plan_key):
+        if self.plan_cache is None or plan_key is None:
+            return
+        self.plan_cache.discard(plan_key)
 
     def task_optimizing_layer(
         self,
@@ -2780,17 +3601,59 @@ class Agency:
         message: str,
         inspector_request: str = None,
         inspector_thread: Thread = None,
+        similar_text: str = None,
     ):
         """
-        发送消息给某个agent线程并确保返回json格式，必要时通过inspector人工/自动检查
+        发送消息给某个agent线程并确保返回json格式，必要时通过inspector人工/自动检查。
+        agent在cached_agents中时，先查询response_cache，命中则不再请求agent。
+        默认只做精确匹配；similar_text只在对用户原始请求的规划时传入，允许语义相近的请求复用结果，
+        任务、子任务等消息带有具体的id和规格，相似但参数不同时不能复用
         """
+        agent = thread.recipient_agent
+        if self.response_cache is None or agent.name not in self.cached_agents:
+            return self._json_get_completion(
+                thread, message, inspector_request, inspector_thread
+            )
+
+        cache_key = self.response_cache.make_key(
+            agent.name, agent.model, agent.instructions, message, inspector_request
+        )
+        # temperature为0时输出确定，只做精确匹配
+        if not agent.temperature:
+            similar_text = None
+        result = self.response_cache.get(cache_key, scope=agent.name, text=similar_text)
+        if result is not None:
+            print(f"{agent.name} RESPONSE CACHE HIT\n")
+            return result
+
+        result = self._json_get_completion(
+            thread, message, inspector_request, inspector_thread
+        )
+        if result != _EMPTY_JSON:
+            self.response_cache.set(cache_key, result, scope=agent.name, text=similar_text)
+        return result
+
+    def _json_get_completion(
+        self,
+        thread: Thread,
+        message: str,
+        inspector_request: str = None,
+        inspector_thread: Thread = None,
+    ):
+        # agent可能通过ReadJsonFile读取任务树和错误记录，请求前先写回最新的修改
+        self.flush_context_tree()
+        self.flush_errors()
+
         flag = False
         count_flag_false = 0
         original_message = message
         while True:
             # 1. 先请求一次agent输出
+            agent_name = thread.recipient_agent.name
+            self._log_event(agent_name, "user", message)
             res = thread.get_completion(message=message, response_format="auto")
             response_information = self.my_get_completion(res)
+            self._log_event(agent_name, "assistant", response_information)
 
             # 2. 尝试从返回内容解析json
             flag, result = self.get_json_from_str(message=response_information)
@@ -2813,7 +3676,7 @@ class Agency:
                 if count_flag_false <= 3:
                     continue
                 else:
-                    return json.dumps({})
+                    return _EMPTY_JSON
 
             # 3. 如果有inspector，需额外走一轮人工/自动审核
             if inspector_thread is not None:
@@ -2827,18 +3690,22 @@ class Agency:
                 if flag == True:
                     inspect_query = {
                         "user_request": inspector_request,
-                        "task_graph": json.loads(result),
+                        "task_graph": fast_json.loads(result),
                     }
                 else:
                     inspect_query = {
                         "user_request": inspector_request,
                         "task_graph": result,
                     }
+                inspector_name = inspector_thread.recipient_agent.name
+                inspect_message = fast_json.dumps(inspect_query)
+                self._log_event(inspector_name, "user", inspect_message)
                 inspector_res = inspector_thread.get_completion(
-                    message=json.dumps(inspect_query, ensure_ascii=False),
+                    message=inspect_message,
                     response_format="auto",
                 )
                 inspector_result = self.my_get_completion(inspector_res)
+                self._log_event(inspector_name, "assistant", inspector_result)
                 print(inspector_result)
                 __ = self.get_inspector_review(inspector_result)
                 # 如果需要人工审核，由用户决定
@@ -2872,12 +3739,19 @@ class Agency:
             # 4. 没有inspector直接返回
             return result
 
+    def _log_event(self, agent_name: str, role: str, content):
+        """
+        把一条对话消息交给event_callback记录（未设置时什么都不做）
+        """
+        if self.event_callback is not None:
+            self.event_callback(agent_name, role, content)
+
     def get_inspector_review(self, message: str):
         """
         检查inspector给的结果是否通过（review为YES即通过）
         """
         try:
-            json_res = json.loads(message)
+            json_res = fast_json.loads(message)
             return json_res["review"] == "YES"
         except:
             yes_str = "YES"
@@ -2908,7 +3782,7 @@ class Agency:
 
         # 1. 尝试直接解析
         try:
-            json_res = json.loads(message)
+            json_res = fast_json.loads(message)
             return True, message
         except json.decoder.JSONDecodeError:
             pass
@@ -2917,7 +3791,7 @@ class Agency:
         if match:
             json_str = match.group(1)
             try:
-                json_res = json.loads(json_str)
+                json_res = fast_json.loads(json_str)
                 return True, json_str
             except Exception:
                 return False, json_str
@@ -2928,11 +3802,7 @@ class Agency:
         """
         消耗生成器res，返回其最终返回值（即StopIteration.value）
         """
-        while True:
-            try:
-                next(res)
-            except StopIteration as e:
-                return e.value
+        return _drain_generator(res)
 
     def langgraph_test(self, repeater: Agent, rander: Agent, palindromist: Agent):
         from typing import Annotated
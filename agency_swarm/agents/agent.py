@@ -2,12 +2,13 @@ import copy
 import inspect
 import json
 import os
+import threading
 from typing import Any, Dict, List, Literal, Optional, Type, TypedDict, Union
 
 from deepdiff import DeepDiff
 from openai import NotFoundError
 from openai.lib._parsing._completions import type_to_response_format_param
-from openai.types.beta.assistant import ToolResources
+from openai.types.beta.assistant import Assistant, ToolResources
 
 from agency_swarm.tools import (
     BaseTool,
@@ -21,6 +22,9 @@ from agency_swarm.util.oai import get_openai_client
 from agency_swarm.util.openapi import validate_openapi_spec
 from agency_swarm.util.shared_state import SharedState
 
+# Agency会并发执行各agent的init_oai，settings.json的读-改-写需要串行
+_settings_lock = threading.Lock()
+
 
 class ExampleMessage(TypedDict):
     role: Literal["user", "assistant"]
@@ -256,31 +260,43 @@ class Agent:
 
         # load assistant from settings
         if os.path.exists(path):
-            with open(path, "r") as f:
-                settings = json.load(f)
-                # iterate settings and find the assistant with the same name
-                for assistant_settings in settings:
-                    if assistant_settings["name"] == self.name:
-                        try:
-                            self.assistant = self.client.beta.assistants.retrieve(
-                                assistant_settings["id"]
+            with _settings_lock:
+                with open(path, "r") as f:
+                    settings = json.load(f)
+            # iterate settings and find the assistant with the same name
+            for assistant_settings in settings:
+                if assistant_settings["name"] == self.name:
+                    # trust the saved settings when nothing changed locally, skipping the retrieve round trip
+                    if os.getenv("TRUST_LOCAL_SETTINGS") == "True" and self._check_parameters(
+                        copy.deepcopy(assistant_settings)
+                    ):
+                        self.assistant = Assistant.model_validate(assistant_settings)
+                        self.id = assistant_settings["id"]
+                        if self.assistant.tool_resources:
+                            self.tool_resources = (
+                                self.assistant.tool_resources.model_dump()
                             )
-                            self.id = assistant_settings["id"]
+                        return self
+                    try:
+                        self.assistant = self.client.beta.assistants.retrieve(
+                            assistant_settings["id"]
+                        )
+                        self.id = assistant_settings["id"]
 
-                            # update assistant if parameters are different
-                            if not self._check_parameters(self.assistant.model_dump()):
-                                print("Updating agent... " + self.name)
-                                self._update_assistant()
+                        # update assistant if parameters are different
+                        if not self._check_parameters(self.assistant.model_dump()):
+                            print("Updating agent... " + self.name)
+                            self._update_assistant()
 
-                            if self.assistant.tool_resources:
-                                self.tool_resources = (
-                                    self.assistant.tool_resources.model_dump()
-                                )
+                        if self.assistant.tool_resources:
+                            self.tool_resources = (
+                                self.assistant.tool_resources.model_dump()
+                            )
 
-                            self._update_settings()
-                            return self
-                        except NotFoundError:
-                            continue
+                        self._update_settings()
+                        return self
+                    except NotFoundError:
+                        continue
 
         # create assistant if settings.json does not exist or assistant with the same name does not exist
         params = {
@@ -769,31 +785,33 @@ class Agent:
 
     def _save_settings(self):
         path = self.get_settings_path()
-        # check if settings.json exists
-        if not os.path.isfile(path):
-            with open(path, "w") as f:
-                json.dump([self.assistant.model_dump()], f, indent=4)
-        else:
-            settings = []
-            with open(path, "r") as f:
-                settings = json.load(f)
-                settings.append(self.assistant.model_dump())
-            with open(path, "w") as f:
-                json.dump(settings, f, indent=4)
+        with _settings_lock:
+            # check if settings.json exists
+            if not os.path.isfile(path):
+                with open(path, "w") as f:
+                    json.dump([self.assistant.model_dump()], f, indent=4)
+            else:
+                settings = []
+                with open(path, "r") as f:
+                    settings = json.load(f)
+                    settings.append(self.assistant.model_dump())
+                with open(path, "w") as f:
+                    json.dump(settings, f, indent=4)
 
     def _update_settings(self):
         path = self.get_settings_path()
-        # check if settings.json exists
-        if os.path.isfile(path):
-            settings = []
-            with open(path, "r") as f:
-                settings = json.load(f)
-                for i, assistant_settings in enumerate(settings):
-                    if assistant_settings["id"] == self.id:
-                        settings[i] = self.assistant.model_dump()
-                        break
-            with open(path, "w") as f:
-                json.dump(settings, f, indent=4)
+        with _settings_lock:
+            # check if settings.json exists
+            if os.path.isfile(path):
+                settings = []
+                with open(path, "r") as f:
+                    settings = json.load(f)
+                    for i, assistant_settings in enumerate(settings):
+                        if assistant_settings["id"] == self.id:
+                            settings[i] = self.assistant.model_dump()
+                            break
+                with open(path, "w") as f:
+                    json.dump(settings, f, indent=4)
 
     # --- Helper Methods ---
 
@@ -876,7 +894,8 @@ class Agent:
             return os.path.abspath(os.path.realpath(os.path.dirname(class_file)))
 
     def add_shared_instructions(self, instructions: str):
-        if not instructions:
+        # a blank manifesto would only shift the instructions and break the cached prompt prefix
+        if not instructions or not instructions.strip():
             return
 
         if self._shared_instructions is None:
@@ -925,14 +944,15 @@ class Agent:
 
     def _delete_settings(self):
         path = self.get_settings_path()
-        # check if settings.json exists
-        if os.path.isfile(path):
-            settings = []
-            with open(path, "r") as f:
-                settings = json.load(f)
-                for i, assistant_settings in enumerate(settings):
-                    if assistant_settings["id"] == self.id:
-                        settings.pop(i)
-                        break
-            with open(path, "w") as f:
-                json.dump(settings, f, indent=4)
+        with _settings_lock:
+            # check if settings.json exists
+            if os.path.isfile(path):
+                settings = []
+                with open(path, "r") as f:
+                    settings = json.load(f)
+                    for i, assistant_settings in enumerate(settings):
+                        if assistant_settings["id"] == self.id:
+                            settings.pop(i)
+                            break
+                with open(path, "w") as f:
+                    json.dump(settings, f, indent=4)
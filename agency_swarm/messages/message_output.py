@@ -137,6 +137,8 @@ class MessageOutput:
 
 class MessageOutputLive(MessageOutput):
     live_display = None
+    # 最近一次渲染到终端的内容
+    _rendered_content = None
 
     def __init__(
         self,
@@ -162,6 +164,10 @@ class MessageOutputLive(MessageOutput):
         Update the display with new snapshot content.
         """
         self.content = snapshot  # Update content with the latest snapshot
+        # 内容没有变化时（如工具调用delta只改变了id等字段）跳过重新渲染Markdown
+        if snapshot == self._rendered_content:
+            return
+        self._rendered_content = snapshot
 
         header_text = self.formatted_header
         md_content = Markdown(self.content)
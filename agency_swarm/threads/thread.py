@@ -3,6 +3,7 @@ import inspect
 import json
 import os
 import re
+import threading
 import time
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -50,6 +51,8 @@ class Thread:
         self._stream = None
 
         self._num_run_retries = 0
+        # 同一个Thread同时只能有一个run，由调用方持有该锁来串行化
+        self._run_lock = threading.Lock()
         # names of recepient agents that were called in SendMessage tool
         # needed to prevent agents calling the same recepient agent multiple times
         self._called_recepients = []
@@ -1,3 +1,4 @@
+from .cache import PlanCache, ResponseCache
 from .cli.create_agent_template import create_agent_template
 from .cli.import_agent import import_agent
 from .files import get_file_purpose, get_tools
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, List, NamedTuple, Optional
+
+from .oai import get_openai_client
+
+
+class _CacheEntry(NamedTuple):
+    expires_at: float
+    scope: Optional[str]
+    embedding: Optional[List[float]]
+    value: Any
+
+
+def _cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def openai_embedder(
+    model: str = "text-embedding-3-small",
+) -> Callable[[str], List[float]]:
+    """Returns an embedding function backed by the shared OpenAI client."""
+
+    def embed(text: str) -> List[float]:
+        return (
+            get_openai_client()
+            .embeddings.create(model=model, input=text)
+            .data[0]
+            .embedding
+        )
+
+    return embed
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache for LLM responses.
+
+    Lookups first try an exact sha256 key. When an ``embed`` function is given and the caller passes the
+    prompt text, a miss falls back to the most similar cached prompt within the same scope, returned only
+    if its cosine similarity reaches ``similarity_threshold``. Entries expire after ``ttl`` seconds.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: float = 3600,
+        embed: Callable[[str], List[float]] = None,
+        similarity_threshold: float = 0.92,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+        self._entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        # get() 中计算的向量，留给随后的 set() 复用，避免重复请求embedding
+        self._pending_embeddings = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str, scope: str = None, text: str = None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.expires_at > now:
+                    self._entries.move_to_end(key)
+                    return entry.value
+                del self._entries[key]
+
+        if self.embed is None or text is None:
+            return None
+
+        embedding = self.embed(text)
+        best_key, best_score = None, self.similarity_threshold
+        with self._lock:
+            # 请求失败时不会调用set()，限制暂存向量的数量
+            if len(self._pending_embeddings) >= self.maxsize:
+                self._pending_embeddings.clear()
+            self._pending_embeddings[key] = embedding
+            for entry_key, entry in self._entries.items():
+                if (
+                    entry.scope != scope
+                    or entry.embedding is None
+                    or entry.expires_at <= now
+                ):
+                    continue
+                score = _cosine_similarity(embedding, entry.embedding)
+                if score >= best_score:
+                    best_key, best_score = entry_key, score
+            if best_key is None:
+                return None
+            self._entries.move_to_end(best_key)
+            return self._entries[best_key].value
+
+    def set(self, key: str, value, scope: str = None, text: str = None):
+        with self._lock:
+            embedding = self._pending_embeddings.pop(key, None)
+        if embedding is None and self.embed is not None and text is not None:
+            embedding = self.embed(text)
+
+        with self._lock:
+            self._entries[key] = _CacheEntry(
+                time.monotonic() + self.ttl, scope, embedding, value
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pending_embeddings.clear()
+
+
+class PlanCache:
+    """
+    Persistent cache of plans that were executed successfully, stored in a SQLite file.
+
+    Plans are looked up by an exact sha256 key first. When an ``embed`` function is given and the caller
+    passes the request text, a miss falls back to the most similar cached request within the same scope,
+    returned only if its cosine similarity reaches ``similarity_threshold``. ``get`` returns the key the
+    plan is stored under together with the plan, so a plan found by similarity can be discarded. Entries
+    expire after ``ttl`` seconds; beyond ``maxsize`` entries the least recently used ones are evicted.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        maxsize: int = 1000,
+        ttl: float = 7 * 24 * 3600,
+        embed: Callable[[str], List[float]] = None,
+        similarity_threshold: float = 0.9,
+    ):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS plans ("
+                "key TEXT PRIMARY KEY, scope TEXT, embedding TEXT, value TEXT, "
+                "expires_at REAL, hits INTEGER DEFAULT 0, last_used INTEGER DEFAULT 0)"
+            )
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(plans)")}
+            # 早期版本创建的缓存文件没有last_used列
+            if "last_used" not in columns:
+                self._db.execute(
+                    "ALTER TABLE plans ADD COLUMN last_used INTEGER DEFAULT 0"
+                )
+
+    make_key = staticmethod(ResponseCache.make_key)
+
+    def get(self, key: str, scope: str = None, text: str = None):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM plans WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+        if row is None and self.embed is not None and text is not None:
+            embedding = self.embed(text)
+            best_key, best_score = None, self.similarity_threshold
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT key, embedding FROM plans "
+                    "WHERE scope IS ? AND embedding IS NOT NULL AND expires_at > ?",
+                    (scope, now),
+                ).fetchall()
+            for entry_key, entry_embedding in rows:
+                score = _cosine_similarity(embedding, json.loads(entry_embedding))
+                if score >= best_score:
+                    best_key, best_score = entry_key, score
+            if best_key is None:
+                return None
+            key = best_key
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT value FROM plans WHERE key = ?", (key,)
+                ).fetchone()
+        if row is None:
+            return None
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE plans SET hits = hits + 1, "
+                "last_used = (SELECT MAX(last_used) + 1 FROM plans) WHERE key = ?",
+                (key,),
+            )
+        return key, json.loads(row[0])
+
+    def set(self, key: str, value, scope: str = None, text: str = None):
+        embedding = None
+        if self.embed is not None and text is not None:
+            embedding = json.dumps(self.embed(text))
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO plans "
+                "(key, scope, embedding, value, expires_at, last_used) VALUES "
+                "(?, ?, ?, ?, ?, (SELECT COALESCE(MAX(last_used), 0) + 1 FROM plans))",
+                (
+                    key,
+                    scope,
+                    embedding,
+                    json.dumps(value, ensure_ascii=False),
+                    now + self.ttl,
+                ),
+            )
+            self._db.execute("DELETE FROM plans WHERE expires_at <= ?", (now,))
+            # 超出容量时淘汰最久未使用的计划。last_used是每次写入、命中时递增的序号，不依赖时钟精度，
+            # 刚写入的计划序号最大，不会被淘汰
+            self._db.execute(
+                "DELETE FROM plans WHERE key IN ("
+                "SELECT key FROM plans ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.maxsize,),
+            )
+
+    def discard(self, key: str):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM plans WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM plans")
@@ -0,0 +1,26 @@
+import json
+
+try:
+    import orjson
+
+    # orjson 只接受标准JSON，解析失败时抛出的 JSONDecodeError 是 json.JSONDecodeError 的子类
+    loads = orjson.loads
+
+    def dumps(obj):
+        """Serializes obj to a compact str; non-ASCII characters are kept as is."""
+        return orjson.dumps(obj).decode("utf-8")
+
+    def dumps_indented(obj):
+        """Serializes obj to a str indented by two spaces, for files that people may open."""
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode("utf-8")
+
+except ImportError:
+    loads = json.loads
+
+    def dumps(obj):
+        """Serializes obj to a compact str; non-ASCII characters are kept as is."""
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+    def dumps_indented(obj):
+        """Serializes obj to a str indented by two spaces, for files that people may open."""
+        return json.dumps(obj, ensure_ascii=False, indent=2)
@@ -1,4 +1,6 @@
+import functools
 import mimetypes
+from pathlib import PurePath
 
 # Register the MIME type for .xlsx files
 mimetypes.add_type(
@@ -51,8 +53,18 @@ dual_types = [
 ]
 
 
+@functools.lru_cache(maxsize=256)
+def _guess_mime_type(suffixes):
+    return mimetypes.guess_type("file" + suffixes)[0]
+
+
+def _mime_type(file_path):
+    """Guesses the MIME type from the file extension, cached per (lowercased) extension."""
+    return _guess_mime_type("".join(PurePath(file_path).suffixes).lower())
+
+
 def get_file_purpose(file_path):
-    mime_type, _ = mimetypes.guess_type(file_path)
+    mime_type = _mime_type(file_path)
     if not mime_type:
         raise ValueError(f"Could not determine type for file: {file_path}")
     if mime_type in image_types:
@@ -64,7 +76,7 @@ def get_file_purpose(file_path):
 
 def get_tools(file_path):
     """Returns the tools for the given file path"""
-    mime_type, _ = mimetypes.guess_type(file_path)
+    mime_type = _mime_type(file_path)
     if not mime_type:
         raise ValueError(f"Could not determine type for file: {file_path}")
     if mime_type in code_interpreter_types:
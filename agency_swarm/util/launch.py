@@ -0,0 +1,45 @@
+import atexit
+import os
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# 并发创建agent的最大线程数
+CREATE_AGENT_WORKERS = 8
+
+
+def create_agents(*modules, max_workers=CREATE_AGENT_WORKERS):
+    """Calls ``create_agent()`` on every module concurrently and returns the agents in the same order.
+
+    Agent construction reads instruction files, parses tool folders and may upload files, so the calls
+    are I/O bound and independent of each other.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda module: module.create_agent(), modules))
+
+
+def close_on_exit(*logs):
+    """Makes sure the given run logs are drained and closed however the process ends.
+
+    The logs are closed from an ``atexit`` hook (``RunLog.close`` is idempotent), and SIGTERM is turned
+    into ``sys.exit(0)`` so the ``with`` blocks and the hook run instead of the process being killed.
+    ``sys.exit`` only unwinds the main thread, so the planning loop has to run there and background
+    pools have to be stopped (``Agency.shutdown``) before the logs are closed. Must be called from the
+    main thread.
+    """
+    for log in logs:
+        atexit.register(log.close)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+
+def notify_done():
+    """Signals the end of a run with a single beep. Set NO_BEEP=1 to disable it."""
+    if os.getenv("NO_BEEP") == "1":
+        return
+    if sys.platform == "win32":
+        import winsound
+
+        winsound.MessageBeep(winsound.MB_ICONEXCLAMATION)
+    elif sys.__stdout__ is not None:
+        sys.__stdout__.write("\a")
+        sys.__stdout__.flush()
@@ -5,11 +5,45 @@ import httpx
 import openai
 from dotenv import load_dotenv
 
+from .rate_limit import RateLimiter
+
 load_dotenv()
 
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
 client_lock = threading.Lock()
 client = None
 
+# process-wide caps on in-flight requests and requests per minute, shared by every agent
+MAX_CONCURRENT_REQUESTS = int(os.getenv("OPENAI_MAX_CONCURRENT_REQUESTS", "8"))
+REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "3500"))
+
+
+class RateLimitedClient(openai.DefaultHttpxClient):
+    """HTTP client that waits for a concurrency slot and a rate-limit token before sending each request.
+
+    The limits are applied in ``send`` rather than in a custom transport, so httpx still builds its own
+    transports, including the ones for ``HTTP(S)_PROXY``/``ALL_PROXY`` from the environment. Connection
+    pool limits and redirect handling keep openai's defaults (``DefaultHttpxClient``).
+    """
+
+    def __init__(
+        self, max_concurrent_requests: int, requests_per_minute: int, **kwargs
+    ):
+        super().__init__(**kwargs)
+        self._semaphore = threading.BoundedSemaphore(max_concurrent_requests)
+        self._rate_limiter = RateLimiter(requests_per_minute, 60.0)
+
+    def send(self, request, **kwargs):
+        with self._semaphore:
+            self._rate_limiter.acquire()
+            return super().send(request, **kwargs)
+
 
 def get_openai_client():
     global client
@@ -27,6 +61,12 @@ def get_openai_client():
                 timeout=httpx.Timeout(600.0),
                 max_retries=10,
                 default_headers={"OpenAI-Beta": "assistants=v2"},
+                http_client=RateLimitedClient(
+                    MAX_CONCURRENT_REQUESTS,
+                    REQUESTS_PER_MINUTE,
+                    http2=HTTP2_AVAILABLE,
+                    timeout=httpx.Timeout(600.0),
+                ),
             )
     return client
 
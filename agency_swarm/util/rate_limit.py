@@ -0,0 +1,28 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """Thread-safe token bucket allowing ``rate`` acquisitions per ``period`` seconds."""
+
+    def __init__(self, rate: float, period: float = 60.0):
+        self.capacity = rate
+        self._tokens = rate
+        self._fill_rate = rate / period
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens + (now - self._updated) * self._fill_rate,
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._fill_rate
+            time.sleep(wait)
@@ -0,0 +1,159 @@
+import io
+import json
+import queue
+import threading
+import time
+from datetime import datetime
+
+try:
+    import orjson
+
+    def _dumps_line(obj):
+        return orjson.dumps(obj).decode("utf-8") + "\n"
+
+except ImportError:
+
+    def _dumps_line(obj):
+        return json.dumps(obj, ensure_ascii=False) + "\n"
+
+
+# 日志文件的块缓冲大小
+LOG_BUFFER_SIZE = 1 << 16
+# 后台写线程定期落盘的间隔（秒），崩溃时最多丢失这段时间内的日志
+LOG_FLUSH_INTERVAL = 0.5
+
+# 后台写线程的控制消息
+_FLUSH = object()
+_CLOSE = object()
+
+
+class RunLog:
+    """File-like run log whose writes are handed to a background thread.
+
+    ``write`` only enqueues the text, so threads printing streamed output never wait on disk I/O.
+    The writer thread owns the block-buffered file, flushes it at most ``LOG_FLUSH_INTERVAL`` seconds
+    after the first unflushed write, and closes it after draining the queue.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.closed = False
+        self._queue = queue.SimpleQueue()
+        self._file = open(path, "w", encoding="utf-8", buffering=LOG_BUFFER_SIZE)
+        self._writer = threading.Thread(
+            target=self._write_loop, name="run-log-writer", daemon=True
+        )
+        self._writer.start()
+
+    def write(self, message):
+        self._queue.put(message)
+        return len(message)
+
+    def flush(self):
+        self._queue.put(_FLUSH)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.put(_CLOSE)
+        self._writer.join()
+
+    def _write_loop(self):
+        file = self._file
+        get = self._queue.get
+        dirty = False
+        flush_at = time.monotonic() + LOG_FLUSH_INTERVAL
+        while True:
+            try:
+                message = get(
+                    timeout=max(flush_at - time.monotonic(), 0) if dirty else None
+                )
+            except queue.Empty:
+                message = _FLUSH
+            if message is _CLOSE:
+                break
+            if message is _FLUSH:
+                file.flush()
+                dirty = False
+                continue
+            file.write(message)
+            if not dirty:
+                dirty = True
+                flush_at = time.monotonic() + LOG_FLUSH_INTERVAL
+            elif time.monotonic() >= flush_at:
+                file.flush()
+                dirty = False
+        file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_run_log(path):
+    """Opens a run log that is written by a background thread."""
+    return RunLog(path)
+
+
+def event_logger(log):
+    """Returns a ``log_event(agent, role, content)`` callback that appends one JSON line per event to ``log``.
+
+    Each message is serialized once and handed to the log as a single line, so the transcript can be
+    tailed or parsed while the run is still going.
+    """
+    write = log.write
+
+    def log_event(agent, role, content):
+        write(
+            _dumps_line(
+                {
+                    "ts_ns": time.time_ns(),
+                    "agent": agent,
+                    "role": role,
+                    "content": content,
+                }
+            )
+        )
+
+    return log_event
+
+
+def event_time(event):
+    """Converts the ``ts_ns`` of a logged event to a datetime; only needed when rendering the log."""
+    return datetime.fromtimestamp(event["ts_ns"] / 1e9)
+
+
+class TeeOutput(io.TextIOBase):
+    """Writes stdout to both the terminal and a log file.
+
+    The terminal is written through immediately so streaming output stays interactive, while the
+    log file is left to flush on its own schedule.
+    """
+
+    def __init__(self, file, terminal):
+        self.file = file
+        self.terminal = terminal
+        self._file_write = file.write
+        self._terminal_write = terminal.write
+
+    def write(self, message):
+        self._terminal_write(message)
+        self._file_write(message)
+        return len(message)
+
+    def flush(self):
+        # 只刷新终端，日志文件由后台写线程定期落盘
+        self.terminal.flush()
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return self.terminal.isatty()
+
+    @property
+    def encoding(self):
+        return self.terminal.encoding
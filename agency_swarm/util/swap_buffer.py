@@ -0,0 +1,61 @@
+import threading
+from collections import deque
+
+
+class SwapBuffer:
+    """Multi-producer, single-consumer buffer that hands over everything pushed since the last drain.
+
+    Items live in a ``collections.deque`` whose ``append``/``popleft`` are atomic. A push is an append
+    plus, only when the consumer is idle, an ``Event.set``, so pushes during a burst take no lock.
+    The consumer takes all pending items in one drain, so a burst of streamed tokens costs one
+    wake-up instead of one per item. At most ``maxsize`` items are held: when the consumer lags,
+    producers wait for the next drain instead of growing memory.
+
+    Control state that only matters in its latest version goes through ``put_control`` instead: it
+    occupies a single slot that newer values overwrite, and the consumer reads it with ``take_control``.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._items = deque()
+        self._ready = threading.Event()
+        self._not_full = threading.Event()
+        self._not_full.set()
+        # 只保留最新的一条控制消息，append/pop都是原子操作
+        self._control = deque(maxlen=1)
+
+    def push(self, item):
+        items = self._items
+        while len(items) >= self.maxsize:
+            self._not_full.clear()
+            # 清除后再检查一次，避免错过消费端在此期间发出的通知
+            if len(items) >= self.maxsize:
+                self._not_full.wait()
+        items.append(item)
+        # Event.set()内部要获取Condition锁；已处于set状态时跳过，稳态下push完全不加锁。
+        # item在检查之前已经入队，而消费端先clear再取数据，所以不会丢失唤醒
+        if not self._ready.is_set():
+            self._ready.set()
+
+    def drain(self, timeout=None):
+        """Blocks until at least one item is available (or timeout expires) and returns all pending items."""
+        self._ready.wait(timeout)
+        # 先清除再取数据：取数据期间新到的item会重新set，不会丢失唤醒
+        self._ready.clear()
+        popleft = self._items.popleft
+        batch = [popleft() for _ in range(len(self._items))]
+        self._not_full.set()
+        return batch
+
+    def put_control(self, kind, payload=None):
+        """Replaces any pending control message with ``(kind, payload)`` and wakes the consumer."""
+        self._control.append((kind, payload))
+        if not self._ready.is_set():
+            self._ready.set()
+
+    def take_control(self):
+        """Returns the latest pending control message, or None. Call it after ``drain``."""
+        try:
+            return self._control.pop()
+        except IndexError:
+            return None
@@ -1,186 +1,172 @@
-from agency_swarm import Agent, Agency
-
-from agents.k8s_group_agents.task_planner import (
-    task_planner, task_scheduler, task_inspector
-)
-from agents.k8s_group_agents.subtask_planner import (
-    subtask_planner, subtask_scheduler, subtask_inspector
-)
-
-from agents.k8s_group_agents.comprehensive_group import(
-    comprehensive_planner, comprehensive_step_scheduler
-)
-
-from agents.k8s_group_agents.pod_manage_group import (
-    pod_manage_planner, pod_manage_step_scheduler
-)
-
-from agents.k8s_group_agents.pod_orchestration_scheduling_group import (
-    pod_orchestration_scheduling_planner,pod_orchestration_scheduling_step_scheduler
-)
-
-from agents.k8s_group_agents.config_manage_group import (
-    config_manage_planner, config_manage_step_scheduler
-)
-
-from agents.k8s_group_agents.monitor_group import (
-    monitor_planner, monitor_step_scheduler
-)
-
-from agents.k8s_group_agents.software_manage_group import (
-    software_manage_planner, software_manage_step_scheduler
-)
-
-from agents.k8s_group_agents.storage_group import (
-    storage_planner, storage_step_scheduler
-)
-
-from agents.k8s_group_agents import step_inspector
-
-from agents.k8s_group_agents.comprehensive_group.file_io_agent import file_io_agent
-from agents.k8s_group_agents.comprehensive_group.text_output_agent import text_output_agent
-
-from agents.k8s_group_agents.pod_manage_group.pod_manage_agent import pod_manage_agent
-from agents.k8s_group_agents.pod_manage_group.resource_grouping_agent import resource_grouping_agent
-
-from agents.k8s_group_agents.pod_orchestration_scheduling_group.stateful_workload_manage_agent import stateful_workload_manage_agent
-from agents.k8s_group_agents.pod_orchestration_scheduling_group.stateless_workload_manage_agent import stateless_workload_manage_agent
-from agents.k8s_group_agents.pod_orchestration_scheduling_group.task_manage_agent import task_manage_agent
-from agents.k8s_group_agents.pod_orchestration_scheduling_group.daemonSet_manage_agent import daemonSet_manage_agent
-from agents.k8s_group_agents.pod_orchestration_scheduling_group.affinity_antiAffinity_scheduling_agent import affinity_antiAffinity_scheduling_agent
-
-from agents.k8s_group_agents.config_manage_group.env_config_manage_agent import env_config_manage_agent
-from agents.k8s_group_agents.config_manage_group.privacy_manage_agent import privacy_manage_agent
-
-
-from agents.k8s_group_agents.storage_group.pv_agent import pv_agent
-from agents.k8s_group_agents.storage_group.pvc_agent import pvc_agent
-from agents.k8s_group_agents.storage_group.storageclass_agent import storageclass_agent
-from agents.k8s_group_agents.storage_group.csi_agent import csi_agent
-from agents.k8s_group_agents.storage_group.emptydir_agent import emptydir_agent
-from agents.k8s_group_agents.storage_group.hostpath_agent import hostpath_agent
-from agents.k8s_group_agents.storage_group.disk_agent import disk_agent
-
-from agents.k8s_group_agents.monitor_group.monitor_configuration_agent import monitor_configuration_agent
-from agents.k8s_group_agents.monitor_group.monitor_observe_agent import monitor_observe_agent
-from agents.k8s_group_agents.monitor_group.flexible_strategy_manage_agent import flexible_strategy_manage_agent
-
-
-from agents.k8s_group_agents.software_manage_group.software_config_modify_agent import software_config_modify_agent
-from agents.k8s_group_agents.software_manage_group.software_install_agent import software_install_agent
-from agents.k8s_group_agents.software_manage_group.software_monitor_agent import software_monitor_agent
-from agents.k8s_group_agents.software_manage_group.stress_test_agent import stress_test_agent
-
-from agents.k8s_group_agents.vm_group.kubeadm_agent import kubeadm_agent
-from agents.k8s_group_agents.vm_group.status_agent import status_agent
-from agents.k8s_group_agents.vm_group.package_agent import package_agent
-
-from agents.k8s_group_agents import check_log_agent
-
-from agents.k8s_group_agents.tools.ExecuteCommand import ExecuteCommand
-
-
-from agency_swarm import set_openai_key
-
-from dotenv import load_dotenv
+import datetime
 import os
 import sys
-import datetime
+from contextlib import ExitStack, redirect_stdout
 
-from agents.k8s_group_agents.vm_group import vm_planner, vm_step_scheduler
+from dotenv import load_dotenv
 
 load_dotenv()
-set_openai_key(os.getenv('OPENAI_API_KEY'))
+# 在加载agency_swarm及各agent模块之前检查API key，缺失时立即退出
+if not os.getenv('OPENAI_API_KEY'):
+    sys.exit("OPENAI_API_KEY not set")
+
+from agency_swarm import Agency, Agent, set_openai_key
+from agency_swarm.util.launch import close_on_exit, create_agents, notify_done
+from agency_swarm.util.run_log import TeeOutput, event_logger, open_run_log
+
+set_openai_key(os.environ['OPENAI_API_KEY'])
 
 def main():
     # 添加日志功能：创建一个日志文件，用当前时间作为文件名
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    log_file_path = os.path.join("log", f"run_log_{timestamp}.txt")
-    # 创建日志文件
-    log_file = open(log_file_path, 'w', encoding='utf-8', buffering=1)
-    
-    # 创建自定义的输出类，同时将输出发送到文件和终端
-    class TeeOutput:
-        def __init__(self, file, terminal):
-            self.file = file
-            self.terminal = terminal
-            
-        def write(self, message):
-            self.terminal.write(message)
-            self.file.write(message)
-            
-        def flush(self):
-            self.terminal.flush()
-            self.file.flush()
-    
-    # 保存原始的stdout，并设置新的输出重定向
-    original_stdout = sys.stdout
-    sys.stdout = TeeOutput(log_file, original_stdout)
-    
-    try:
+    # 确保日志目录存在，首次运行时log目录可能还未创建
+    os.makedirs("log", exist_ok=True)
+    run_id = f"{datetime.datetime.now():%Y%m%d_%H%M%S}"
+    log_file_path = os.path.join("log", f"run_log_{run_id}.txt")
+    # 每条agent消息以一行JSON追加写入，运行中即可tail/解析
+    event_log_path = os.path.join("log", f"events_{run_id}.jsonl")
+    with ExitStack() as stack:
+        # 退出时按注册的逆序执行：恢复stdout、关闭日志文件，然后响铃并提示日志路径
+        stack.callback(print, f"日志已保存到：{log_file_path}")
+        stack.callback(notify_done)
+        # 创建日志文件，并将输出同时重定向到文件和终端
+        log_file = stack.enter_context(open_run_log(log_file_path))
+        event_log = stack.enter_context(open_run_log(event_log_path))
+        # 被中断或收到SIGTERM时也保证日志写完并关闭
+        close_on_exit(log_file, event_log)
+        stack.enter_context(redirect_stdout(TeeOutput(log_file, sys.stdout)))
+
+        # 延迟导入agent模块，仅在真正运行时加载
+        from agents.k8s_group_agents.task_planner import (
+            task_planner, task_scheduler, task_inspector
+        )
+        from agents.k8s_group_agents.subtask_planner import (
+            subtask_planner, subtask_scheduler, subtask_inspector
+        )
+
+        from agents.k8s_group_agents.comprehensive_group import(
+            comprehensive_planner, comprehensive_step_scheduler
+        )
+
+        from agents.k8s_group_agents.pod_manage_group import (
+            pod_manage_planner, pod_manage_step_scheduler
+        )
+
+        from agents.k8s_group_agents.pod_orchestration_scheduling_group import (
+            pod_orchestration_scheduling_planner,pod_orchestration_scheduling_step_scheduler
+        )
+
+        from agents.k8s_group_agents.config_manage_group import (
+            config_manage_planner, config_manage_step_scheduler
+        )
+
+        from agents.k8s_group_agents.monitor_group import (
+            monitor_planner, monitor_step_scheduler
+        )
+
+        from agents.k8s_group_agents.software_manage_group import (
+            software_manage_planner, software_manage_step_scheduler
+        )
+
+        from agents.k8s_group_agents.storage_group import (
+            storage_planner, storage_step_scheduler
+        )
+
+        from agents.k8s_group_agents import step_inspector
+
+        from agents.k8s_group_agents.comprehensive_group.file_io_agent import file_io_agent
+        from agents.k8s_group_agents.comprehensive_group.text_output_agent import text_output_agent
+
+        from agents.k8s_group_agents.pod_manage_group.pod_manage_agent import pod_manage_agent
+        from agents.k8s_group_agents.pod_manage_group.resource_grouping_agent import resource_grouping_agent
+
+        from agents.k8s_group_agents.pod_orchestration_scheduling_group.stateful_workload_manage_agent import stateful_workload_manage_agent
+        from agents.k8s_group_agents.pod_orchestration_scheduling_group.stateless_workload_manage_agent import stateless_workload_manage_agent
+        from agents.k8s_group_agents.pod_orchestration_scheduling_group.task_manage_agent import task_manage_agent
+        from agents.k8s_group_agents.pod_orchestration_scheduling_group.daemonSet_manage_agent import daemonSet_manage_agent
+        from agents.k8s_group_agents.pod_orchestration_scheduling_group.affinity_antiAffinity_scheduling_agent import affinity_antiAffinity_scheduling_agent
+
+        from agents.k8s_group_agents.config_manage_group.env_config_manage_agent import env_config_manage_agent
+        from agents.k8s_group_agents.config_manage_group.privacy_manage_agent import privacy_manage_agent
+
+
+        from agents.k8s_group_agents.storage_group.pv_agent import pv_agent
+        from agents.k8s_group_agents.storage_group.pvc_agent import pvc_agent
+        from agents.k8s_group_agents.storage_group.storageclass_agent import storageclass_agent
+        from agents.k8s_group_agents.storage_group.csi_agent import csi_agent
+        from agents.k8s_group_agents.storage_group.emptydir_agent import emptydir_agent
+        from agents.k8s_group_agents.storage_group.hostpath_agent import hostpath_agent
+        from agents.k8s_group_agents.storage_group.disk_agent import disk_agent
+
+        from agents.k8s_group_agents.monitor_group.monitor_configuration_agent import monitor_configuration_agent
+        from agents.k8s_group_agents.monitor_group.monitor_observe_agent import monitor_observe_agent
+        from agents.k8s_group_agents.monitor_group.flexible_strategy_manage_agent import flexible_strategy_manage_agent
+
+
+        from agents.k8s_group_agents.software_manage_group.software_config_modify_agent import software_config_modify_agent
+        from agents.k8s_group_agents.software_manage_group.software_install_agent import software_install_agent
+        from agents.k8s_group_agents.software_manage_group.software_monitor_agent import software_monitor_agent
+        from agents.k8s_group_agents.software_manage_group.stress_test_agent import stress_test_agent
+
+        from agents.k8s_group_agents.vm_group.kubeadm_agent import kubeadm_agent
+        from agents.k8s_group_agents.vm_group.status_agent import status_agent
+        from agents.k8s_group_agents.vm_group.package_agent import package_agent
+
+        from agents.k8s_group_agents import check_log_agent
+
+        from agents.k8s_group_agents.tools.ExecuteCommand import ExecuteCommand
+
+        from agents.k8s_group_agents.vm_group import vm_planner, vm_step_scheduler
+
         # 以下是日志功能更新前的代码
-        task_planner_instance = task_planner.create_agent()
-        task_scheduler_instance = task_scheduler.create_agent()
-        task_inspector_instance = task_inspector.create_agent()
-
-        subtask_planner_instance = subtask_planner.create_agent()
-        subtask_scheduler_instance = subtask_scheduler.create_agent()
-        subtask_inspector_instance = subtask_inspector.create_agent()
-
-        step_inspector_instance = step_inspector.create_agent()
-
-        comprehensive_planner_instance = comprehensive_planner.create_agent()
-        comprehensive_step_scheduler_instance = comprehensive_step_scheduler.create_agent()
-        pod_manage_planner_instance = pod_manage_planner.create_agent()
-        pod_manage_step_scheduler_instance = pod_manage_step_scheduler.create_agent()
-        pod_orchestration_scheduling_planner_instance = pod_orchestration_scheduling_planner.create_agent()
-        pod_orchestration_scheduling_step_scheduler_instance = pod_orchestration_scheduling_step_scheduler.create_agent()
-        config_manage_planner_instance = config_manage_planner.create_agent()
-        config_manage_step_scheduler_instance = config_manage_step_scheduler.create_agent()
-        storage_planner_instance = storage_planner.create_agent()
-        storage_step_scheduler_instance = storage_step_scheduler.create_agent()
-        monitor_planner_instance = monitor_planner.create_agent()
-        monitor_step_scheduler_instance = monitor_step_scheduler.create_agent()
-        software_manage_planner_instance = software_manage_planner.create_agent()
-        software_manage_step_scheduler_instance = software_manage_step_scheduler.create_agent()
-
-        #虚拟机子任务规划
-        # vm_planner_instance = vm_planner.create_agent()
-        # vm_step_scheduler_instance = vm_step_scheduler.create_agent()
-
-        text_output_agent_instance =  text_output_agent.create_agent()
-        file_io_agent_instance = file_io_agent.create_agent()
-
-        pod_manage_agent_instance = pod_manage_agent.create_agent()
-        resource_grouping_agent_instance = resource_grouping_agent.create_agent()
-
-        stateful_workload_manage_agent_instance = stateful_workload_manage_agent.create_agent()
-        stateless_workload_manage_agent_instance = stateless_workload_manage_agent.create_agent()
-        task_manage_agent_instance = task_manage_agent.create_agent()
-        daemonSet_manage_agent_instance = daemonSet_manage_agent.create_agent()
-        affinity_antiAffinity_scheduling_agent_instance = affinity_antiAffinity_scheduling_agent.create_agent()
-
-        env_config_manage_agent_instance = env_config_manage_agent.create_agent()
-        privacy_manage_agent_instance = privacy_manage_agent.create_agent()
-
-        monitor_configuration_agent_instance = monitor_configuration_agent.create_agent()
-        monitor_observe_agent_instance = monitor_observe_agent.create_agent()
-        flexible_strategy_manage_agent_instance = flexible_strategy_manage_agent.create_agent()
-
-        software_config_modify_agent_instance = software_config_modify_agent.create_agent()
-        software_install_agent_instance = software_install_agent.create_agent()
-        software_monitor_agent_instance = software_monitor_agent.create_agent()
-        stress_test_agent_instance = stress_test_agent.create_agent()
-
-        pv_agent_instance = pv_agent.create_agent()
-        pvc_agent_instance = pvc_agent.create_agent()
-        storageclass_agent_instance = storageclass_agent.create_agent()
-        csi_agent_instance = csi_agent.create_agent()
-        emptydir_agent_instance = emptydir_agent.create_agent()
-        hostpath_agent_instance = hostpath_agent.create_agent()
-        disk_agent_instance = disk_agent.create_agent()
-
-        check_log_agent_instance = check_log_agent.create_agent()
+        (
+            task_planner_instance, task_scheduler_instance, task_inspector_instance,
+            subtask_planner_instance, subtask_scheduler_instance, subtask_inspector_instance,
+            step_inspector_instance,
+            comprehensive_planner_instance, comprehensive_step_scheduler_instance,
+            pod_manage_planner_instance, pod_manage_step_scheduler_instance,
+            pod_orchestration_scheduling_planner_instance,
+            pod_orchestration_scheduling_step_scheduler_instance, config_manage_planner_instance,
+            config_manage_step_scheduler_instance, storage_planner_instance,
+            storage_step_scheduler_instance, monitor_planner_instance,
+            monitor_step_scheduler_instance, software_manage_planner_instance,
+            software_manage_step_scheduler_instance,
+            #虚拟机子任务规划
+            # vm_planner_instance = vm_planner.create_agent()
+            # vm_step_scheduler_instance = vm_step_scheduler.create_agent()
+            text_output_agent_instance, file_io_agent_instance,
+            pod_manage_agent_instance, resource_grouping_agent_instance,
+            stateful_workload_manage_agent_instance, stateless_workload_manage_agent_instance,
+            task_manage_agent_instance, daemonSet_manage_agent_instance,
+            affinity_antiAffinity_scheduling_agent_instance,
+            env_config_manage_agent_instance, privacy_manage_agent_instance,
+            monitor_configuration_agent_instance, monitor_observe_agent_instance,
+            flexible_strategy_manage_agent_instance,
+            software_config_modify_agent_instance, software_install_agent_instance,
+            software_monitor_agent_instance, stress_test_agent_instance,
+            pv_agent_instance, pvc_agent_instance, storageclass_agent_instance, csi_agent_instance,
+            emptydir_agent_instance, hostpath_agent_instance, disk_agent_instance,
+            check_log_agent_instance,
+        ) = create_agents(
+            task_planner, task_scheduler, task_inspector,
+            subtask_planner, subtask_scheduler, subtask_inspector,
+            step_inspector,
+            comprehensive_planner, comprehensive_step_scheduler, pod_manage_planner,
+            pod_manage_step_scheduler, pod_orchestration_scheduling_planner,
+            pod_orchestration_scheduling_step_scheduler, config_manage_planner,
+            config_manage_step_scheduler, storage_planner, storage_step_scheduler, monitor_planner,
+            monitor_step_scheduler, software_manage_planner, software_manage_step_scheduler,
+            text_output_agent, file_io_agent,
+            pod_manage_agent, resource_grouping_agent,
+            stateful_workload_manage_agent, stateless_workload_manage_agent, task_manage_agent,
+            daemonSet_manage_agent, affinity_antiAffinity_scheduling_agent,
+            env_config_manage_agent, privacy_manage_agent,
+            monitor_configuration_agent, monitor_observe_agent, flexible_strategy_manage_agent,
+            software_config_modify_agent, software_install_agent, software_monitor_agent,
+            stress_test_agent,
+            pv_agent, pvc_agent, storageclass_agent, csi_agent, emptydir_agent, hostpath_agent,
+            disk_agent,
+            check_log_agent,
+        )
 
         # 虚拟机智能体初始化
         # status_agent_instance = status_agent.create_agent()
@@ -265,7 +251,10 @@ def main():
         agency = Agency(agency_chart=chat_graph,
                         thread_strategy=thread_strategy,
                         temperature=0.5,
-                        max_prompt_tokens=25000,)
+                        max_prompt_tokens=25000,
+                        event_callback=event_logger(event_log),)
+        # 退出时先停止agency的线程池，等正在执行的step结束后再关闭日志
+        stack.callback(agency.shutdown)
 
         plan_agents = {
             "task_planner": task_planner_instance,
@@ -337,27 +326,12 @@ def main():
         while True:
             request_id += 1
             agency.task_planning(original_request=text, plan_agents=plan_agents, cap_group_agents=cap_group_agents, cap_agents=cap_agents, request_id= "request_" + str(request_id))
-            text= input("\n请输入新的请求描述（或输入exit退出）：")
+            text = input("\n请输入新的请求描述（或输入exit退出）：")
             log_file.write(text + '\n')
             log_file.flush()
             if text.lower() == 'exit':
                 break
-            
-    
-    finally:
-        # 关闭日志文件和恢复标准输出
-        sys.stdout = original_stdout
-        log_file.close()
-        print(f"日志已保存到：{log_file_path}")
+
 
 if __name__ == "__main__":
-    try:
-        main()
-    finally: # 响铃
-        import winsound
-        import time
-        winsound.MessageBeep(winsound.MB_ICONEXCLAMATION)
-        time.sleep(2)
-        winsound.MessageBeep(winsound.MB_ICONEXCLAMATION)
-        time.sleep(2)
-        winsound.MessageBeep(winsound.MB_ICONEXCLAMATION)
+    main()
@@ -1,219 +1,196 @@
-from agency_swarm import Agent, Agency
-
-from agents.task_planner import (
-    task_planner, scheduler, inspector
-)
-from agents.subtask_planner import (
-    subtask_planner, subtask_manager, subtask_scheduler, subtask_inspector
-)
-from agents.cap_group_agents.CES_group import (
-    CES_manager, CES_planner, CES_step_scheduler
-)
-from agents.cap_group_agents.ECS_group import (
-    ECS_manager, ECS_planner, ECS_step_scheduler
-)
-from agents.cap_group_agents.EVS_group import (
-    EVS_manager, EVS_planner, EVS_step_scheduler
-)
-from agents.cap_group_agents.Huawei_Cloud_API_group import (
-    Huawei_Cloud_API_manager, Huawei_Cloud_API_planner, Huawei_Cloud_API_step_scheduler
-)
-from agents.cap_group_agents.IAM_service_group import (
-    IAM_service_manager, IAM_service_planner, IAM_service_step_scheduler
-)
-from agents.cap_group_agents.IMS_group import (
-    IMS_manager, IMS_planner, IMS_step_scheduler
-)
-from agents.cap_group_agents.OS_group import (
-    OS_manager, OS_planner, OS_step_scheduler
-)
-from agents.cap_group_agents.VPC_network import (
-    VPC_network_manager, VPC_network_planner, VPC_network_step_scheduler
-)
-from agents.cap_group_agents.CLUSTER_group import (
-    CLUSTER_manager, CLUSTER_planner, CLUSTER_step_scheduler
-)
-from agents.cap_group_agents.NODE_group import (
-    NODE_manager, NODE_planner, NODE_step_scheduler
-)
-from agents.cap_group_agents import step_inspector
-
-from agents.cap_group_agents import (
-    basic_cap_solver, param_asker
-)
-
-from agents.cap_group_agents.CES_group.cap_agents.CES_alarm_history_agent import CES_alarm_history_agent
-from agents.cap_group_agents.CES_group.cap_agents.CES_alarm_rule_agent import CES_alarm_rule_agent
-from agents.cap_group_agents.CES_group.cap_agents.CES_dashboard_agent import CES_dashboard_agent
-from agents.cap_group_agents.CES_group.cap_agents.CES_data_agent import CES_data_agent
-from agents.cap_group_agents.CES_group.cap_agents.CES_event_agent import CES_event_agent
-from agents.cap_group_agents.CES_group.cap_agents.CES_metric_agent import CES_metric_agent
-
-from agents.cap_group_agents.ECS_group.cap_agents.ECS_harddisk_agent import ECS_harddisk_agent
-from agents.cap_group_agents.ECS_group.cap_agents.ECS_instance_agent import ECS_instance_agent
-from agents.cap_group_agents.ECS_group.cap_agents.ECS_netcard_agent import ECS_netcard_agent
-from agents.cap_group_agents.ECS_group.cap_agents.ECS_recommend_agent import ECS_recommend_agent
-from agents.cap_group_agents.ECS_group.cap_agents.ECS_specification_query_agent import ECS_specification_query_agent
-
-from agents.cap_group_agents.EVS_group.cap_agents.EVS_clouddiskt_agent import EVS_clouddiskt_agent
-from agents.cap_group_agents.EVS_group.cap_agents.EVS_snapshot_agent import EVS_snapshot_agent
-
-from agents.cap_group_agents.IAM_service_group.cap_agents.AKSK_agent import AKSK_agent
-
-from agents.cap_group_agents.IMS_group.cap_agents.IMS_agent import IMS_agent
-
-from agents.cap_group_agents.OS_group.cap_agents.OS_agent import OS_agent
-
-from agents.cap_group_agents.VPC_network.cap_agents.VPC_secgroup_agent import VPC_secgroup_agent
-from agents.cap_group_agents.VPC_network.cap_agents.VPC_subnet_agent import VPC_subnet_agent
-from agents.cap_group_agents.VPC_network.cap_agents.VPC_vpc_agent import VPC_vpc_agent
-
-from agents.cap_group_agents.CLUSTER_group.cap_agents.CLUSTER_lifecycle_agent import CLUSTER_lifecycle_agent
-from agents.cap_group_agents.CLUSTER_group.cap_agents.CLUSTER_specification_change_agent import CLUSTER_specification_change_agent
-
-from agents.cap_group_agents.NODE_group.cap_agents.NODE_lifecycle_agent import NODE_lifecycle_agent
-from agents.cap_group_agents.NODE_group.cap_agents.NODE_pool_agent import NODE_pool_agent
-from agents.cap_group_agents.NODE_group.cap_agents.NODE_scaling_protect_agent import NODE_scaling_protect_agent
-
-from agents.basic_agents.api_agents import (
-    API_param_selector, array_selector, param_selector, param_inspector, array_splitter
-)
-from agents.basic_agents.job_agent import check_log_agent
-from agents.basic_agents.job_agent import job_agent
-from agents.basic_agents.jobs_agent import jobs_agent
-from agents.basic_agents.job_agent.tools.CheckLogForFailures import CheckLogForFailures
-from agents.basic_agents.api_agents.tools.CheckParamRequired import CheckParamRequired
-from agents.basic_agents.api_agents.tools.SelectAPIParam import SelectAPIParam
-from agents.basic_agents.api_agents.tools.SelectParamTable import SelectParamTable
-from agents.basic_agents.api_agents.tools.SplitArray import SplitArray
-
-from agency_swarm import set_openai_key
+import datetime
+import os
+import sys
+from contextlib import ExitStack, redirect_stdout
 
 from dotenv import load_dotenv
-import sys
-import os
-import datetime
 
 load_dotenv()
-set_openai_key(os.getenv('OPENAI_API_KEY'))
+# 在加载agency_swarm及各agent模块之前检查API key，缺失时立即退出
+if not os.getenv('OPENAI_API_KEY'):
+    sys.exit("OPENAI_API_KEY not set")
+
+from agency_swarm import Agency, Agent, set_openai_key
+from agency_swarm.util.launch import close_on_exit, create_agents, notify_done
+from agency_swarm.util.run_log import TeeOutput, event_logger, open_run_log
+
+set_openai_key(os.environ['OPENAI_API_KEY'])
 
 def main():
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    log_file_path = os.path.join("log", f"run_log_{timestamp}.txt")
-    # 创建日志文件
-    log_file = open(log_file_path, 'w', encoding='utf-8', buffering=1)
-    
-    # 创建自定义的输出类，同时将输出发送到文件和终端
-    class TeeOutput:
-        def __init__(self, file, terminal):
-            self.file = file
-            self.terminal = terminal
-            
-        def write(self, message):
-            self.terminal.write(message)
-            self.file.write(message)
-            
-        def flush(self):
-            self.terminal.flush()
-            self.file.flush()
-    
-    # 保存原始的stdout，并设置新的输出重定向
-    original_stdout = sys.stdout
-    sys.stdout = TeeOutput(log_file, original_stdout)
-    
-    try:
-        task_planner_instance = task_planner.create_agent()
-        task_scheduler_instance = scheduler.create_agent()
-        task_inspector_instance = inspector.create_agent()
-
-        subtask_planner_instance = subtask_planner.create_agent()
-        subtask_manager_instance = subtask_manager.create_agent()
-        subtask_scheduler_instance = subtask_scheduler.create_agent()
-        subtask_inspector_instance = subtask_inspector.create_agent()
-
-        step_inspector_instance = step_inspector.create_agent()
-
-        basic_cap_solver_instance = basic_cap_solver.create_agent()
-        param_asker_instance = param_asker.create_agent()
-
-        # repeater = repeater.create_agent()
-        # rander = rander.create_agent()
-        # palindromist = palindromist.create_agent()
-
-        # simulator = simulator.create_agent()
-
-        # CES_planner = CES_planner.create_agent()
-        # CES_manager = CES_manager.create_agent()
-        # CES_step_scheduler = CES_step_scheduler.create_agent()
-        # CES_alarm_history_agent = CES_alarm_history_agent.create_agent()
-        # CES_alarm_rule_agent = CES_alarm_rule_agent.create_agent()
-        # CES_dashboard_agent = CES_dashboard_agent.create_agent()
-        # CES_data_agent = CES_data_agent.create_agent()
-        # CES_event_agent = CES_event_agent.create_agent()
-        # CES_metric_agent = CES_metric_agent.create_agent()
-
-        ECS_planner_instance = ECS_planner.create_agent()
-        ECS_manager_instance = ECS_manager.create_agent()
-        ECS_step_scheduler_instance = ECS_step_scheduler.create_agent()
-        ECS_harddisk_agent_instance = ECS_harddisk_agent.create_agent()
-        ECS_instance_agent_instance = ECS_instance_agent.create_agent()
-        ECS_netcard_agent_instance = ECS_netcard_agent.create_agent()
-        ECS_recommend_agent_instance = ECS_recommend_agent.create_agent()
-        ECS_specification_query_agent_instance = ECS_specification_query_agent.create_agent()
-
-        # EVS_planner = EVS_planner.create_agent()
-        # EVS_manager = EVS_manager.create_agent()
-        # EVS_step_scheduler = EVS_step_scheduler.create_agent()
-        # EVS_clouddiskt_agent = EVS_clouddiskt_agent.create_agent()
-        # EVS_snapshot_agent = EVS_snapshot_agent.create_agent()
-
-        # IAM_service_planner = IAM_service_planner.create_agent()
-        # IAM_service_manager = IAM_service_manager.create_agent()
-        # IAM_service_step_scheduler = IAM_service_step_scheduler.create_agent()
-        AKSK_agent_instance = AKSK_agent.create_agent()
-
-        IMS_planner_instance = IMS_planner.create_agent()
-        IMS_manager_instance = IMS_manager.create_agent()
-        IMS_step_scheduler_instance = IMS_step_scheduler.create_agent()
-        IMS_agent_instance = IMS_agent.create_agent()
-
-        # Huawei_Cloud_API_planner = Huawei_Cloud_API_planner.create_agent()
-        # Huawei_Cloud_API_manager = Huawei_Cloud_API_manager.create_agent()
-        # Huawei_Cloud_API_step_scheduler = Huawei_Cloud_API_step_scheduler.create_agent()
-
-        # OS_planner = OS_planner.create_agent()
-        # OS_manager = OS_manager.create_agent()
-        # OS_step_scheduler = OS_step_scheduler.create_agent()
-        # OS_agent = OS_agent.create_agent()
-
-        VPC_network_planner_instance = VPC_network_planner.create_agent()
-        VPC_network_manager_instance = VPC_network_manager.create_agent()
-        VPC_network_step_scheduler_instance = VPC_network_step_scheduler.create_agent()
-        VPC_secgroup_agent_instance = VPC_secgroup_agent.create_agent()
-        VPC_subnet_agent_instance = VPC_subnet_agent.create_agent()
-        VPC_vpc_agent_instance = VPC_vpc_agent.create_agent()
-
-        CLUSTER_planner_instance = CLUSTER_planner.create_agent()
-        CLUSTER_manager_instance = CLUSTER_manager.create_agent()
-        CLUSTER_step_scheduler_instance = CLUSTER_step_scheduler.create_agent()
-        CLUSTER_lifecycle_agent_instance = CLUSTER_lifecycle_agent.create_agent()
-        CLUSTER_specification_change_agent_instance = CLUSTER_specification_change_agent.create_agent()
-
-        NODE_planner_instance = NODE_planner.create_agent()
-        NODE_manager_instance = NODE_manager.create_agent()
-        NODE_step_scheduler_instance = NODE_step_scheduler.create_agent()
-        NODE_lifecycle_agent_instance = NODE_lifecycle_agent.create_agent()
-        NODE_pool_agent_instance = NODE_pool_agent.create_agent()
-        NODE_scaling_protect_agent_instance = NODE_scaling_protect_agent.create_agent()
-
-        API_param_selector_instance = API_param_selector.create_agent()
-        array_selector_instance = array_selector.create_agent()
-        array_splitter_instance = array_splitter.create_agent()
-        param_selector_instance = param_selector.create_agent()
-        param_inspector_instance = param_inspector.create_agent()
-        check_log_agent_instance = check_log_agent.create_agent()
-        job_agent_instance = job_agent.create_agent()
-        jobs_agent_instance = jobs_agent.create_agent()
+    # 确保日志目录存在，首次运行时log目录可能还未创建
+    os.makedirs("log", exist_ok=True)
+    run_id = f"{datetime.datetime.now():%Y%m%d_%H%M%S}"
+    log_file_path = os.path.join("log", f"run_log_{run_id}.txt")
+    # 每条agent消息以一行JSON追加写入，运行中即可tail/解析
+    event_log_path = os.path.join("log", f"events_{run_id}.jsonl")
+    with ExitStack() as stack:
+        # 退出时按注册的逆序执行：恢复stdout、关闭日志文件，然后响铃并提示日志路径
+        stack.callback(print, f"日志已保存到：{log_file_path}")
+        stack.callback(notify_done)
+        # 创建日志文件，并将输出同时重定向到文件和终端
+        log_file = stack.enter_context(open_run_log(log_file_path))
+        event_log = stack.enter_context(open_run_log(event_log_path))
+        # 被中断或收到SIGTERM时也保证日志写完并关闭
+        close_on_exit(log_file, event_log)
+        stack.enter_context(redirect_stdout(TeeOutput(log_file, sys.stdout)))
+
+        # 延迟导入agent模块，仅在真正运行时加载
+        from agents.task_planner import (
+            task_planner, scheduler, inspector
+        )
+        from agents.subtask_planner import (
+            subtask_planner, subtask_manager, subtask_scheduler, subtask_inspector
+        )
+        from agents.cap_group_agents.CES_group import (
+            CES_manager, CES_planner, CES_step_scheduler
+        )
+        from agents.cap_group_agents.ECS_group import (
+            ECS_manager, ECS_planner, ECS_step_scheduler
+        )
+        from agents.cap_group_agents.EVS_group import (
+            EVS_manager, EVS_planner, EVS_step_scheduler
+        )
+        from agents.cap_group_agents.Huawei_Cloud_API_group import (
+            Huawei_Cloud_API_manager, Huawei_Cloud_API_planner, Huawei_Cloud_API_step_scheduler
+        )
+        from agents.cap_group_agents.IAM_service_group import (
+            IAM_service_manager, IAM_service_planner, IAM_service_step_scheduler
+        )
+        from agents.cap_group_agents.IMS_group import (
+            IMS_manager, IMS_planner, IMS_step_scheduler
+        )
+        from agents.cap_group_agents.OS_group import (
+            OS_manager, OS_planner, OS_step_scheduler
+        )
+        from agents.cap_group_agents.VPC_network import (
+            VPC_network_manager, VPC_network_planner, VPC_network_step_scheduler
+        )
+        from agents.cap_group_agents.CLUSTER_group import (
+            CLUSTER_manager, CLUSTER_planner, CLUSTER_step_scheduler
+        )
+        from agents.cap_group_agents.NODE_group import (
+            NODE_manager, NODE_planner, NODE_step_scheduler
+        )
+        from agents.cap_group_agents import step_inspector
+
+        from agents.cap_group_agents import (
+            basic_cap_solver, param_asker
+        )
+
+        from agents.cap_group_agents.CES_group.cap_agents.CES_alarm_history_agent import CES_alarm_history_agent
+        from agents.cap_group_agents.CES_group.cap_agents.CES_alarm_rule_agent import CES_alarm_rule_agent
+        from agents.cap_group_agents.CES_group.cap_agents.CES_dashboard_agent import CES_dashboard_agent
+        from agents.cap_group_agents.CES_group.cap_agents.CES_data_agent import CES_data_agent
+        from agents.cap_group_agents.CES_group.cap_agents.CES_event_agent import CES_event_agent
+        from agents.cap_group_agents.CES_group.cap_agents.CES_metric_agent import CES_metric_agent
+
+        from agents.cap_group_agents.ECS_group.cap_agents.ECS_harddisk_agent import ECS_harddisk_agent
+        from agents.cap_group_agents.ECS_group.cap_agents.ECS_instance_agent import ECS_instance_agent
+        from agents.cap_group_agents.ECS_group.cap_agents.ECS_netcard_agent import ECS_netcard_agent
+        from agents.cap_group_agents.ECS_group.cap_agents.ECS_recommend_agent import ECS_recommend_agent
+        from agents.cap_group_agents.ECS_group.cap_agents.ECS_specification_query_agent import ECS_specification_query_agent
+
+        from agents.cap_group_agents.EVS_group.cap_agents.EVS_clouddiskt_agent import EVS_clouddiskt_agent
+        from agents.cap_group_agents.EVS_group.cap_agents.EVS_snapshot_agent import EVS_snapshot_agent
+
+        from agents.cap_group_agents.IAM_service_group.cap_agents.AKSK_agent import AKSK_agent
+
+        from agents.cap_group_agents.IMS_group.cap_agents.IMS_agent import IMS_agent
+
+        from agents.cap_group_agents.OS_group.cap_agents.OS_agent import OS_agent
+
+        from agents.cap_group_agents.VPC_network.cap_agents.VPC_secgroup_agent import VPC_secgroup_agent
+        from agents.cap_group_agents.VPC_network.cap_agents.VPC_subnet_agent import VPC_subnet_agent
+        from agents.cap_group_agents.VPC_network.cap_agents.VPC_vpc_agent import VPC_vpc_agent
+
+        from agents.cap_group_agents.CLUSTER_group.cap_agents.CLUSTER_lifecycle_agent import CLUSTER_lifecycle_agent
+        from agents.cap_group_agents.CLUSTER_group.cap_agents.CLUSTER_specification_change_agent import CLUSTER_specification_change_agent
+
+        from agents.cap_group_agents.NODE_group.cap_agents.NODE_lifecycle_agent import NODE_lifecycle_agent
+        from agents.cap_group_agents.NODE_group.cap_agents.NODE_pool_agent import NODE_pool_agent
+        from agents.cap_group_agents.NODE_group.cap_agents.NODE_scaling_protect_agent import NODE_scaling_protect_agent
+
+        from agents.basic_agents.api_agents import (
+            API_param_selector, array_selector, param_selector, param_inspector, array_splitter
+        )
+        from agents.basic_agents.job_agent import check_log_agent
+        from agents.basic_agents.job_agent import job_agent
+        from agents.basic_agents.jobs_agent import jobs_agent
+        from agents.basic_agents.job_agent.tools.CheckLogForFailures import CheckLogForFailures
+        from agents.basic_agents.api_agents.tools.CheckParamRequired import CheckParamRequired
+        from agents.basic_agents.api_agents.tools.SelectAPIParam import SelectAPIParam
+        from agents.basic_agents.api_agents.tools.SelectParamTable import SelectParamTable
+        from agents.basic_agents.api_agents.tools.SplitArray import SplitArray
+
+        (
+            task_planner_instance, task_scheduler_instance, task_inspector_instance,
+            subtask_planner_instance, subtask_manager_instance, subtask_scheduler_instance,
+            subtask_inspector_instance,
+            step_inspector_instance,
+            basic_cap_solver_instance, param_asker_instance,
+            # repeater = repeater.create_agent()
+            # rander = rander.create_agent()
+            # palindromist = palindromist.create_agent()
+            # simulator = simulator.create_agent()
+            # CES_planner = CES_planner.create_agent()
+            # CES_manager = CES_manager.create_agent()
+            # CES_step_scheduler = CES_step_scheduler.create_agent()
+            # CES_alarm_history_agent = CES_alarm_history_agent.create_agent()
+            # CES_alarm_rule_agent = CES_alarm_rule_agent.create_agent()
+            # CES_dashboard_agent = CES_dashboard_agent.create_agent()
+            # CES_data_agent = CES_data_agent.create_agent()
+            # CES_event_agent = CES_event_agent.create_agent()
+            # CES_metric_agent = CES_metric_agent.create_agent()
+            ECS_planner_instance, ECS_manager_instance, ECS_step_scheduler_instance,
+            ECS_harddisk_agent_instance, ECS_instance_agent_instance, ECS_netcard_agent_instance,
+            ECS_recommend_agent_instance, ECS_specification_query_agent_instance,
+            # EVS_planner = EVS_planner.create_agent()
+            # EVS_manager = EVS_manager.create_agent()
+            # EVS_step_scheduler = EVS_step_scheduler.create_agent()
+            # EVS_clouddiskt_agent = EVS_clouddiskt_agent.create_agent()
+            # EVS_snapshot_agent = EVS_snapshot_agent.create_agent()
+            # IAM_service_planner = IAM_service_planner.create_agent()
+            # IAM_service_manager = IAM_service_manager.create_agent()
+            # IAM_service_step_scheduler = IAM_service_step_scheduler.create_agent()
+            AKSK_agent_instance,
+            IMS_planner_instance, IMS_manager_instance, IMS_step_scheduler_instance,
+            IMS_agent_instance,
+            # Huawei_Cloud_API_planner = Huawei_Cloud_API_planner.create_agent()
+            # Huawei_Cloud_API_manager = Huawei_Cloud_API_manager.create_agent()
+            # Huawei_Cloud_API_step_scheduler = Huawei_Cloud_API_step_scheduler.create_agent()
+            # OS_planner = OS_planner.create_agent()
+            # OS_manager = OS_manager.create_agent()
+            # OS_step_scheduler = OS_step_scheduler.create_agent()
+            # OS_agent = OS_agent.create_agent()
+            VPC_network_planner_instance, VPC_network_manager_instance,
+            VPC_network_step_scheduler_instance, VPC_secgroup_agent_instance,
+            VPC_subnet_agent_instance, VPC_vpc_agent_instance,
+            CLUSTER_planner_instance, CLUSTER_manager_instance, CLUSTER_step_scheduler_instance,
+            CLUSTER_lifecycle_agent_instance, CLUSTER_specification_change_agent_instance,
+            NODE_planner_instance, NODE_manager_instance, NODE_step_scheduler_instance,
+            NODE_lifecycle_agent_instance, NODE_pool_agent_instance,
+            NODE_scaling_protect_agent_instance,
+            API_param_selector_instance, array_selector_instance, array_splitter_instance,
+            param_selector_instance, param_inspector_instance, check_log_agent_instance,
+            job_agent_instance, jobs_agent_instance,
+        ) = create_agents(
+            task_planner, scheduler, inspector,
+            subtask_planner, subtask_manager, subtask_scheduler, subtask_inspector,
+            step_inspector,
+            basic_cap_solver, param_asker,
+            ECS_planner, ECS_manager, ECS_step_scheduler, ECS_harddisk_agent, ECS_instance_agent,
+            ECS_netcard_agent, ECS_recommend_agent, ECS_specification_query_agent,
+            AKSK_agent,
+            IMS_planner, IMS_manager, IMS_step_scheduler, IMS_agent,
+            VPC_network_planner, VPC_network_manager, VPC_network_step_scheduler,
+            VPC_secgroup_agent, VPC_subnet_agent, VPC_vpc_agent,
+            CLUSTER_planner, CLUSTER_manager, CLUSTER_step_scheduler, CLUSTER_lifecycle_agent,
+            CLUSTER_specification_change_agent,
+            NODE_planner, NODE_manager, NODE_step_scheduler, NODE_lifecycle_agent, NODE_pool_agent,
+            NODE_scaling_protect_agent,
+            API_param_selector, array_selector, array_splitter, param_selector, param_inspector,
+            check_log_agent, job_agent, jobs_agent,
+        )
 
         chat_graph = [task_planner_instance, task_scheduler_instance, task_inspector_instance,
                     subtask_planner_instance, subtask_manager_instance, subtask_scheduler_instance, subtask_inspector_instance,
@@ -356,21 +333,30 @@ def main():
         agency_manifesto = """
         """
 
+        # 接收方 -> 调用方列表，这些调用每次都使用新的会话线程
+        always_new_callers = {
+            param_selector: [SelectAPIParam, SelectParamTable],
+            array_selector: [param_selector, CheckParamRequired],
+            check_log_agent: [CheckLogForFailures],
+            array_splitter: [SplitArray],
+        }
         thread_strategy = {
             "always_new": [
-                (SelectAPIParam, param_selector),
-                (SelectParamTable, param_selector),
-                (param_selector, array_selector),
-                (CheckParamRequired, array_selector),
-                (CheckLogForFailures, check_log_agent),
-                (SplitArray, array_splitter)
+                (caller, recipient)
+                for recipient, callers in always_new_callers.items()
+                for caller in callers
             ]
         }
 
+        # 所有agent共享的说明会被放在各自instructions的最前面，保持提示词前缀稳定以命中提示词缓存
         agency = Agency(agency_chart=chat_graph,
                         thread_strategy=thread_strategy,
+                        shared_instructions=agency_manifesto,
                         temperature=0.5,
-                        max_prompt_tokens=25000,)
+                        max_prompt_tokens=25000,
+                        event_callback=event_logger(event_log),)
+        # 退出时先停止agency的线程池，等正在执行的step结束后再关闭日志
+        stack.callback(agency.shutdown)
 
         plan_agents = {
             "task_planner": task_planner_instance,
@@ -447,26 +433,12 @@ def main():
         while True:
             request_id += 1
             agency.task_planning(original_request=text, plan_agents=plan_agents, cap_group_agents=cap_group_agents, cap_agents=cap_agents, request_id= "request_" + str(request_id))
-            text= input("\n请输入新的请求描述（或输入exit退出）：")
+            text = input("\n请输入新的请求描述（或输入exit退出）：")
             log_file.write(text + '\n')
             log_file.flush()
             if text.lower() == 'exit':
                 break
-    finally:
-        # 关闭日志文件和恢复标准输出
-        sys.stdout = original_stdout
-        log_file.close()
-        print(f"日志已保存到：{log_file_path}")
-    
+
 
 if __name__ == "__main__":
-    try:
-        main()
-    finally: # 响铃
-        import winsound
-        import time
-        winsound.MessageBeep(winsound.MB_ICONEXCLAMATION)
-        time.sleep(2)
-        winsound.MessageBeep(winsound.MB_ICONEXCLAMATION)
-        time.sleep(2)
-        winsound.MessageBeep(winsound.MB_ICONEXCLAMATION)
+    main()
@@ -1,299 +1,262 @@
 import datetime
 import os
 import sys
+from contextlib import ExitStack, redirect_stdout
 
 from dotenv import load_dotenv
 
+load_dotenv()
+# 在加载agency_swarm及各agent模块之前检查API key，缺失时立即退出
+if not os.getenv("OPENAI_API_KEY"):
+    sys.exit("OPENAI_API_KEY not set")
+
 from agency_swarm import Agency, Agent, set_openai_key
-from agents.openeuler_agents import (
-    check_log_agent,
-    step_inspector,
-)
-from agents.openeuler_agents.os_group import (
-    os_planner, 
-    os_step_scheduler,
-    os_rag_optimizer,
-)
-from agents.openeuler_agents.os_group.network_agent import network_agent
-from agents.openeuler_agents.os_group.permissions_agent import permissions_agent
-from agents.openeuler_agents.os_group.basic_agent import basic_agent
-from agents.openeuler_agents.os_group.user_agent import user_agent
-from agents.openeuler_agents.security_group import (
-    security_planner,
-    security_step_scheduler,
-    security_rag_optimizer,
-)
-from agents.openeuler_agents.security_group.secscanner_agent import secscanner_agent
-from agents.openeuler_agents.security_group.syscare_agent import syscare_agent
-from agents.openeuler_agents.software_group import (
-    software_planner,
-    software_step_scheduler,
-    software_rag_optimizer,
-)
-from agents.openeuler_agents.software_group.sql_agent import sql_agent
-from agents.openeuler_agents.software_group.atune_agent import atune_agent
-from agents.openeuler_agents.software_group.package_agent import package_agent
-from agents.openeuler_agents.software_group.repository_agent import repository_agent
-from agents.openeuler_agents.subtask_planner import (
-    subtask_inspector,
-    subtask_planner,
-    subtask_scheduler,
-)
-from agents.openeuler_agents.task_planner import (
-    task_inspector,
-    task_inspector_rag,
-    task_planner,
-    task_planner_rag,
-    task_scheduler,
-    task_scheduler_rag,
-    task_manager_rag
-)
-
-from agents.subtask_planner import(
-    subtask_manager
-)
-
-from agents.cap_group_agents.CES_group import (
-    CES_manager, CES_planner, CES_step_scheduler
-)
-from agents.cap_group_agents.ECS_group import (
-    ECS_manager, ECS_planner, ECS_step_scheduler, ECS_rag_optimizer
-)
-from agents.cap_group_agents.EVS_group import (
-    EVS_manager, EVS_planner, EVS_step_scheduler
-)
-from agents.cap_group_agents.IAM_service_group import (
-    IAM_service_manager, IAM_service_planner, IAM_service_step_scheduler, IAM_rag_optimizer
-)
-from agents.cap_group_agents.IMS_group import (
-    IMS_manager, IMS_planner, IMS_step_scheduler, IMS_rag_optimizer
-)
-from agents.cap_group_agents.VPC_network import (
-    VPC_network_manager, VPC_network_planner, VPC_network_step_scheduler, VPC_network_rag_optimizer
-)
-from agents.cap_group_agents.CLUSTER_group import (
-    CLUSTER_manager, CLUSTER_planner, CLUSTER_step_scheduler, CLUSTER_rag_optimizer
-)
-from agents.cap_group_agents.NODE_group import (
-    NODE_manager, NODE_planner, NODE_step_scheduler, NODE_rag_optimizer
-)
-from agents.openeuler_agents.file_group import (
-file_planner, file_step_scheduler, file_rag_optimizer
-)
-
-from agents.cap_group_agents import step_inspector
-
-from agents.cap_group_agents import (
-    basic_cap_solver, param_asker
-)
-
-from agents.cap_group_agents.CES_group.cap_agents.CES_alarm_history_agent import CES_alarm_history_agent
-from agents.cap_group_agents.CES_group.cap_agents.CES_alarm_rule_agent import CES_alarm_rule_agent
-from agents.cap_group_agents.CES_group.cap_agents.CES_dashboard_agent import CES_dashboard_agent
-from agents.cap_group_agents.CES_group.cap_agents.CES_data_agent import CES_data_agent
-from agents.cap_group_agents.CES_group.cap_agents.CES_event_agent import CES_event_agent
-from agents.cap_group_agents.CES_group.cap_agents.CES_metric_agent import CES_metric_agent
-
-from agents.cap_group_agents.ECS_group.cap_agents.ECS_harddisk_agent import ECS_harddisk_agent
-from agents.cap_group_agents.ECS_group.cap_agents.ECS_instance_agent import ECS_instance_agent
-from agents.cap_group_agents.ECS_group.cap_agents.ECS_netcard_agent import ECS_netcard_agent
-from agents.cap_group_agents.ECS_group.cap_agents.ECS_recommend_agent import ECS_recommend_agent
-from agents.cap_group_agents.ECS_group.cap_agents.ECS_specification_query_agent import ECS_specification_query_agent
-
-from agents.cap_group_agents.EVS_group.cap_agents.EVS_clouddiskt_agent import EVS_clouddiskt_agent
-from agents.cap_group_agents.EVS_group.cap_agents.EVS_snapshot_agent import EVS_snapshot_agent
-
-from agents.cap_group_agents.IAM_service_group.cap_agents.AKSK_agent import AKSK_agent
-
-from agents.cap_group_agents.IMS_group.cap_agents.IMS_agent import IMS_agent
-
-from agents.cap_group_agents.OS_group.cap_agents.OS_agent import OS_agent
-
-from agents.cap_group_agents.VPC_network.cap_agents.VPC_secgroup_agent import VPC_secgroup_agent
-from agents.cap_group_agents.VPC_network.cap_agents.VPC_subnet_agent import VPC_subnet_agent
-from agents.cap_group_agents.VPC_network.cap_agents.VPC_vpc_agent import VPC_vpc_agent
-
-from agents.cap_group_agents.CLUSTER_group.cap_agents.CLUSTER_lifecycle_agent import CLUSTER_lifecycle_agent
-from agents.cap_group_agents.CLUSTER_group.cap_agents.CLUSTER_specification_change_agent import CLUSTER_specification_change_agent
-
-from agents.cap_group_agents.NODE_group.cap_agents.NODE_lifecycle_agent import NODE_lifecycle_agent
-from agents.cap_group_agents.NODE_group.cap_agents.NODE_pool_agent import NODE_pool_agent
-from agents.cap_group_agents.NODE_group.cap_agents.NODE_scaling_protect_agent import NODE_scaling_protect_agent
-
-
-from agents.basic_agents.job_agent import check_log_agent
-from agents.basic_agents.job_agent.tools.CheckLogForFailures import CheckLogForFailures
-from agents.basic_agents.api_agents.tools.CheckParamRequired import CheckParamRequired
-from agents.basic_agents.api_agents.tools.SelectAPIParam import SelectAPIParam
-from agents.basic_agents.api_agents.tools.SelectParamTable import SelectParamTable
-from agents.basic_agents.api_agents.tools.SplitArray import SplitArray
-
-from agents.openeuler_agents.tools.SSHExecuteCommand import SSHExecuteCommand
-
-
-from agents.basic_agents.api_agents import (
-    API_param_selector, array_selector, param_selector, param_inspector, array_splitter
-)
-
-from agents.openeuler_agents.file_group.text_agent import text_agent
-from agents.openeuler_agents.file_group.file_io_agent import file_io_agent
-from agents.openeuler_agents.file_group.script_agent import script_agent
+from agency_swarm.util.launch import close_on_exit, create_agents
+from agency_swarm.util.run_log import TeeOutput, event_logger, open_run_log
 
-load_dotenv()
-set_openai_key(os.getenv("OPENAI_API_KEY"))
+set_openai_key(os.environ["OPENAI_API_KEY"])
 
 
 def main():
     # 添加日志功能:创建一个日志文件,用当前时间作为文件名
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    log_file_path = os.path.join("log", f"run_log_{timestamp}.txt")
+    # 确保日志目录存在，首次运行时log目录可能还未创建
+    os.makedirs("log", exist_ok=True)
+    run_id = f"{datetime.datetime.now():%Y%m%d_%H%M%S}"
+    log_file_path = os.path.join("log", f"run_log_{run_id}.txt")
+    # 每条agent消息以一行JSON追加写入，运行中即可tail/解析
+    event_log_path = os.path.join("log", f"events_{run_id}.jsonl")
+
+    with ExitStack() as stack:
+        # 退出时按注册的逆序执行：恢复stdout、关闭日志文件，然后提示日志路径
+        stack.callback(print, f"日志已保存到:{log_file_path}")
+        # 创建日志文件，并将输出同时重定向到文件和终端
+        log_file = stack.enter_context(open_run_log(log_file_path))
+        event_log = stack.enter_context(open_run_log(event_log_path))
+        # 被中断或收到SIGTERM时也保证日志写完并关闭
+        close_on_exit(log_file, event_log)
+        stack.enter_context(redirect_stdout(TeeOutput(log_file, sys.stdout)))
+
+        use_rag = os.getenv("USE_RAG")
+
+        # 延迟导入agent模块，仅在真正运行时加载
+        from agents.openeuler_agents import (
+            check_log_agent,
+            step_inspector,
+        )
+        from agents.openeuler_agents.os_group import (
+            os_planner, 
+            os_step_scheduler,
+            os_rag_optimizer,
+        )
+        from agents.openeuler_agents.os_group.network_agent import network_agent
+        from agents.openeuler_agents.os_group.permissions_agent import permissions_agent
+        from agents.openeuler_agents.os_group.basic_agent import basic_agent
+        from agents.openeuler_agents.os_group.user_agent import user_agent
+        from agents.openeuler_agents.security_group import (
+            security_planner,
+            security_step_scheduler,
+            security_rag_optimizer,
+        )
+        from agents.openeuler_agents.security_group.secscanner_agent import secscanner_agent
+        from agents.openeuler_agents.security_group.syscare_agent import syscare_agent
+        from agents.openeuler_agents.software_group import (
+            software_planner,
+            software_step_scheduler,
+            software_rag_optimizer,
+        )
+        from agents.openeuler_agents.software_group.sql_agent import sql_agent
+        from agents.openeuler_agents.software_group.atune_agent import atune_agent
+        from agents.openeuler_agents.software_group.package_agent import package_agent
+        from agents.openeuler_agents.software_group.repository_agent import repository_agent
+        from agents.openeuler_agents.subtask_planner import (
+            subtask_inspector,
+            subtask_planner,
+            subtask_scheduler,
+        )
+        from agents.openeuler_agents.task_planner import (
+            task_inspector,
+            task_inspector_rag,
+            task_planner,
+            task_planner_rag,
+            task_scheduler,
+            task_scheduler_rag,
+            task_manager_rag
+        )
 
-    # 创建日志文件
-    log_file = open(log_file_path, "w", encoding="utf-8", buffering=1)
+        from agents.subtask_planner import(
+            subtask_manager
+        )
 
-    # 创建自定义的输出类,同时将输出发送到文件和终端
-    class TeeOutput:
-        def __init__(self, file, terminal):
-            self.file = file
-            self.terminal = terminal
+        from agents.cap_group_agents.CES_group import (
+            CES_manager, CES_planner, CES_step_scheduler
+        )
+        from agents.cap_group_agents.ECS_group import (
+            ECS_manager, ECS_planner, ECS_step_scheduler, ECS_rag_optimizer
+        )
+        from agents.cap_group_agents.EVS_group import (
+            EVS_manager, EVS_planner, EVS_step_scheduler
+        )
+        from agents.cap_group_agents.IAM_service_group import (
+            IAM_service_manager, IAM_service_planner, IAM_service_step_scheduler, IAM_rag_optimizer
+        )
+        from agents.cap_group_agents.IMS_group import (
+            IMS_manager, IMS_planner, IMS_step_scheduler, IMS_rag_optimizer
+        )
+        from agents.cap_group_agents.VPC_network import (
+            VPC_network_manager, VPC_network_planner, VPC_network_step_scheduler, VPC_network_rag_optimizer
+        )
+        from agents.cap_group_agents.CLUSTER_group import (
+            CLUSTER_manager, CLUSTER_planner, CLUSTER_step_scheduler, CLUSTER_rag_optimizer
+        )
+        from agents.cap_group_agents.NODE_group import (
+            NODE_manager, NODE_planner, NODE_step_scheduler, NODE_rag_optimizer
+        )
+        from agents.openeuler_agents.file_group import (
+        file_planner, file_step_scheduler, file_rag_optimizer
+        )
 
-        def write(self, message):
-            self.terminal.write(message)
-            self.file.write(message)
+        from agents.cap_group_agents import step_inspector
 
-        def flush(self):
-            self.terminal.flush()
-            self.file.flush()
+        from agents.cap_group_agents import (
+            basic_cap_solver, param_asker
+        )
 
-    # 保存原始的stdout,并设置新的输出重定向
-    original_stdout = sys.stdout
-    sys.stdout = TeeOutput(log_file, original_stdout)
+        from agents.cap_group_agents.CES_group.cap_agents.CES_alarm_history_agent import CES_alarm_history_agent
+        from agents.cap_group_agents.CES_group.cap_agents.CES_alarm_rule_agent import CES_alarm_rule_agent
+        from agents.cap_group_agents.CES_group.cap_agents.CES_dashboard_agent import CES_dashboard_agent
+        from agents.cap_group_agents.CES_group.cap_agents.CES_data_agent import CES_data_agent
+        from agents.cap_group_agents.CES_group.cap_agents.CES_event_agent import CES_event_agent
+        from agents.cap_group_agents.CES_group.cap_agents.CES_metric_agent import CES_metric_agent
 
-    use_rag = os.getenv("USE_RAG")
+        from agents.cap_group_agents.ECS_group.cap_agents.ECS_harddisk_agent import ECS_harddisk_agent
+        from agents.cap_group_agents.ECS_group.cap_agents.ECS_instance_agent import ECS_instance_agent
+        from agents.cap_group_agents.ECS_group.cap_agents.ECS_netcard_agent import ECS_netcard_agent
+        from agents.cap_group_agents.ECS_group.cap_agents.ECS_recommend_agent import ECS_recommend_agent
+        from agents.cap_group_agents.ECS_group.cap_agents.ECS_specification_query_agent import ECS_specification_query_agent
+
+        from agents.cap_group_agents.EVS_group.cap_agents.EVS_clouddiskt_agent import EVS_clouddiskt_agent
+        from agents.cap_group_agents.EVS_group.cap_agents.EVS_snapshot_agent import EVS_snapshot_agent
+
+        from agents.cap_group_agents.IAM_service_group.cap_agents.AKSK_agent import AKSK_agent
+
+        from agents.cap_group_agents.IMS_group.cap_agents.IMS_agent import IMS_agent
+
+        from agents.cap_group_agents.OS_group.cap_agents.OS_agent import OS_agent
+
+        from agents.cap_group_agents.VPC_network.cap_agents.VPC_secgroup_agent import VPC_secgroup_agent
+        from agents.cap_group_agents.VPC_network.cap_agents.VPC_subnet_agent import VPC_subnet_agent
+        from agents.cap_group_agents.VPC_network.cap_agents.VPC_vpc_agent import VPC_vpc_agent
+
+        from agents.cap_group_agents.CLUSTER_group.cap_agents.CLUSTER_lifecycle_agent import CLUSTER_lifecycle_agent
+        from agents.cap_group_agents.CLUSTER_group.cap_agents.CLUSTER_specification_change_agent import CLUSTER_specification_change_agent
+
+        from agents.cap_group_agents.NODE_group.cap_agents.NODE_lifecycle_agent import NODE_lifecycle_agent
+        from agents.cap_group_agents.NODE_group.cap_agents.NODE_pool_agent import NODE_pool_agent
+        from agents.cap_group_agents.NODE_group.cap_agents.NODE_scaling_protect_agent import NODE_scaling_protect_agent
+
+
+        from agents.basic_agents.job_agent import check_log_agent
+        from agents.basic_agents.job_agent.tools.CheckLogForFailures import CheckLogForFailures
+        from agents.basic_agents.api_agents.tools.CheckParamRequired import CheckParamRequired
+        from agents.basic_agents.api_agents.tools.SelectAPIParam import SelectAPIParam
+        from agents.basic_agents.api_agents.tools.SelectParamTable import SelectParamTable
+        from agents.basic_agents.api_agents.tools.SplitArray import SplitArray
+
+        from agents.openeuler_agents.tools.SSHExecuteCommand import SSHExecuteCommand
+
+
+        from agents.basic_agents.api_agents import (
+            API_param_selector, array_selector, param_selector, param_inspector, array_splitter
+        )
+
+        from agents.openeuler_agents.file_group.text_agent import text_agent
+        from agents.openeuler_agents.file_group.file_io_agent import file_io_agent
+        from agents.openeuler_agents.file_group.script_agent import script_agent
 
-    try:
         # 以下是日志功能更新前的代码
-        task_planner_instance = task_planner.create_agent()
-        task_scheduler_instance = task_scheduler.create_agent()
-        task_inspector_instance = task_inspector.create_agent()
-
-        task_planner_rag_instance = task_planner_rag.create_agent()
-        task_scheduler_rag_instance = task_scheduler_rag.create_agent()
-        task_inspector_rag_instance = task_inspector_rag.create_agent()
-        task_manager_rag_instance = task_manager_rag.create_agent()
-
-        software_rag_optimizer_instance = software_rag_optimizer.create_agent()
-        security_rag_optimizer_instance = security_rag_optimizer.create_agent()
-        os_rag_optimizer_instance = os_rag_optimizer.create_agent()
-        file_rag_optimizer_instance = file_rag_optimizer.create_agent()
-
-        ECS_rag_optimizer_instance = ECS_rag_optimizer.create_agent()
-        IAM_rag_optimizer_instance = IAM_rag_optimizer.create_agent()
-        IMS_rag_optimizer_instance = IMS_rag_optimizer.create_agent()
-        VPC_network_rag_optimizer_instance = VPC_network_rag_optimizer.create_agent()
-        # CLUSTER_rag_optimizer_instance = CLUSTER_rag_optimizer.create_agent()
-        # NODE_rag_optimizer_instance = NODE_rag_optimizer.create_agent()
-        
-        subtask_planner_instance = subtask_planner.create_agent()
-        subtask_scheduler_instance = subtask_scheduler.create_agent()
-        subtask_inspector_instance = subtask_inspector.create_agent()
-        subtask_manager_instance = subtask_manager.create_agent()
-
-        step_inspector_instance = step_inspector.create_agent()
-        basic_cap_solver_instance = basic_cap_solver.create_agent()
-        param_asker_instance = param_asker.create_agent()
-
-        software_planner_instance = software_planner.create_agent()
-        software_step_scheduler_instance = software_step_scheduler.create_agent()
-        package_agent_instance = package_agent.create_agent()
-        repository_agent_instance = repository_agent.create_agent()
-        atune_agent_instance = atune_agent.create_agent()
-        sql_agent_instance = sql_agent.create_agent()
-
-        security_planner_instance = security_planner.create_agent()
-        security_step_scheduler_instance = security_step_scheduler.create_agent()
-        secscanner_agent_instance = secscanner_agent.create_agent()
-        syscare_agent_instance = syscare_agent.create_agent()
-
-        os_planner_instance = os_planner.create_agent()
-        os_step_scheduler_instance = os_step_scheduler.create_agent()
-        permissions_agent_instance = permissions_agent.create_agent()
-        network_agent_instance = network_agent.create_agent()
-        user_agent_instance = user_agent.create_agent()
-        basic_agent_instance = basic_agent.create_agent()
-
-        check_log_agent_instance = check_log_agent.create_agent()
-
-        basic_cap_solver_instance = basic_cap_solver.create_agent()
-        param_asker_instance = param_asker.create_agent()
-
-        file_planner_instance = file_planner.create_agent()
-        file_step_scheduler_instance = file_step_scheduler.create_agent()
-        text_agent_instance = text_agent.create_agent()
-        file_io_agent_instance = file_io_agent.create_agent()
-        script_agent_instance = script_agent.create_agent()
-        # repeater = repeater.create_agent()
-        # rander = rander.create_agent()
-        # palindromist = palindromist.create_agent()
-
-        # simulator = simulator.create_agent()
-
-        # CES_planner = CES_planner.create_agent()
-        # CES_manager = CES_manager.create_agent()
-        # CES_step_scheduler = CES_step_scheduler.create_agent()
-        # CES_alarm_history_agent = CES_alarm_history_agent.create_agent()
-        # CES_alarm_rule_agent = CES_alarm_rule_agent.create_agent()
-        # CES_dashboard_agent = CES_dashboard_agent.create_agent()
-        # CES_data_agent = CES_data_agent.create_agent()
-        # CES_event_agent = CES_event_agent.create_agent()
-        # CES_metric_agent = CES_metric_agent.create_agent()
-
-        ECS_planner_instance = ECS_planner.create_agent()
-        ECS_manager_instance = ECS_manager.create_agent()
-        ECS_step_scheduler_instance = ECS_step_scheduler.create_agent()
-        ECS_harddisk_agent_instance = ECS_harddisk_agent.create_agent()
-        ECS_instance_agent_instance = ECS_instance_agent.create_agent()
-        ECS_netcard_agent_instance = ECS_netcard_agent.create_agent()
-        ECS_recommend_agent_instance = ECS_recommend_agent.create_agent()
-        ECS_specification_query_agent_instance = ECS_specification_query_agent.create_agent()
-
-        IAM_service_planner_instance = IAM_service_planner.create_agent()
-        IAM_service_manager_instance = IAM_service_manager.create_agent()
-        IAM_service_step_scheduler_instance = IAM_service_step_scheduler.create_agent()
-        AKSK_agent_instance = AKSK_agent.create_agent()
-
-        IMS_planner_instance = IMS_planner.create_agent()
-        IMS_manager_instance = IMS_manager.create_agent()
-        IMS_step_scheduler_instance = IMS_step_scheduler.create_agent()
-        IMS_agent_instance = IMS_agent.create_agent()
-
-        VPC_network_planner_instance = VPC_network_planner.create_agent()
-        VPC_network_manager_instance = VPC_network_manager.create_agent()
-        VPC_network_step_scheduler_instance = VPC_network_step_scheduler.create_agent()
-        VPC_secgroup_agent_instance = VPC_secgroup_agent.create_agent()
-        VPC_subnet_agent_instance = VPC_subnet_agent.create_agent()
-        VPC_vpc_agent_instance = VPC_vpc_agent.create_agent()
-
-        # CLUSTER_planner_instance = CLUSTER_planner.create_agent()
-        # CLUSTER_manager_instance = CLUSTER_manager.create_agent()
-        # CLUSTER_step_scheduler_instance = CLUSTER_step_scheduler.create_agent()
-        # CLUSTER_lifecycle_agent_instance = CLUSTER_lifecycle_agent.create_agent()
-        # CLUSTER_specification_change_agent_instance = CLUSTER_specification_change_agent.create_agent()
-
-        # NODE_planner_instance = NODE_planner.create_agent()
-        # NODE_manager_instance = NODE_manager.create_agent()
-        # NODE_step_scheduler_instance = NODE_step_scheduler.create_agent()
-        # NODE_lifecycle_agent_instance = NODE_lifecycle_agent.create_agent()
-        # NODE_pool_agent_instance = NODE_pool_agent.create_agent()
-        # NODE_scaling_protect_agent_instance = NODE_scaling_protect_agent.create_agent()
-
-
-        check_log_agent_instance = check_log_agent.create_agent()
-        API_param_selector_instance = API_param_selector.create_agent()
-        array_selector_instance = array_selector.create_agent()
-        array_splitter_instance = array_splitter.create_agent()
-        param_selector_instance = param_selector.create_agent()
-        param_inspector_instance = param_inspector.create_agent()
+        (
+            task_planner_instance, task_scheduler_instance, task_inspector_instance,
+            task_planner_rag_instance, task_scheduler_rag_instance, task_inspector_rag_instance,
+            task_manager_rag_instance,
+            software_rag_optimizer_instance, security_rag_optimizer_instance,
+            os_rag_optimizer_instance, file_rag_optimizer_instance,
+            ECS_rag_optimizer_instance, IAM_rag_optimizer_instance, IMS_rag_optimizer_instance,
+            VPC_network_rag_optimizer_instance,
+            # CLUSTER_rag_optimizer_instance = CLUSTER_rag_optimizer.create_agent()
+            # NODE_rag_optimizer_instance = NODE_rag_optimizer.create_agent()
+            subtask_planner_instance, subtask_scheduler_instance, subtask_inspector_instance,
+            subtask_manager_instance,
+            step_inspector_instance, basic_cap_solver_instance, param_asker_instance,
+            software_planner_instance, software_step_scheduler_instance, package_agent_instance,
+            repository_agent_instance, atune_agent_instance, sql_agent_instance,
+            security_planner_instance, security_step_scheduler_instance, secscanner_agent_instance,
+            syscare_agent_instance,
+            os_planner_instance, os_step_scheduler_instance, permissions_agent_instance,
+            network_agent_instance, user_agent_instance, basic_agent_instance,
+            check_log_agent_instance,
+            basic_cap_solver_instance, param_asker_instance,
+            file_planner_instance, file_step_scheduler_instance, text_agent_instance,
+            file_io_agent_instance, script_agent_instance,
+            # repeater = repeater.create_agent()
+            # rander = rander.create_agent()
+            # palindromist = palindromist.create_agent()
+            # simulator = simulator.create_agent()
+            # CES_planner = CES_planner.create_agent()
+            # CES_manager = CES_manager.create_agent()
+            # CES_step_scheduler = CES_step_scheduler.create_agent()
+            # CES_alarm_history_agent = CES_alarm_history_agent.create_agent()
+            # CES_alarm_rule_agent = CES_alarm_rule_agent.create_agent()
+            # CES_dashboard_agent = CES_dashboard_agent.create_agent()
+            # CES_data_agent = CES_data_agent.create_agent()
+            # CES_event_agent = CES_event_agent.create_agent()
+            # CES_metric_agent = CES_metric_agent.create_agent()
+            ECS_planner_instance, ECS_manager_instance, ECS_step_scheduler_instance,
+            ECS_harddisk_agent_instance, ECS_instance_agent_instance, ECS_netcard_agent_instance,
+            ECS_recommend_agent_instance, ECS_specification_query_agent_instance,
+            IAM_service_planner_instance, IAM_service_manager_instance,
+            IAM_service_step_scheduler_instance, AKSK_agent_instance,
+            IMS_planner_instance, IMS_manager_instance, IMS_step_scheduler_instance,
+            IMS_agent_instance,
+            VPC_network_planner_instance, VPC_network_manager_instance,
+            VPC_network_step_scheduler_instance, VPC_secgroup_agent_instance,
+            VPC_subnet_agent_instance, VPC_vpc_agent_instance,
+            # CLUSTER_planner_instance = CLUSTER_planner.create_agent()
+            # CLUSTER_manager_instance = CLUSTER_manager.create_agent()
+            # CLUSTER_step_scheduler_instance = CLUSTER_step_scheduler.create_agent()
+            # CLUSTER_lifecycle_agent_instance = CLUSTER_lifecycle_agent.create_agent()
+            # CLUSTER_specification_change_agent_instance = CLUSTER_specification_change_agent.create_agent()
+            # NODE_planner_instance = NODE_planner.create_agent()
+            # NODE_manager_instance = NODE_manager.create_agent()
+            # NODE_step_scheduler_instance = NODE_step_scheduler.create_agent()
+            # NODE_lifecycle_agent_instance = NODE_lifecycle_agent.create_agent()
+            # NODE_pool_agent_instance = NODE_pool_agent.create_agent()
+            # NODE_scaling_protect_agent_instance = NODE_scaling_protect_agent.create_agent()
+            check_log_agent_instance, API_param_selector_instance, array_selector_instance,
+            array_splitter_instance, param_selector_instance, param_inspector_instance,
+        ) = create_agents(
+            task_planner, task_scheduler, task_inspector,
+            task_planner_rag, task_scheduler_rag, task_inspector_rag, task_manager_rag,
+            software_rag_optimizer, security_rag_optimizer, os_rag_optimizer, file_rag_optimizer,
+            ECS_rag_optimizer, IAM_rag_optimizer, IMS_rag_optimizer, VPC_network_rag_optimizer,
+            subtask_planner, subtask_scheduler, subtask_inspector, subtask_manager,
+            step_inspector, basic_cap_solver, param_asker,
+            software_planner, software_step_scheduler, package_agent, repository_agent, atune_agent,
+            sql_agent,
+            security_planner, security_step_scheduler, secscanner_agent, syscare_agent,
+            os_planner, os_step_scheduler, permissions_agent, network_agent, user_agent,
+            basic_agent,
+            check_log_agent,
+            basic_cap_solver, param_asker,
+            file_planner, file_step_scheduler, text_agent, file_io_agent, script_agent,
+            ECS_planner, ECS_manager, ECS_step_scheduler, ECS_harddisk_agent, ECS_instance_agent,
+            ECS_netcard_agent, ECS_recommend_agent, ECS_specification_query_agent,
+            IAM_service_planner, IAM_service_manager, IAM_service_step_scheduler, AKSK_agent,
+            IMS_planner, IMS_manager, IMS_step_scheduler, IMS_agent,
+            VPC_network_planner, VPC_network_manager, VPC_network_step_scheduler,
+            VPC_secgroup_agent, VPC_subnet_agent, VPC_vpc_agent,
+            check_log_agent, API_param_selector, array_selector, array_splitter, param_selector,
+            param_inspector,
+        )
 
         chat_graph = [
             # task
@@ -470,25 +433,41 @@ def main():
 
         ]
 
+        # 接收方 -> 调用方列表，这些调用每次都使用新的会话线程
+        always_new_callers = {
+            check_log_agent: [SSHExecuteCommand, CheckLogForFailures],
+            param_selector: [SelectAPIParam, SelectParamTable],
+            array_selector: [param_selector, CheckParamRequired],
+            array_splitter: [SplitArray],
+        }
         thread_strategy = {
             "always_new": [
-                (SSHExecuteCommand, check_log_agent),
-                (SelectAPIParam, param_selector),
-                (SelectParamTable, param_selector),
-                (param_selector, array_selector),
-                (CheckParamRequired, array_selector),
-                (CheckLogForFailures, check_log_agent),
-                (SplitArray, array_splitter)
+                (caller, recipient)
+                for recipient, callers in always_new_callers.items()
+                for caller in callers
             ]
         }
 
+        # 开启后缓存执行成功的计划，相同或相似（embedding相似度）的请求直接复用，不再调用planner
+        plan_cache = None
+        if os.getenv("PLAN_CACHE_ENABLED", "").lower() == "true":
+            from agency_swarm.util.cache import PlanCache, openai_embedder
+
+            plan_cache = PlanCache(
+                os.path.join("cache", "plan_cache.sqlite"), embed=openai_embedder()
+            )
+
         agency = Agency(
             agency_chart=chat_graph,
             thread_strategy=thread_strategy,
             temperature=0.5,
             max_prompt_tokens=25000,
             log_file=log_file,
+            event_callback=event_logger(event_log),
+            plan_cache=plan_cache,
         )
+        # 退出时先停止agency的线程池，等正在执行的step结束后再关闭日志
+        stack.callback(agency.shutdown)
 
         plan_agents = {
             "task_planner": task_planner_instance,
@@ -641,13 +620,6 @@ def main():
             if text.lower() == "exit":
                 break
 
-    finally:
-        # 关闭日志文件和恢复标准输出
-        sys.stdout = original_stdout
-        log_file.close()
-        print(f"日志已保存到:{log_file_path}")
-        
-
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,136 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from agency_swarm.agency.agency import Agency
+
+
+def tree_node(node_id):
+    return {"id": node_id, "title": node_id, "description": f"do {node_id}"}
+
+
+class ContextTreeTest(unittest.TestCase):
+    """任务树的内存副本与context_tree.json的写回"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+        self.path = os.path.join(self.dir, "context_tree.json")
+        self.agency = self.new_agency()
+
+    def new_agency(self):
+        agency = object.__new__(Agency)
+        agency.error_path = os.path.join(self.dir, "error.json")
+        agency.CONTEXT_TREE_PATH = self.path
+        agency._context_tree = None
+        agency._context_tree_dirty = False
+        agency._context_tree_nodes = {}
+        agency._errors = {}
+        agency._errors_dirty = False
+        return agency
+
+    def read_tree(self):
+        with open(self.path, encoding="utf-8") as file:
+            return json.load(file)
+
+    def test_node_updates_are_written_on_flush(self):
+        agency = self.agency
+        agency.init_context_tree(request_id="request_1", content="request")
+        agency.add_context_tree_nodes(
+            request_id="request_1", nodes=[tree_node("task_1")]
+        )
+        agency.update_context_tree(
+            request_id="request_1", task_id="task_1", status="executing"
+        )
+        self.assertFalse(os.path.exists(self.path))
+
+        agency.flush_context_tree()
+        [task] = self.read_tree()["request_1"]["tasks"]
+        self.assertEqual(task["status"], "executing")
+
+    def test_flush_without_changes_does_not_write(self):
+        agency = self.agency
+        agency.init_context_tree(request_id="request_1", content="request")
+        agency.flush_context_tree()
+        os.remove(self.path)
+        agency.flush_context_tree()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_request_status_is_written_immediately(self):
+        agency = self.agency
+        agency.init_context_tree(request_id="request_1", content="request")
+        agency.update_context_tree(request_id="request_1", status="completed")
+        self.assertEqual(self.read_tree()["request_1"]["status"], "completed")
+
+    def test_existing_file_is_loaded_on_first_use(self):
+        self.agency.init_context_tree(request_id="request_1", content="first")
+        self.agency.update_context_tree(request_id="request_1", status="completed")
+
+        agency = self.new_agency()
+        agency.init_context_tree(request_id="request_2", content="second")
+        agency.update_context_tree(request_id="request_2", status="completed")
+        self.assertEqual(list(self.read_tree()), ["request_1", "request_2"])
+
+    def add_subtask(self, agency):
+        agency.init_context_tree(request_id="request_1", content="request")
+        agency.add_context_tree_nodes(
+            request_id="request_1", nodes=[tree_node("task_1")]
+        )
+        agency.add_context_tree_nodes(
+            request_id="request_1", task_id="task_1", nodes=[tree_node("subtask_1")]
+        )
+
+    def test_replanned_steps_replace_indexed_nodes(self):
+        agency = self.agency
+        self.add_subtask(agency)
+        ids = {
+            "request_id": "request_1",
+            "task_id": "task_1",
+            "subtask_id": "subtask_1",
+        }
+        agency.add_context_tree_nodes(nodes=[tree_node("step_1")], **ids)
+        agency.update_context_tree(step_id="step_1", status="executing", **ids)
+
+        # 重新规划时子树被摘除，同id的新节点不能被索引中的旧节点顶替
+        agency.clear_context_tree_node(**ids)
+        agency.add_context_tree_nodes(nodes=[tree_node("step_1")], **ids)
+        agency.update_context_tree(step_id="step_1", status="completed", **ids)
+        agency.update_context_tree(
+            step_id="step_1", action={"result": "SUCCESS"}, **ids
+        )
+        agency.flush_context_tree()
+
+        [task] = self.read_tree()["request_1"]["tasks"]
+        [subtask] = task["subtasks"]
+        self.assertEqual(
+            [
+                (step["id"], step["status"], step["actions"])
+                for step in subtask["steps"]
+            ],
+            [("step_1", "completed", [{"result": "SUCCESS"}])],
+        )
+
+    def test_reinitialized_request_forgets_indexed_nodes(self):
+        agency = self.agency
+        self.add_subtask(agency)
+        agency.init_context_tree(request_id="request_1", content="request")
+        with self.assertRaisesRegex(Exception, "task_1 not found in request_1"):
+            agency.add_context_tree_nodes(
+                request_id="request_1", task_id="task_1", nodes=[tree_node("subtask_1")]
+            )
+
+    def test_missing_node_error_names_first_missing_level(self):
+        agency = self.agency
+        self.add_subtask(agency)
+        with self.assertRaisesRegex(Exception, "subtask_9 not found in task_1"):
+            agency.clear_context_tree_node(
+                request_id="request_1", task_id="task_1", subtask_id="subtask_9"
+            )
+        with self.assertRaisesRegex(Exception, "Request request_9 not found"):
+            agency.clear_context_tree_node(request_id="request_9", task_id="task_1")
+
+
+if __name__ == "__main__":
+    unittest.main()
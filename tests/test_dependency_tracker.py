@@ -0,0 +1,77 @@
+import random
+import unittest
+
+from agency_swarm.agency.agency import _DependencyTracker
+
+
+def naive_ready(graph, completed_ids):
+    completed = set(completed_ids)
+    return [
+        node_id
+        for node_id, info in graph.items()
+        if node_id not in completed and all(dep in completed for dep in info["dep"])
+    ]
+
+
+def random_dag(rng, size):
+    graph = {}
+    for index in range(size):
+        node_id = f"step_{index + 1}"
+        deps = rng.sample(list(graph), rng.randint(0, min(3, len(graph))))
+        graph[node_id] = {"title": f"title {index + 1}", "dep": deps}
+    # 打乱顺序，依赖不一定出现在节点之前
+    items = list(graph.items())
+    rng.shuffle(items)
+    return dict(items)
+
+
+class DependencyTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.graph = {
+            "a": {"title": "A", "dep": []},
+            "b": {"title": "B", "dep": ["a"]},
+            "c": {"title": "C", "dep": ["a", "b"]},
+            "d": {"title": "D", "dep": []},
+        }
+
+    def test_ready_follows_completions(self):
+        tracker = _DependencyTracker(self.graph)
+        completed = []
+        self.assertEqual(tracker.ready(completed), ["a", "d"])
+        completed.append("a")
+        self.assertEqual(tracker.ready(completed), ["b", "d"])
+        completed += ["d", "b"]
+        self.assertEqual(tracker.ready(completed), ["c"])
+        completed.append("c")
+        self.assertEqual(tracker.ready(completed), [])
+
+    def test_pending_and_labels(self):
+        tracker = _DependencyTracker(self.graph)
+        self.assertEqual(tracker.completed_text, "none")
+        ready = tracker.ready(["a"])
+        self.assertEqual(tracker.pending(ready), ["c"])
+        self.assertEqual(tracker.completed_text, "a (A)")
+        ready = tracker.ready(["a", "d", "d"])
+        self.assertEqual(tracker.pending(ready), ["c"])
+        self.assertEqual(tracker.completed_text, "a (A), d (D)")
+        self.assertEqual(tracker.label("b"), "b (B)")
+
+    def test_matches_full_recomputation_on_random_dags(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            graph = random_dag(rng, rng.randint(1, 25))
+            tracker = _DependencyTracker(graph)
+            completed = []
+            while True:
+                ready = tracker.ready(completed)
+                self.assertEqual(ready, naive_ready(graph, completed))
+                if not ready:
+                    break
+                # 每轮完成一部分可执行节点，模拟并发执行时的不同完成顺序
+                done = rng.sample(ready, rng.randint(1, len(ready)))
+                completed.extend(done)
+            self.assertEqual(set(completed), set(graph))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,25 @@
+import json
+import unittest
+
+from agency_swarm.util import fast_json
+
+
+class FastJsonTest(unittest.TestCase):
+    def test_round_trip_keeps_non_ascii(self):
+        obj = {"title": "创建节点", "dep": ["step_1"], "count": 2}
+        text = fast_json.dumps(obj)
+        self.assertIn("创建节点", text)
+        self.assertNotIn("\n", text)
+        self.assertEqual(fast_json.loads(text), obj)
+
+    def test_dumps_indented(self):
+        text = fast_json.dumps_indented({"a": [1]})
+        self.assertEqual(text, json.dumps({"a": [1]}, indent=2))
+
+    def test_invalid_json_raises_json_decode_error(self):
+        with self.assertRaises(json.JSONDecodeError):
+            fast_json.loads("{not json")
+
+
+if __name__ == "__main__":
+    unittest.main()
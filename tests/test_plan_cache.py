@@ -0,0 +1,84 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from agency_swarm.util.cache import PlanCache
+
+
+def keyword_embedder(text):
+    """按关键词给出固定向量，便于构造相似/不相似的请求"""
+    return [1.0, 0.0] if "ecs" in text else [0.0, 1.0]
+
+
+class PlanCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "plan_cache.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_get_returns_stored_key_and_plan(self):
+        cache = PlanCache(self.path)
+        self.assertIsNone(cache.get("key"))
+        cache.set("key", [{"task_1": {}}, True])
+        self.assertEqual(cache.get("key"), ("key", [{"task_1": {}}, True]))
+
+    def test_plans_persist_across_instances(self):
+        PlanCache(self.path).set("key", {"plan": 1})
+        self.assertEqual(PlanCache(self.path).get("key"), ("key", {"plan": 1}))
+
+    def test_similar_hit_can_be_discarded(self):
+        cache = PlanCache(self.path, embed=keyword_embedder)
+        cache.set("k1", "plan", scope="planner", text="create an ecs")
+        matched_key, plan = cache.get("k2", scope="planner", text="create one ecs")
+        self.assertEqual((matched_key, plan), ("k1", "plan"))
+        cache.discard(matched_key)
+        self.assertIsNone(cache.get("k2", scope="planner", text="create one ecs"))
+
+    def test_entries_expire(self):
+        cache = PlanCache(self.path, ttl=0.05)
+        cache.set("key", "plan")
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("key"))
+
+    def test_least_recently_used_is_evicted_with_a_frozen_clock(self):
+        cache = PlanCache(self.path, maxsize=2)
+        # 时钟不变（如Windows上的粗粒度时钟）时淘汰顺序也必须确定
+        with mock.patch("agency_swarm.util.cache.time.time", return_value=1000.0):
+            cache.set("a", 1)
+            cache.set("b", 2)
+            for _ in range(3):
+                cache.get("a")
+                cache.get("b")
+            cache.set("c", 3)
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(cache.get("b"), ("b", 2))
+            self.assertEqual(cache.get("c"), ("c", 3))
+
+    def test_new_plans_are_never_evicted_on_insert(self):
+        cache = PlanCache(self.path, maxsize=3)
+        with mock.patch("agency_swarm.util.cache.time.time", return_value=1000.0):
+            for index in range(10):
+                cache.set(str(index), index)
+                self.assertEqual(cache.get(str(index)), (str(index), index))
+
+    def test_opens_cache_file_without_last_used_column(self):
+        db = sqlite3.connect(self.path)
+        db.execute(
+            "CREATE TABLE plans (key TEXT PRIMARY KEY, scope TEXT, embedding TEXT, "
+            "value TEXT, expires_at REAL, hits INTEGER DEFAULT 0)"
+        )
+        db.commit()
+        db.close()
+        cache = PlanCache(self.path)
+        cache.set("key", "plan")
+        self.assertEqual(cache.get("key"), ("key", "plan"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,19 @@
+import time
+import unittest
+
+from agency_swarm.util.rate_limit import RateLimiter
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_burst_then_waits_for_refill(self):
+        limiter = RateLimiter(2, 0.2)
+        start = time.monotonic()
+        limiter.acquire()
+        limiter.acquire()
+        self.assertLess(time.monotonic() - start, 0.05)
+        limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+
+if __name__ == "__main__":
+    unittest.main()
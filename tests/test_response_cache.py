@@ -0,0 +1,48 @@
+import time
+import unittest
+
+from agency_swarm.util.cache import ResponseCache
+
+
+def keyword_embedder(text):
+    """按关键词给出固定向量，便于构造相似/不相似的请求"""
+    return [1.0, 0.0] if "ecs" in text else [0.0, 1.0]
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def test_exact_hit_and_miss(self):
+        cache = ResponseCache()
+        key = cache.make_key("agent", "message")
+        self.assertIsNone(cache.get(key))
+        cache.set(key, "result")
+        self.assertEqual(cache.get(key), "result")
+        self.assertNotEqual(key, cache.make_key("agent", "other message"))
+
+    def test_entries_expire(self):
+        cache = ResponseCache(ttl=0.05)
+        cache.set("key", "result")
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("key"))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ResponseCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_similar_text_within_scope(self):
+        cache = ResponseCache(embed=keyword_embedder)
+        cache.set("k1", "result", scope="agent", text="create an ecs")
+        self.assertEqual(
+            cache.get("k2", scope="agent", text="create one ecs"), "result"
+        )
+        self.assertIsNone(cache.get("k3", scope="agent", text="create a vpc"))
+        self.assertIsNone(cache.get("k4", scope="other", text="create an ecs"))
+
+
+if __name__ == "__main__":
+    unittest.main()
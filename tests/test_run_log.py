@@ -0,0 +1,53 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from agency_swarm.util.run_log import RunLog, event_logger, event_time
+
+
+class RunLogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "run_log.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_close_writes_everything(self):
+        log = RunLog(self.path)
+        for line in range(100):
+            log.write(f"line {line}\n")
+        log.close()
+        log.close()
+        with open(self.path, encoding="utf-8") as file:
+            self.assertEqual(file.read().count("\n"), 100)
+
+    def test_event_logger_writes_json_lines(self):
+        with RunLog(self.path) as log:
+            log_event = event_logger(log)
+            log_event("task_planner", "user", "创建节点")
+            log_event("task_planner", "assistant", "{}")
+        with open(self.path, encoding="utf-8") as file:
+            events = [json.loads(line) for line in file]
+        self.assertEqual(
+            [(event["agent"], event["role"]) for event in events],
+            [("task_planner", "user"), ("task_planner", "assistant")],
+        )
+        self.assertEqual(events[0]["content"], "创建节点")
+
+    def test_events_carry_nanosecond_timestamps(self):
+        with RunLog(self.path) as log:
+            log_event = event_logger(log)
+            log_event("task_planner", "user", "a")
+            log_event("task_planner", "assistant", "b")
+        with open(self.path, encoding="utf-8") as file:
+            first, second = [json.loads(line) for line in file]
+        self.assertIsInstance(first["ts_ns"], int)
+        self.assertLessEqual(first["ts_ns"], second["ts_ns"])
+        self.assertLessEqual(event_time(first), event_time(second))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import json
+import unittest
+
+from agency_swarm.agency.agency import _loads_scheduled_ids, _scheduled_ids
+
+
+class ScheduledIdsTest(unittest.TestCase):
+    """_scheduled_ids必须与通用json解析的结果和异常一致，无论是否安装了msgspec"""
+
+    def assert_same_as_json(self, scheduled):
+        try:
+            expected = _loads_scheduled_ids(scheduled, "next_steps")
+        except Exception as error:
+            with self.assertRaises(type(error)):
+                _scheduled_ids(scheduled, "next_steps")
+            return
+        self.assertEqual(_scheduled_ids(scheduled, "next_steps"), expected)
+
+    def test_list_of_ids(self):
+        scheduled = '{"reason": "...", "next_steps": ["step_1", "step_2"]}'
+        self.assertEqual(_scheduled_ids(scheduled, "next_steps"), ["step_1", "step_2"])
+
+    def test_null_means_nothing_scheduled(self):
+        self.assertIsNone(_scheduled_ids('{"next_steps": null}', "next_steps"))
+
+    def test_missing_field_raises_key_error(self):
+        with self.assertRaises(KeyError):
+            _scheduled_ids('{"next_tasks": []}', "next_steps")
+
+    def test_invalid_json_raises_json_decode_error(self):
+        with self.assertRaises(json.JSONDecodeError):
+            _scheduled_ids('{"next_steps": [', "next_steps")
+
+    def test_matches_generic_parsing(self):
+        for scheduled in (
+            '{"next_steps": []}',
+            '{"next_steps": "step_1"}',
+            '{"next_steps": [1, "step_2"]}',
+            "[]",
+        ):
+            self.assert_same_as_json(scheduled)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import threading
+import unittest
+
+from agency_swarm.util.swap_buffer import SwapBuffer
+
+
+class SwapBufferTest(unittest.TestCase):
+    def test_drain_returns_everything_pushed(self):
+        buffer = SwapBuffer()
+        for item in range(5):
+            buffer.push(item)
+        self.assertEqual(buffer.drain(timeout=0), [0, 1, 2, 3, 4])
+        self.assertEqual(buffer.drain(timeout=0), [])
+
+    def test_only_latest_control_is_kept(self):
+        buffer = SwapBuffer()
+        buffer.put_control("status", 1)
+        buffer.put_control("status", 2)
+        self.assertEqual(buffer.drain(timeout=0), [])
+        self.assertEqual(buffer.take_control(), ("status", 2))
+        self.assertIsNone(buffer.take_control())
+
+    def test_full_buffer_blocks_producer_until_drained(self):
+        buffer = SwapBuffer(maxsize=2)
+        buffer.push(1)
+        buffer.push(2)
+        pushed = threading.Event()
+
+        def produce():
+            buffer.push(3)
+            pushed.set()
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        self.assertFalse(pushed.wait(0.1))
+        self.assertEqual(buffer.drain(timeout=0), [1, 2])
+        self.assertTrue(pushed.wait(1))
+        producer.join()
+        self.assertEqual(buffer.drain(timeout=0), [3])
+
+
+if __name__ == "__main__":
+    unittest.main()
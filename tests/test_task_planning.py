@@ -0,0 +1,456 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest import mock
+
+from agency_swarm.agency import agency as agency_module
+from agency_swarm.agency.agency import Agency
+
+
+class FakeThread:
+    """代替Thread，只记录对应的agent"""
+
+    def __init__(self, user, agent):
+        self.recipient_agent = agent
+
+
+def node(node_id, dep=(), **fields):
+    return {
+        "id": node_id,
+        "title": node_id,
+        "description": f"do {node_id}",
+        "dep": list(dep),
+        **fields,
+    }
+
+
+def graph(*nodes):
+    """把节点列表转成规划层返回的流程图"""
+    return json.dumps({item["id"]: item for item in nodes})
+
+
+def succeed(step, cap_group, cap_agent_threads):
+    # task_planning_rag把tool、result和context记入任务树
+    return {"tool": "fake_tool", "result": "SUCCESS", "context": "done"}
+
+
+def optimize(message, original_request, optimizer_thread, overall_id=""):
+    return json.dumps({"description": f"refined {overall_id}", "agent": ["cap_agent"]})
+
+
+class TaskPlanningTest(unittest.TestCase):
+    """用只含规划流程所需状态的Agency运行task_planning，规划层、调度层和能力agent均为假实现"""
+
+    plan_agents = {
+        name: SimpleNamespace(name=name)
+        for name in (
+            "task_planner",
+            "task_inspector",
+            "task_scheduler",
+            "subtask_planner",
+            "subtask_inspector",
+            "subtask_scheduler",
+            "step_inspector",
+        )
+    }
+    cap_group_agents = {
+        "group": [
+            SimpleNamespace(name="group_planner"),
+            SimpleNamespace(name="group_scheduler"),
+        ]
+    }
+    cap_agents = {"group": [SimpleNamespace(name="cap_agent")]}
+    # task_planning_rag使用的agent，task按能力群分到两个群
+    rag_plan_agents = {
+        name: SimpleNamespace(name=name)
+        for name in ("task_planner_rag", "task_inspector_rag", "task_manager_rag")
+    }
+    rag_cap_group_agents = {
+        group: [SimpleNamespace(name=f"{group}_optimizer")]
+        for group in ("group_a", "group_b")
+    }
+    rag_cap_agents = {
+        group: [SimpleNamespace(name="cap_agent")] for group in ("group_a", "group_b")
+    }
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+        thread_patcher = mock.patch.object(agency_module, "Thread", FakeThread)
+        thread_patcher.start()
+        self.addCleanup(thread_patcher.stop)
+
+        agency = object.__new__(Agency)
+        agency.user = None
+        agency.plan_cache = None
+        agency.error_path = os.path.join(self.dir, "error.json")
+        agency.CONTEXT_TREE_PATH = os.path.join(self.dir, "context_tree.json")
+        agency._context_tree = None
+        agency._context_tree_dirty = False
+        agency._context_tree_nodes = {}
+        agency._errors = {}
+        agency._errors_dirty = False
+        agency._agent_threads = {}
+        agency._spare_cap_agent_threads = {}
+        agency._step_pool = ThreadPoolExecutor(max_workers=8)
+        self.addCleanup(agency._step_pool.shutdown)
+        agency._setup_autocomplete = lambda: None
+        agency.init_files = lambda: None
+        agency.cached_planning_layer = self.plan
+        agency.scheduling_layer = self.schedule
+        agency.capability_agents_processor = lambda **kwargs: self.process(**kwargs)
+        agency.task_optimizing_layer = lambda **kwargs: self.optimize(**kwargs)
+        self.agency = agency
+
+        # 各层规划结果和调度器依次返回的批次，均以overall_id为key
+        self.plans = {}
+        self.batches = {}
+        self.plan_calls = []
+        self.process = succeed
+        self.optimize = optimize
+
+    def plan(
+        self, message, original_request, planner_thread, error_message="", **kwargs
+    ):
+        overall_id = kwargs["overall_id"]
+        self.plan_calls.append((overall_id, error_message))
+        if len(self.plan_calls) > 20:
+            raise AssertionError("planning does not converge")
+        return self.plans[overall_id], overall_id, kwargs.get("other_input", ""), None
+
+    def schedule(self, message, scheduler_thread):
+        batch = self.batches[message].pop(0)
+        return json.dumps(
+            {"next_tasks": batch, "next_subtasks": batch, "next_steps": batch}
+        )
+
+    def plan_steps(self, *steps):
+        self.plans.update(
+            {
+                "original request": graph(node("task_1")),
+                "task_1": graph(node("subtask_1", capability_group="group")),
+                "subtask_1": graph(*steps),
+            }
+        )
+
+    def run_planning(self, code_scheduling=False, parallel=True):
+        with (
+            mock.patch.object(agency_module, "CODE_SCHEDULING", code_scheduling),
+            mock.patch.object(agency_module, "PARALLEL_STEPS", parallel),
+        ):
+            self.agency.task_planning(
+                original_request="request",
+                plan_agents=self.plan_agents,
+                cap_group_agents=self.cap_group_agents,
+                cap_agents=self.cap_agents,
+                request_id="request_1",
+            )
+
+    def run_planning_rag(self, *tasks):
+        self.plans["original request"] = graph(*tasks)
+        with (
+            mock.patch.object(agency_module, "CODE_SCHEDULING", True),
+            mock.patch.object(agency_module, "PARALLEL_STEPS", True),
+        ):
+            self.agency.task_planning_rag(
+                original_request="request",
+                plan_agents=self.rag_plan_agents,
+                cap_group_agents=self.rag_cap_group_agents,
+                cap_agents=self.rag_cap_agents,
+                request_id="request_1",
+            )
+
+    def fail_step_start(self, step_id, wait_for):
+        """step_id开始执行时在run_step中抛出异常（在能力agent的错误处理之外），抛出前等待wait_for"""
+        update_context_tree = self.agency.update_context_tree
+
+        def update(**kwargs):
+            if kwargs.get("step_id") == step_id and kwargs.get("status") == "executing":
+                wait_for.wait(5)
+                raise RuntimeError("context tree unavailable")
+            return update_context_tree(**kwargs)
+
+        self.agency.update_context_tree = update
+
+    def step_statuses(self):
+        with open(self.agency.CONTEXT_TREE_PATH, encoding="utf-8") as file:
+            request = json.load(file)["request_1"]
+        [task] = request["tasks"]
+        [subtask] = task["subtasks"]
+        return request["status"], {
+            step["id"]: step["status"] for step in subtask["steps"]
+        }
+
+    def test_batch_of_steps_runs_concurrently_on_separate_threads(self):
+        self.plan_steps(node("step_1"), node("step_2"), node("step_3"))
+        self.batches.update(
+            {
+                "original request": [["task_1"], []],
+                "task_1": [["subtask_1"], []],
+                "subtask_1": [["step_1", "step_2", "step_3"], []],
+            }
+        )
+        # 三个step必须同时在执行才能通过barrier
+        barrier = threading.Barrier(3, timeout=5)
+        used_threads = []
+
+        def process(step, cap_group, cap_agent_threads):
+            used_threads.append(cap_agent_threads[cap_group]["cap_agent"])
+            barrier.wait()
+            return succeed(step, cap_group, cap_agent_threads)
+
+        self.process = process
+        self.run_planning()
+
+        self.assertEqual(len(set(map(id, used_threads))), 3)
+        self.assertEqual(
+            [overall_id for overall_id, _ in self.plan_calls],
+            ["original request", "task_1", "subtask_1"],
+        )
+        self.assertEqual(
+            self.step_statuses(),
+            (
+                "completed",
+                {"step_1": "completed", "step_2": "completed", "step_3": "completed"},
+            ),
+        )
+        # 借用的两组Thread已归还
+        self.assertEqual(len(self.agency._spare_cap_agent_threads["group"]), 2)
+
+    def test_failed_step_in_batch_replans_task(self):
+        self.plan_steps(node("step_1"), node("step_2"))
+        self.batches.update(
+            {
+                "original request": [["task_1"], []],
+                "task_1": [["subtask_1"], ["subtask_1"], []],
+                "subtask_1": [["step_1", "step_2"], ["step_1", "step_2"], []],
+            }
+        )
+        attempts = []
+
+        def process(step, cap_group, cap_agent_threads):
+            attempts.append(step["id"])
+            if step["id"] == "step_2" and attempts.count("step_2") == 1:
+                return {"result": "FAIL", "context": "disk full"}
+            return succeed(step, cap_group, cap_agent_threads)
+
+        self.process = process
+        self.run_planning()
+
+        # step失败后subtask以失败告终，带着错误信息重新规划所在的task
+        self.assertEqual(
+            self.plan_calls,
+            [
+                ("original request", ""),
+                ("task_1", ""),
+                ("subtask_1", ""),
+                ("task_1", "disk full"),
+                ("subtask_1", ""),
+            ],
+        )
+        self.assertEqual(sorted(attempts), ["step_1", "step_1", "step_2", "step_2"])
+        self.assertEqual(
+            self.step_statuses(),
+            ("completed", {"step_1": "completed", "step_2": "completed"}),
+        )
+
+    def test_ready_step_starts_without_waiting_for_slow_sibling(self):
+        self.plan_steps(node("step_1"), node("step_2"), node("step_3", dep=["step_2"]))
+        step_3_started = threading.Event()
+        overlapped = []
+
+        def process(step, cap_group, cap_agent_threads):
+            if step["id"] == "step_1":
+                # step_2完成后step_3应立即开始，不必等step_1结束
+                overlapped.append(step_3_started.wait(5))
+            elif step["id"] == "step_3":
+                step_3_started.set()
+            return succeed(step, cap_group, cap_agent_threads)
+
+        self.process = process
+        self.run_planning(code_scheduling=True)
+
+        self.assertEqual(overlapped, [True])
+        self.assertEqual(
+            self.step_statuses(),
+            (
+                "completed",
+                {"step_1": "completed", "step_2": "completed", "step_3": "completed"},
+            ),
+        )
+
+    def test_error_waits_for_running_steps_before_returning_threads(self):
+        self.plan_steps(node("step_1"), node("step_2"))
+        step_1_started = threading.Event()
+        step_1_finished = threading.Event()
+
+        def process(step, cap_group, cap_agent_threads):
+            step_1_started.set()
+            time.sleep(0.2)
+            step_1_finished.set()
+            return succeed(step, cap_group, cap_agent_threads)
+
+        self.process = process
+        self.fail_step_start("step_2", wait_for=step_1_started)
+        with self.assertRaisesRegex(RuntimeError, "context tree unavailable"):
+            self.run_planning(code_scheduling=True)
+
+        self.assertTrue(step_1_finished.is_set())
+        self.assertEqual(len(self.agency._spare_cap_agent_threads["group"]), 1)
+
+    def failing_first(self, *errors):
+        """能力agent的前几次调用依次抛出errors，之后成功；返回调用过的step id列表"""
+        attempts = []
+        errors = list(errors)
+
+        def process(step, cap_group, cap_agent_threads):
+            attempts.append(step["id"])
+            if errors:
+                raise errors.pop(0)
+            return succeed(step, cap_group, cap_agent_threads)
+
+        self.process = process
+        return attempts
+
+    def test_timed_out_step_is_retried_in_place(self):
+        self.plan_steps(node("step_1"))
+        attempts = self.failing_first(TimeoutError("model timed out"))
+        self.run_planning(code_scheduling=True, parallel=False)
+
+        self.assertEqual(attempts, ["step_1", "step_1"])
+        # 原地重试成功，不必重新规划
+        self.assertEqual(
+            self.plan_calls,
+            [("original request", ""), ("task_1", ""), ("subtask_1", "")],
+        )
+        self.assertEqual(self.step_statuses(), ("completed", {"step_1": "completed"}))
+
+    def test_repeated_timeout_replans_task(self):
+        self.plan_steps(node("step_1"))
+        attempts = self.failing_first(
+            TimeoutError("model timed out"), TimeoutError("model timed out")
+        )
+        self.run_planning(code_scheduling=True, parallel=False)
+
+        self.assertEqual(attempts, ["step_1"] * 3)
+        self.assertEqual(
+            self.plan_calls,
+            [
+                ("original request", ""),
+                ("task_1", ""),
+                ("subtask_1", ""),
+                ("task_1", "model timed out"),
+                ("subtask_1", ""),
+            ],
+        )
+
+    def test_other_errors_are_not_retried_in_place(self):
+        self.plan_steps(node("step_1"))
+        attempts = self.failing_first(ValueError("bad action"))
+        self.run_planning(code_scheduling=True, parallel=False)
+
+        self.assertEqual(attempts, ["step_1", "step_1"])
+        self.assertEqual(self.plan_calls[3], ("task_1", "bad action"))
+
+    def test_batch_of_tasks_runs_concurrently_on_separate_threads(self):
+        barrier = threading.Barrier(3, timeout=5)
+        used_threads = []
+        optimizer_threads = []
+
+        def process(step, cap_group, cap_agent_threads):
+            used_threads.append(cap_agent_threads[cap_group]["cap_agent"])
+            barrier.wait()
+            return succeed(step, cap_group, cap_agent_threads)
+
+        def record_optimizer(optimizer_thread, **kwargs):
+            optimizer_threads.append(optimizer_thread)
+            return optimize(optimizer_thread=optimizer_thread, **kwargs)
+
+        self.process = process
+        self.optimize = record_optimizer
+        self.run_planning_rag(
+            node("task_1", capability_group="group_a"),
+            node("task_2", capability_group="group_b"),
+            node("task_3", capability_group="group_a"),
+        )
+
+        self.assertEqual(len(set(map(id, used_threads))), 3)
+        self.assertEqual(len(set(map(id, optimizer_threads))), 3)
+        with open(self.agency.CONTEXT_TREE_PATH, encoding="utf-8") as file:
+            request = json.load(file)["request_1"]
+        self.assertEqual(request["status"], "completed")
+        self.assertEqual(
+            {task["id"]: task["status"] for task in request["tasks"]},
+            {"task_1": "completed", "task_2": "completed", "task_3": "completed"},
+        )
+        self.assertEqual(
+            {
+                group: len(threads)
+                for group, threads in self.agency._spare_cap_agent_threads.items()
+            },
+            {"group_a": 1, "group_b": 1},
+        )
+
+    def test_task_error_waits_for_running_tasks_before_returning_threads(self):
+        task_1_started = threading.Event()
+        task_1_finished = threading.Event()
+
+        def process(step, cap_group, cap_agent_threads):
+            task_1_started.set()
+            time.sleep(0.2)
+            task_1_finished.set()
+            return succeed(step, cap_group, cap_agent_threads)
+
+        def optimize_or_fail(overall_id="", **kwargs):
+            if overall_id == "task_2":
+                task_1_started.wait(5)
+                raise RuntimeError("optimizer unavailable")
+            return optimize(overall_id=overall_id, **kwargs)
+
+        self.process = process
+        self.optimize = optimize_or_fail
+        with self.assertRaisesRegex(RuntimeError, "optimizer unavailable"):
+            self.run_planning_rag(
+                node("task_1", capability_group="group_a"),
+                node("task_2", capability_group="group_b"),
+            )
+
+        self.assertTrue(task_1_finished.is_set())
+        self.assertEqual(len(self.agency._spare_cap_agent_threads["group_b"]), 1)
+
+    def test_step_batch_error_waits_for_running_steps_before_returning_threads(self):
+        self.plan_steps(node("step_1"), node("step_2"))
+        self.batches.update(
+            {
+                "original request": [["task_1"]],
+                "task_1": [["subtask_1"]],
+                "subtask_1": [["step_1", "step_2"]],
+            }
+        )
+        step_2_started = threading.Event()
+        step_2_finished = threading.Event()
+
+        def process(step, cap_group, cap_agent_threads):
+            step_2_started.set()
+            time.sleep(0.2)
+            step_2_finished.set()
+            return succeed(step, cap_group, cap_agent_threads)
+
+        self.process = process
+        # 先取结果的step_1抛出异常时，step_2仍在使用借出的Thread
+        self.fail_step_start("step_1", wait_for=step_2_started)
+        with self.assertRaisesRegex(RuntimeError, "context tree unavailable"):
+            self.run_planning()
+
+        self.assertTrue(step_2_finished.is_set())
+        self.assertEqual(len(self.agency._spare_cap_agent_threads["group"]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()